@@ -0,0 +1,524 @@
+import asyncio
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Queue
+from typing import Dict, List, Optional
+
+import httpx
+
+from .DownloadHandle import DownloadHandle, FileHandle
+from .FileFinalizer import FileFinalizer
+from .FinalizePool import FinalizePool
+from .FragmentWriter import FragmentWriter
+from .MetadataFetcher import MetadataFetcher
+from .ParkingLot import FragmentParked
+from .ProgressDispatcher import ProgressDispatcher
+from .TaskPlanner import TaskPlanner
+from .UrlResolver import UrlResolver
+from .state import (
+    ThrottleState,
+    FragmentTask,
+    FileState,
+    FileRecord,
+    FileStatus, onCompleteCallback, onProgressCallback,
+    FinalizeStats,
+)
+from ..Config import APIConfig
+from ..exceptions import RateLimitError, ServiceUnavailableError, DiscordAttachmentNotFoundError, ServerTimeoutError, NetworkError
+from ..models.Item import Item
+from ..utils.BandwidthLimiter import BandwidthLimiter
+from ..utils.FragmentCache import FragmentCache, PendingEntry
+from ..utils.Metrics import MetricsRegistry, MetricsSink
+from ..utils.RetryScheduler import RetryPolicy
+from ..utils.TransportPool import TransportPool
+
+logger = logging.getLogger("iDrive")
+
+
+class AsyncUltraDownloader:
+    """
+    Same job and public surface as UltraDownloader, but every fragment stream is a coroutine on one
+    event loop (running in a background thread) sharing a single httpx.AsyncClient, instead of a thread
+    with its own client. Decryption and file writes are batched into `write_block_size` blocks and
+    offloaded to a small executor; finished files are assembled by their own FinalizePool, so a long merge
+    never holds up other files' writes.
+    """
+
+    def __init__(self, max_concurrency: int = 200, direct_write: bool = True, io_workers: int = 4, write_block_size: int = 1024 * 1024,
+                 transport: Optional[TransportPool] = None, retry_policy: Optional[RetryPolicy] = None, fragment_cache: Optional[FragmentCache] = None,
+                 bandwidth_limiter: Optional[BandwidthLimiter] = None, metrics: Optional[MetricsSink] = None, max_finalize_workers: int = 8):
+        self._temp_download_folder = os.path.join(tempfile.gettempdir(), "idrive_download")
+        os.makedirs(self._temp_download_folder, exist_ok=True)
+
+        self.transport = transport or TransportPool.default()
+        self.metadata_fetcher = MetadataFetcher(transport=self.transport)
+        self.planner = TaskPlanner(self._temp_download_folder, direct_write=direct_write)
+        # per-stage latencies and counters, MetricsSink() turns them off
+        self.metrics = metrics or MetricsRegistry()
+        self.resolver = UrlResolver(metrics=self.metrics, transport=self.transport)
+        self.throttle = ThrottleState()
+        # optional, fragments found there skip both url resolution and transfer
+        self.fragment_cache = fragment_cache
+        # caps all transfers at once, unlimited unless given a rate
+        self.bandwidth_limiter = bandwidth_limiter or BandwidthLimiter()
+
+        self.max_concurrency = max_concurrency
+        self.write_block_size = write_block_size
+        self.max_retries = 5
+        self.retry_policy = retry_policy or RetryPolicy()
+
+        # Shared state
+        self._states: Dict[str, FileState] = {}
+        self._records: Dict[str, FileRecord] = {}
+        self._lock = threading.RLock()
+        # one thread for the progress callbacks of all files
+        self._progress = ProgressDispatcher()
+
+        self._io = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="iDriveAsyncIO")
+        # sized like UltraDownloader's: grows while finished files queue up and the disk keeps up
+        self._finalize_queue: Queue[str] = Queue()
+        self.finalizer = FinalizePool(self._finalize_queue, self._states, self._records, max_workers=max_finalize_workers, metrics=self.metrics)
+        self.finalizer.start()
+
+        # Everything below belongs to the event loop thread
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+        self._call(self._setup).result()
+
+    async def _setup(self) -> None:
+        self._client = self.transport.create_async_client(max_connections=self.max_concurrency)
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._global_gate = asyncio.Event()
+        self._global_gate.set()
+        self._file_gates: Dict[str, asyncio.Event] = {}
+        self._parked: Dict[str, List[FragmentTask]] = {}
+        # write blocks of the streams, taken for a fragment and put back after it: never more than one per stream
+        self._blocks: List[memoryview] = []
+        self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.max_concurrency)]
+
+    def _call(self, coro_fn, *args):
+        return asyncio.run_coroutine_threadsafe(coro_fn(*args), self._loop)
+
+    # ------------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------------
+
+    def download(self, data: Item, target_dir: str = APIConfig.download_folder, on_complete: onCompleteCallback = None,
+                 on_progress: onProgressCallback = None, progress_interval: float = 0.5) -> DownloadHandle:
+        """Same as `UltraDownloader.download`: returns a handle whose futures settle as files finish."""
+        files = self.metadata_fetcher.fetch_files(data)
+
+        plan_queue, finalize_queue, states, records, size_est = self.planner.prepare(files, target_dir, on_complete)
+
+        with self._lock:
+            duplicates = set(states.keys()) & set(self._states.keys())
+            if duplicates:
+                raise RuntimeError(f"Attempted to enqueue already-existing file_ids: {sorted(duplicates)}")
+            self._states.update(states)
+            self._records.update(records)
+            for fid, st in states.items():
+                self._track(fid, st)
+
+        finalize_ids: List[str] = []
+        while True:
+            try:
+                finalize_ids.append(finalize_queue.get_nowait())
+            except Empty:
+                break
+
+        tasks: List[FragmentTask] = []
+        while True:
+            try:
+                tasks.append(plan_queue.get_nowait())
+            except Empty:
+                break
+
+        handle = DownloadHandle({fid: FileHandle(fid, records[fid].file_info.name, st, self.cancel_file, self._progress) for fid, st in states.items()})
+        if on_progress is not None:
+            handle.on_progress(on_progress, progress_interval)
+
+        self._call(self._enqueue, list(states.keys()), tasks, finalize_ids).result()
+        return handle
+
+    async def _enqueue(self, file_ids: List[str], tasks: List[FragmentTask], finalize_ids: List[str]) -> None:
+        for fid in file_ids:
+            gate = asyncio.Event()
+            gate.set()
+            self._file_gates[fid] = gate
+
+        for task in tasks:
+            self._queue.put_nowait(task)
+
+        for fid in finalize_ids:
+            self._schedule_finalize(fid)
+
+    def get_file_state(self, file_id: str) -> FileState:
+        return self._states[file_id]
+
+    def get_all_states(self) -> Dict[str, FileState]:
+        return dict(self._states)
+
+    def get_failed_states(self) -> Dict[str, FileState]:
+        return {fid: st for fid, st in self._states.items() if st.error}
+
+    def get_download_rate(self) -> float:
+        return self.throttle.download_rate()
+
+    def get_metrics(self) -> Dict[str, Dict[str, dict]]:
+        """Same as `UltraDownloader.get_metrics`, without the queue wait stages (there are no queues between stages here)."""
+        return self.metrics.snapshot(prefix="download_") if isinstance(self.metrics, MetricsRegistry) else {}
+
+    def get_cache_stats(self) -> Dict[str, int]:
+        return self.fragment_cache.stats() if self.fragment_cache else {}
+
+    def get_finalize_stats(self) -> FinalizeStats:
+        """Finalize queue depth, worker count, disk throughput and time spent per stage."""
+        return self.finalizer.stats()
+
+    def get_file_rate(self, file_id: str) -> float:
+        return self.throttle.file_rate(file_id)
+
+    # ------------------------------------------------------------------
+    # Pause / resume / cancel
+    # ------------------------------------------------------------------
+
+    def pause_all(self) -> None:
+        self._loop.call_soon_threadsafe(self._global_gate.clear)
+        for st in self._states.values():
+            with st.lock:
+                if st.status == FileStatus.DOWNLOADING:
+                    st.status = FileStatus.PAUSED
+
+    def resume_all(self) -> None:
+        self._loop.call_soon_threadsafe(self._resume_all)
+        for st in self._states.values():
+            with st.lock:
+                if st.status == FileStatus.PAUSED and not st.cancelled:
+                    st.status = FileStatus.DOWNLOADING
+
+    def pause_file(self, file_id: str) -> None:
+        st = self._states[file_id]
+        with st.lock:
+            st.pause_event.clear()
+            if st.status == FileStatus.DOWNLOADING:
+                st.status = FileStatus.PAUSED
+        self._loop.call_soon_threadsafe(self._file_gates[file_id].clear)
+
+    def resume_file(self, file_id: str) -> None:
+        st = self._states[file_id]
+        with st.lock:
+            st.pause_event.set()
+            if st.status == FileStatus.PAUSED and not st.cancelled and st.error is None and st.fragments_downloaded < st.fragments_total:
+                st.status = FileStatus.DOWNLOADING
+        self._loop.call_soon_threadsafe(self._release, file_id)
+
+    def cancel_file(self, file_id: str) -> None:
+        st = self._states[file_id]
+        st.finish(FileStatus.CANCELLED)
+        # drops its parked tasks
+        self._loop.call_soon_threadsafe(self._release, file_id)
+        # otherwise the last fragment still being written does this
+        if st.discard_due():
+            self._io.submit(FileFinalizer.discard, self._records[file_id])
+
+    def _track(self, file_id: str, state: FileState) -> None:
+        # per-file bookkeeping lives as long as the file isn't finished, whichever way it ends
+        self.throttle.track_file(file_id)
+        state.future.add_done_callback(lambda _: self.throttle.forget_file(file_id))
+
+    def _release(self, file_id: str) -> None:
+        self._file_gates[file_id].set()
+        state = self._states.get(file_id)
+        if state is not None and state.cancelled:
+            self._parked.pop(file_id, None)
+        elif self._global_gate.is_set():
+            # otherwise `_resume_all` puts them back
+            for task in self._parked.pop(file_id, []):
+                self._queue.put_nowait(task)
+
+    def _resume_all(self) -> None:
+        self._global_gate.set()
+        for file_id in list(self._parked):
+            gate = self._file_gates.get(file_id)
+            if gate is None or gate.is_set():
+                for task in self._parked.pop(file_id):
+                    self._queue.put_nowait(task)
+
+    # ------------------------------------------------------------------
+    # Fragment workers (event loop)
+    # ------------------------------------------------------------------
+
+    def _park(self, task: FragmentTask) -> None:
+        # tasks of paused files wait here instead of occupying a stream slot, `_release` / `_resume_all` put them back
+        self._parked.setdefault(task.file_id, []).append(task)
+
+    async def _worker(self) -> None:
+        while True:
+            task = await self._queue.get()
+            try:
+                await self._process(task)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"[AsyncUltraDownloader] Unexpected worker failure for file {task.file_id}")
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, task: FragmentTask) -> None:
+        state = self._states.get(task.file_id)
+        if state is None or state.cancelled:
+            return
+
+        if not self._global_gate.is_set() or not self._file_gates[task.file_id].is_set():
+            self._park(task)
+            return
+
+        try:
+            with state.lock:
+                if state.status not in (FileStatus.COMPLETED, FileStatus.FAILED, FileStatus.CANCELLED):
+                    state.status = FileStatus.DOWNLOADING
+
+            if not state.writer_started():
+                return
+            try:
+                bytes_downloaded = await self._download_fragment(task, state)
+            except FragmentParked:
+                self._park(task)
+                return
+            finally:
+                if state.writer_stopped():
+                    self._io.submit(FileFinalizer.discard, self._records[task.file_id])
+            self.throttle.signal_bytes(bytes_downloaded, file_id=task.file_id)
+
+            with state.lock:
+                state.bytes_downloaded += bytes_downloaded
+                if state.cancelled:
+                    return
+                state.fragments_downloaded += 1
+                done = state.fragments_downloaded == state.fragments_total
+
+            if done:
+                self._schedule_finalize(task.file_id)
+
+        except (RateLimitError, ServiceUnavailableError) as e:
+            self.throttle.signal_error()
+            self.metrics.increment("download_errors_total", error=e.__class__.__name__)
+            if task.retries >= self.max_retries:
+                state.finish(FileStatus.FAILED, e)
+                return
+            # the transport's rate limit registry holds the retry until the bucket resets
+            logger.warning(f"[AsyncUltraDownloader] Throttled ({e.__class__.__name__}) → requeued (retry {task.retries})")
+            task.retries += 1
+            self._queue.put_nowait(task)
+
+        except (NetworkError, ServerTimeoutError) as e:
+            self.metrics.increment("download_errors_total", error=e.__class__.__name__)
+            if self.retry_policy.gives_up(task.network_retries):
+                state.finish(FileStatus.FAILED, e)
+                return
+            delay = self.retry_policy.delay(task.network_retries)
+            task.network_retries += 1
+            with state.lock:
+                state.status = FileStatus.RETRYING_NETWORK
+            logger.warning(f"[AsyncUltraDownloader] Network issue ({e.__class__.__name__}) → retrying in {delay:.1f}s (attempt {task.network_retries})")
+            self._loop.call_later(delay, self._queue.put_nowait, task)
+
+        except Exception as e:
+            self.metrics.increment("download_errors_total", error=e.__class__.__name__)
+            state.finish(FileStatus.FAILED, e)
+            logger.exception(f"[AsyncUltraDownloader] Unexpected failure for file {task.file_id}")
+
+    async def _download_fragment(self, task: FragmentTask, state: FileState) -> int:
+        attachment_id = task.fragment.attachment_id
+
+        if self.fragment_cache is not None:
+            data = await self._loop.run_in_executor(self._io, self.fragment_cache.get, attachment_id)
+            if data is not None and len(data) == task.fragment.size:
+                return await self._loop.run_in_executor(self._io, self._from_cache, task, state, data)
+
+        try:
+            url = task.url or await asyncio.wrap_future(self.resolver.resolve_future(attachment_id, task.file_password))
+            try:
+                return await self._stream(url, task, state)
+            except DiscordAttachmentNotFoundError:
+                # a cached url can get revoked before its advertised expiry, ask for a fresh one once
+                self.resolver.invalidate(attachment_id)
+                url = await asyncio.wrap_future(self.resolver.resolve_future(attachment_id, task.file_password))
+                return await self._stream(url, task, state)
+
+        except httpx.TimeoutException as e:
+            raise ServerTimeoutError("Download timed out") from e
+        except httpx.RequestError as e:
+            raise NetworkError("Network error during download") from e
+
+    async def _stream(self, url: str, task: FragmentTask, state: FileState) -> int:
+        fragment = task.fragment
+        record = self._records[task.file_id]
+        loop = self._loop
+
+        # continues where an interrupted attempt left off
+        writer = await loop.run_in_executor(self._io, FragmentWriter, record, fragment, task.resume_from, task.resume_crc, self.write_block_size)
+        if writer.start != task.resume_from:
+            # the `.part` file to continue is gone
+            await loop.run_in_executor(self._io, self._restart, task, record, state)
+        try:
+            headers = {"Range": f"bytes={writer.start}-"} if writer.start else None
+
+            started = loop.time()
+            async with self._client.stream("GET", url, headers=headers, timeout=10.0, follow_redirects=True) as r:
+                ttfb = loop.time() - started
+                self.throttle.signal_ttfb(ttfb)
+                self.metrics.observe("download_stage_seconds", ttfb, stage="ttfb")
+
+                if r.status_code in (404, 429, 503):
+                    # the errors read the (short) body
+                    await r.aread()
+
+                if r.status_code == 404:
+                    raise DiscordAttachmentNotFoundError(r, f"Attachment {fragment.attachment_id} not found")
+
+                if r.status_code == 429:
+                    raise RateLimitError(r)
+
+                if r.status_code == 503:
+                    raise ServiceUnavailableError(r)
+
+                r.raise_for_status()
+
+                if writer.start and r.status_code != 206:
+                    # the range was ignored, the whole fragment is coming
+                    await loop.run_in_executor(self._io, writer.close)
+                    await loop.run_in_executor(self._io, self._restart, task, record, state)
+                    writer = await loop.run_in_executor(self._io, FragmentWriter, record, fragment, 0, 0, self.write_block_size)
+
+                # only whole fragments go into the cache, written along with the blocks
+                entry = None
+                if self.fragment_cache is not None and not writer.start:
+                    entry = await loop.run_in_executor(self._io, self.fragment_cache.store, fragment.attachment_id)
+
+                # chunks are gathered in a block from the pool, handed to the io executor once full
+                block = self._blocks.pop() if self._blocks else memoryview(bytearray(self.write_block_size))
+                filled = 0
+                body_started = loop.time()
+                try:
+                    async for chunk in r.aiter_bytes():
+                        if state.cancelled:
+                            if entry is not None:
+                                entry.abort()
+                            return writer.written
+                        if not self._global_gate.is_set() or not self._file_gates[task.file_id].is_set():
+                            # closes the response instead of holding its connection through the pause,
+                            # the fragment continues from here on resume
+                            raise FragmentParked()
+
+                        delay = self.bandwidth_limiter.reserve(len(chunk), task.file_id)
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+
+                        if filled + len(chunk) > len(block):
+                            pending, filled = block[:filled], 0
+                            await loop.run_in_executor(self._io, self._write, writer, entry, pending)
+                        if len(chunk) >= len(block):
+                            await loop.run_in_executor(self._io, self._write, writer, entry, chunk)
+                        else:
+                            block[filled:filled + len(chunk)] = chunk
+                            filled += len(chunk)
+
+                    if filled:
+                        pending, filled = block[:filled], 0
+                        await loop.run_in_executor(self._io, self._write, writer, entry, pending)
+
+                    await loop.run_in_executor(self._io, writer.commit, state)
+                except BaseException as e:
+                    if entry is not None:
+                        entry.abort()
+                    if isinstance(e, asyncio.CancelledError):
+                        # an io thread may still be writing from it, leave it to the garbage collector
+                        block = None
+                    if not isinstance(e, (httpx.HTTPError, NetworkError, FragmentParked)):
+                        raise
+                    if filled:
+                        await loop.run_in_executor(self._io, writer.write, block[:filled])
+                    await loop.run_in_executor(self._io, self._checkpoint, task, record, state, writer)
+                    raise
+                finally:
+                    if block is not None:
+                        self._blocks.append(block)
+        finally:
+            await loop.run_in_executor(self._io, writer.close)
+
+        # the whole body, decrypting and writing included
+        self.metrics.observe("download_stage_seconds", loop.time() - body_started, stage="transfer")
+        writer.report(self.metrics)
+
+        if entry is not None:
+            await loop.run_in_executor(self._io, entry.commit)
+        return writer.written
+
+    @staticmethod
+    def _write(writer: FragmentWriter, entry: Optional[PendingEntry], data) -> None:
+        writer.write(data)
+        if entry is not None:
+            entry.write(data)
+
+    def _from_cache(self, task: FragmentTask, state: FileState, data: bytes) -> int:
+        writer = FragmentWriter(self._records[task.file_id], task.fragment)
+        try:
+            writer.write(data)
+            writer.commit(state)
+        finally:
+            writer.close()
+        writer.report(self.metrics, source="cache")
+
+        # progress, but not network throughput
+        with state.lock:
+            state.bytes_downloaded += len(data) - task.resume_from
+        return 0
+
+    def _checkpoint(self, task: FragmentTask, record: FileRecord, state: FileState, writer: FragmentWriter) -> None:
+        """Keeps an interrupted fragment's bytes, so the next attempt asks only for the rest."""
+        if not writer.written or writer.have >= task.fragment.size:
+            # nothing new, or a body that ran long: start the fragment over
+            return
+        have, crc = writer.checkpoint()
+        task.resume_from, task.resume_crc = have, crc
+        record.journal.record(record.file_info.id, task.fragment.sequence, have, crc)
+
+        with state.lock:
+            state.bytes_downloaded += writer.written
+        self.throttle.signal_bytes(writer.written, file_id=task.file_id)
+        task.resume_signaled += writer.written
+
+    def _restart(self, task: FragmentTask, record: FileRecord, state: FileState) -> None:
+        """The fragment comes again from its first byte: its resumed prefix stops counting, in the progress, the meters and the journal."""
+        record.journal.forget(record.file_info.id, [task.fragment.sequence])
+        with state.lock:
+            state.bytes_downloaded -= task.resume_from
+        self.throttle.retract_bytes(task.resume_signaled, file_id=task.file_id)
+        task.resume_from = task.resume_crc = task.resume_signaled = 0
+
+    def _schedule_finalize(self, file_id: str) -> None:
+        self._finalize_queue.put(file_id)
+
+    # ------------------------------------------------------------------
+    # Optional: graceful shutdown
+    # ------------------------------------------------------------------
+
+    def shutdown(self) -> None:
+        async def _stop():
+            for w in self._workers:
+                w.cancel()
+            await asyncio.gather(*self._workers, return_exceptions=True)
+            await self._client.aclose()
+
+        self._call(_stop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._io.shutdown(wait=True)
+        self.finalizer.shutdown()
+        self.resolver.shutdown()
@@ -1,53 +1,99 @@
+import math
 import threading
 import time
 import logging
+from collections import deque
+from typing import Callable, List, Optional
 
-from ..downloader.state import ThrottleState
+from ..downloader.state import ThrottleState, ScalingDecision
 
 logger = logging.getLogger("iDrive")
 
-# todo needs refactoring
+SLOW_START = "slow_start"
+AVOIDANCE = "avoidance"
+
 
 class AutoScaler:
-    def __init__(self, max_workers: int, throttle_state: ThrottleState):
+    """
+    AIMD concurrency controller, TCP style.
+
+    - slow start: the worker count doubles every settled step until throughput stops growing with it, then drops
+      to the count the throughput actually needs (at the best throughput per connection seen)
+    - congestion avoidance: probes +1 worker per settled step and rolls the probe back when it brought no gain,
+      waiting twice as long before each next probe while they keep failing (up to `max_probe_wait` steps);
+      at `max_workers` it probes -1 instead, walking down for as long as throughput holds without the worker,
+      and shrinks to the needed count right away once connections fall well short of their best
+    - on hard throttling (429/503) the target is multiplied by `decrease_factor`, on TTFB rising past `ttfb_tolerance`
+      times its recent average (an EWMA, re-learnt after every decrease) by `latency_factor`
+
+    A step is "settled" once the workers from the previous change had a full interval to produce bytes,
+    as throughput is only accounted when fragments complete.
+
+    `initial_workers` warm-starts the controller (in congestion avoidance) at a count learned earlier;
+    `on_learned(workers, throughput, throttled)` is called every `learn_interval` seconds when a better count was seen.
+    """
+
+    def __init__(self, max_workers: int, throttle_state: ThrottleState, interval: float = 1.0, decrease_factor: float = 0.5,
+                 latency_factor: float = 0.85, ttfb_tolerance: float = 2.5, ttfb_smoothing: float = 0.2, max_probe_wait: int = 16,
+                 history_size: int = 1000, initial_workers: int = 1, on_learned: Optional[Callable[[int, float, bool], None]] = None,
+                 learn_interval: float = 30.0):
         self.min = 1
         self.max = max_workers
-        self.current = self.min
+        self.current = max(self.min, min(self.max, initial_workers))
         self.ts = throttle_state
         self.lock = threading.Lock()
         self.stop_flag = False
 
-        self._last_rate = 0.0
-        self._no_improve_steps = 0
+        self.interval = interval
+        self.decrease_factor = decrease_factor
+        self.latency_factor = latency_factor
+        self.ttfb_tolerance = ttfb_tolerance
+        self.ttfb_smoothing = ttfb_smoothing
+        self.max_probe_wait = max_probe_wait
 
-        # cooldown tracking
-        self._last_scale_up_time = 0.0
-        self._last_scale_down_time = 0.0
+        self.phase = SLOW_START if self.current == self.min else AVOIDANCE
+        self.target = float(self.current)
+        self.ssthresh = float(max_workers)
 
-        self._scale_up_cooldown = 3     # seconds
-        self._scale_down_cooldown = 6  # seconds
+        self._last_bytes = 0
+        self._last_errors = 0
+        self._last_tick = time.monotonic()
+        self._best_per_connection = 0.0
+        self._baseline_ttfb: Optional[float] = None
+        self._baseline_samples = 0
+        # congestion avoidance probing: throughput before the pending +1 (or -1), and how many steps to wait before the next one
+        self._probe_from: Optional[float] = None
+        self._probe_down_from: Optional[float] = None
+        self._probe_wait = 0
+        self._probe_skip = 0
+        # slow start: (throughput, workers) before the pending doubling
+        self._slow_start_from: Optional[tuple] = None
+        self._settled = True
+        self._last_decrease = 0.0
+
+        self._history: "deque[ScalingDecision]" = deque(maxlen=history_size)
+
+        # best settled operating point of this session, for warm-starting the next one
+        self.on_learned = on_learned
+        self.learn_interval = learn_interval
+        self._best_workers = 0
+        self._best_throughput = 0.0
+        self._throttled = False
+        self._learned_dirty = False
+        self._last_learned_report = time.monotonic()
 
     # -------------------------------
     # Worker count management
     # -------------------------------
 
-    def _inc_workers(self, spawn_fn):
-        if self.current < self.max:
+    def _apply(self, spawn_fn, kill_fn):
+        desired = max(self.min, min(self.max, int(self.target)))
+        while self.current < desired:
             spawn_fn()
             self.current += 1
-            self._last_scale_up_time = time.time()
-            logger.info(f"[AutoScaler] Scaled UP → workers={self.current}")
-        else:
-            logger.info(f"[AutoScaler] Wanted scale UP but already at max={self.max}")
-
-    def _dec_workers(self, kill_fn):
-        if self.current > self.min:
+        while self.current > desired:
             kill_fn()
             self.current -= 1
-            self._last_scale_down_time = time.time()
-            logger.info(f"[AutoScaler] Scaled DOWN → workers={self.current}")
-        else:
-            logger.info( f"[AutoScaler] Wanted scale DOWN but already at min={self.min}")
 
     # -------------------------------
     # Autoscaling loop
@@ -62,56 +108,204 @@ class AutoScaler:
         logger.info("[AutoScaler] Started autoscaling loop")
 
         while not self.stop_flag:
-            time.sleep(1.5)
+            time.sleep(self.interval)
 
-            now = time.time()
-            hard_errors = self.ts.error_rate()
-            rate = self.ts.download_rate()
+            with self.lock:
+                if self.stop_flag:
+                    break
+                before = self.current
+                decision = self.step()
+                self._apply(spawn_fn, kill_fn)
+                self._settled = self.current == before
 
-            # cooldown checks
-            can_scale_up = (now - self._last_scale_up_time) >= self._scale_up_cooldown
-            can_scale_down = (now - self._last_scale_down_time) >= self._scale_down_cooldown
+            if decision.action != "hold":
+                logger.info(f"[AutoScaler] {decision.action} ({decision.reason}) → workers={self.current}, phase={self.phase}")
 
-            with self.lock:
-                # 1. hard throttling → immediate scale down (if not in cooldown)
-                if hard_errors > 0:
-                    logger.warning(f"[AutoScaler] Hard throttling ({hard_errors}) → request scale DOWN")
-                    if can_scale_down:
-                        self._dec_workers(kill_fn)
-                    else:
-                        logger.debug("[AutoScaler] DOWN blocked by cooldown")
-                    self._last_rate = rate
-                    continue
-
-                # 2. throughput trend → check if plateau
-                if rate <= self._last_rate * 1.02:  # <2% improvement
-                    self._no_improve_steps += 1
-                else:
-                    self._no_improve_steps = 0
-
-                if self._no_improve_steps >= 4 and self.current > self.min:
-                    logger.info(f"[AutoScaler] Throughput plateau: rate={rate:.1f}, prev={self._last_rate:.1f}")
-                    if can_scale_down:
-                        self._dec_workers(kill_fn)
-                    else:
-                        logger.debug("[AutoScaler] DOWN blocked by cooldown")
-                    self._last_rate = rate
-                    continue
-
-                # 3. scaling UP logic
-                if hard_errors == 0 and can_scale_up:
-                    if rate > self._last_rate * 1.10:  # >10% improvement
-                        logger.info("[AutoScaler] Improving throughput → scale UP")
-                        self._inc_workers(spawn_fn)
-                else:
-                    if not can_scale_up:
-                        logger.debug("[AutoScaler] UP blocked by cooldown")
-
-                self._last_rate = rate
+            if time.monotonic() - self._last_learned_report >= self.learn_interval:
+                self.report_learned()
 
         logger.info("[AutoScaler] Exiting autoscaling loop")
 
+    def step(self) -> ScalingDecision:
+        """One control decision from what happened since the previous one. Only adjusts `target`."""
+        now = time.monotonic()
+        elapsed = max(now - self._last_tick, 0.001)
+        total_bytes = self.ts.bytes_total()
+        total_errors = self.ts.errors_total()
+
+        throughput = (total_bytes - self._last_bytes) / elapsed
+        errors = total_errors - self._last_errors
+        per_connection = throughput / max(self.current, 1)
+        ttfb = self.ts.ttfb()
+
+        self._last_tick, self._last_bytes, self._last_errors = now, total_bytes, total_errors
+
+        action, reason = self._decide(throughput, per_connection, errors, ttfb)
+
+        # compared against before being updated, so a sudden rise stands out; a decrease starts it over
+        if ttfb is not None and action != "decrease":
+            if self._baseline_ttfb is None:
+                self._baseline_ttfb = ttfb
+            else:
+                self._baseline_ttfb += (ttfb - self._baseline_ttfb) * self.ttfb_smoothing
+            self._baseline_samples += 1
+
+        if self._settled and throughput > 0:
+            self._best_per_connection = max(self._best_per_connection, per_connection)
+            if throughput > self._best_throughput:
+                self._best_throughput = throughput
+                self._best_workers = self.current
+                self._learned_dirty = True
+
+        decision = ScalingDecision(
+            timestamp=time.time(),
+            phase=self.phase,
+            action=action,
+            reason=reason,
+            workers=self.current,
+            target=self.target,
+            throughput=throughput,
+            per_connection=per_connection,
+            ttfb=ttfb,
+            errors=errors,
+        )
+        self._history.append(decision)
+        return decision
+
+    def _decide(self, throughput: float, per_connection: float, errors: int, ttfb: Optional[float]):
+        # requests already in flight keep failing for a bit after a decrease, react once per two intervals
+        if time.monotonic() - self._last_decrease < self.interval * 2:
+            return "hold", "after decrease"
+
+        # multiplicative decrease
+        if errors > 0:
+            self._throttled = True
+            self._learned_dirty = True
+            self._decrease(self.decrease_factor)
+            return "decrease", f"{errors} throttling errors"
+
+        # a single early sample is no baseline
+        baseline_ready = self._baseline_samples >= 3
+        if ttfb is not None and baseline_ready and ttfb > self._baseline_ttfb * self.ttfb_tolerance and self.current > self.min:
+            reason = f"ttfb {ttfb * 1000:.0f}ms vs baseline {self._baseline_ttfb * 1000:.0f}ms"
+            self._decrease(self.latency_factor)
+            return "decrease", reason
+
+        if throughput <= 0:
+            return "hold", "idle"
+
+        if not self._settled:
+            return "hold", "settling"
+
+        if self._probe_from is not None:
+            probe_from, self._probe_from = self._probe_from, None
+            if throughput < probe_from * 1.02:
+                # the extra worker didn't buy throughput, give it back and probe less often
+                self.target = max(float(self.min), self.target - 1)
+                self._probe_wait = min(self._probe_wait * 2 or 1, self.max_probe_wait)
+                self._probe_skip = self._probe_wait
+                return "decrease", "probe brought no gain, rolled back"
+            self._probe_wait = 0
+
+        if self._probe_down_from is not None:
+            probe_from, self._probe_down_from = self._probe_down_from, None
+            if throughput < probe_from * 0.98:
+                # the worker was pulling its weight, bring it back and probe less often
+                self.target = min(self.target + 1, float(self.max))
+                self._probe_wait = min(self._probe_wait * 2 or 1, self.max_probe_wait)
+                self._probe_skip = self._probe_wait
+                return "increase", "worker was needed, restored"
+            self._probe_wait = 0
+            if self.current > self.min:
+                self._probe_down_from = throughput
+                self.target -= 1
+                return "decrease", "throughput held without the worker"
+
+        if self.phase == SLOW_START:
+            slow_start_from, self._slow_start_from = self._slow_start_from, None
+            if slow_start_from is not None:
+                from_throughput, from_workers = slow_start_from
+                # the added workers should have brought at least half their share
+                expected = 1 + (self.current / from_workers - 1) / 2
+                if throughput < from_throughput * expected:
+                    self.phase = AVOIDANCE
+                    return self._shrink_to_needed(throughput, "throughput stopped growing, leaving slow start")
+
+            if self.current < self.max:
+                self._slow_start_from = (throughput, self.current)
+                self.target = min(self.target * 2, self.ssthresh, float(self.max))
+                if self.target >= self.ssthresh and self.ssthresh < self.max:
+                    self.phase = AVOIDANCE
+                return "increase", "slow start"
+            self.phase = AVOIDANCE
+
+        if self.current >= self.max:
+            # nothing left to probe upwards, but capped throughput shouldn't hold every worker forever
+            if self._best_per_connection and per_connection < self._best_per_connection * 0.8:
+                return self._shrink_to_needed(throughput, "throughput plateau at max")
+            if self._probe_skip:
+                self._probe_skip -= 1
+                return "hold", "at max"
+            # the same probe downwards: the worker stays away if throughput holds without it
+            self._probe_down_from = throughput
+            self.target = max(float(self.min), self.target - 1)
+            return "decrease", "probe below max"
+
+        if self._probe_skip:
+            self._probe_skip -= 1
+            return "hold", "throughput plateau"
+
+        # additive increase, kept only if it buys throughput (checked on the next settled step)
+        self._probe_from = throughput
+        self.target = min(self.target + 1, float(self.max))
+        return "increase", "additive probe"
+
+    def _shrink_to_needed(self, throughput: float, reason: str):
+        # as many workers as the throughput needs at the best per-connection rate seen, avoidance probes from there
+        needed = math.ceil(throughput / self._best_per_connection) if self._best_per_connection else self.current
+        self.target = float(max(self.min, min(self.current, needed)))
+        self.ssthresh = self.target
+        if self.target < self.current:
+            return "decrease", reason
+        return "hold", reason
+
+    def _decrease(self, factor: float) -> None:
+        self.target = max(float(self.min), self.target * factor)
+        self.ssthresh = max(float(self.min), self.target)
+        self.phase = AVOIDANCE
+        self._last_decrease = time.monotonic()
+        # what a connection achieves and how fast the server answers change with the load, re-learn both
+        self._best_per_connection = 0.0
+        self._baseline_ttfb = None
+        self._baseline_samples = 0
+        self._probe_from = None
+        self._probe_down_from = None
+        self._slow_start_from = None
+
+    # -------------------------------
+    # Introspection
+    # -------------------------------
+
+    def get_history(self) -> List[ScalingDecision]:
+        return list(self._history)
+
+    def report_learned(self) -> None:
+        self._last_learned_report = time.monotonic()
+        if not self.on_learned or not self._learned_dirty or not self._best_workers:
+            return
+        self._learned_dirty = False
+
+        workers = self._best_workers
+        if self._throttled:
+            # the best throughput may have been measured just before getting throttled
+            workers = min(workers, max(self.min, int(self.ssthresh)))
+        try:
+            self.on_learned(workers, self._best_throughput, self._throttled)
+        except Exception:
+            logger.exception("[AutoScaler] Failed to report learned concurrency")
+
     def stop(self):
         logger.info("[AutoScaler] Stop requested")
-        self.stop_flag = True
-
+        # once this returns the worker count is left alone
+        with self.lock:
+            self.stop_flag = True
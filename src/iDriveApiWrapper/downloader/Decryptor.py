@@ -10,3 +10,6 @@ class Decryptor(StreamCipherBase):
         if self.method == EncryptionMethod.Not_Encrypted:
             return raw_data
         return self._ctx.update(raw_data)
+
+    def decrypt_into(self, raw_data, out) -> int:
+        return self._update_into(raw_data, out)
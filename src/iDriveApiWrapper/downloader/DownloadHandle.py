@@ -0,0 +1,115 @@
+import threading
+from concurrent.futures import Future, InvalidStateError, as_completed
+from typing import Callable, Dict, Iterator, Optional
+
+from .ProgressDispatcher import ProgressDispatcher
+from .state import FileState, onProgressCallback
+
+
+class FileHandle:
+    """
+    One file of a `download()` call. `future` settles when the file does: its FileState once completed, the
+    error once failed, cancelled once cancelled. Cancelling the future cancels the download.
+    """
+
+    def __init__(self, file_id: str, name: str, state: FileState, cancel: Callable[[str], None], progress: ProgressDispatcher):
+        self.file_id = file_id
+        self.name = name
+        self.state = state
+        self._cancel = cancel
+        self._progress = progress
+        state.future.add_done_callback(self._on_done)
+
+    def __repr__(self):
+        return f"FileHandle({self.name!r}, status={self.state.status.value})"
+
+    @property
+    def future(self) -> "Future[FileState]":
+        return self.state.future
+
+    def result(self, timeout: Optional[float] = None) -> FileState:
+        return self.state.future.result(timeout)
+
+    def done(self) -> bool:
+        return self.state.future.done()
+
+    def cancel(self) -> None:
+        self._cancel(self.file_id)
+
+    def on_progress(self, callback: onProgressCallback, interval: float = 0.5) -> None:
+        """Calls `callback(file_id, bytes_downloaded, size_total)` at most every `interval` seconds while bytes come in, and once at the end."""
+        self._progress.watch(self.file_id, self.state, callback, interval)
+
+    def _on_done(self, future: Future) -> None:
+        if future.cancelled() and not self.state.cancelled:
+            # cancelled through the future, not the downloader
+            self._cancel(self.file_id)
+
+
+class DownloadHandle:
+    """
+    All files of one `download()` call. `future` settles once every file has, with file_id → FileState of
+    all of them (failed and cancelled ones included, check their `status`); cancelling it cancels the rest of the
+    batch. Waiting costs one done callback per file, no thread or polling.
+    """
+
+    def __init__(self, files: Dict[str, FileHandle]):
+        self.files = files
+        self.future: "Future[Dict[str, FileState]]" = Future()
+
+        self._lock = threading.Lock()
+        self._pending = len(files)
+        if not files:
+            self.future.set_result({})
+        for handle in files.values():
+            handle.future.add_done_callback(self._file_done)
+        self.future.add_done_callback(self._on_done)
+
+    def __repr__(self):
+        return f"DownloadHandle(files={len(self.files)}, pending={self._pending})"
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def __iter__(self) -> Iterator[FileHandle]:
+        return iter(self.files.values())
+
+    def __getitem__(self, file_id: str) -> FileHandle:
+        return self.files[file_id]
+
+    def result(self, timeout: Optional[float] = None) -> Dict[str, FileState]:
+        return self.future.result(timeout)
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def as_completed(self, timeout: Optional[float] = None) -> Iterator[FileHandle]:
+        """Yields the files as they finish, whichever way."""
+        by_future = {handle.future: handle for handle in self.files.values()}
+        for future in as_completed(by_future, timeout):
+            yield by_future[future]
+
+    def cancel(self) -> None:
+        for handle in self.files.values():
+            if not handle.done():
+                handle.cancel()
+
+    def on_progress(self, callback: onProgressCallback, interval: float = 0.5) -> None:
+        """`FileHandle.on_progress` for every file of the batch."""
+        for handle in self.files.values():
+            handle.on_progress(callback, interval)
+
+    def _file_done(self, _: Future) -> None:
+        with self._lock:
+            self._pending -= 1
+            if self._pending:
+                return
+        try:
+            self.future.set_result({file_id: handle.state for file_id, handle in self.files.items()})
+        except InvalidStateError:
+            # cancelled through the future
+            pass
+
+    def _on_done(self, future: Future) -> None:
+        if future.cancelled():
+            self.cancel()
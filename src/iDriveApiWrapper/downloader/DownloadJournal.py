@@ -0,0 +1,85 @@
+import os
+import threading
+import zlib
+from typing import Dict, Iterable, Tuple
+
+RESET = "reset"
+
+
+class DownloadJournal:
+    """
+    Append-only record of the fragments of one download (a batch of files) that are safely on disk,
+    so planning a resume is a single read instead of a stat per fragment.
+
+    Every line is `<file_id> <sequence> <bytes> <crc> <checksum>`, the checksum being the CRC32 of the rest of the line.
+    `<bytes>` short of the fragment's size marks an interrupted fragment that can be continued from there; the
+    latest line of a fragment wins. Bytes are only journaled after they were fsynced, hence after a crash the
+    journal never claims more than what is on disk; torn or garbled lines fail their checksum and are ignored. `<file_id> reset` drops
+    everything recorded for a file before it.
+    """
+
+    def __init__(self, path: str, file_ids: Iterable[str]):
+        self.path = path
+        self._pending = set(file_ids)
+        self._lock = threading.Lock()
+        self._file = None
+
+    def load(self) -> Dict[str, Dict[int, Tuple[int, int]]]:
+        """file_id → {sequence → (bytes on disk, CRC32 of their plaintext)}"""
+        done: Dict[str, Dict[int, Tuple[int, int]]] = {}
+        if not os.path.exists(self.path):
+            return done
+
+        with open(self.path, "r") as f:
+            for line in f:
+                body, _, checksum = line.rstrip("\n").rpartition(" ")
+                if not body or checksum != self._checksum(body):
+                    continue
+                fields = body.split(" ")
+                if len(fields) == 2 and fields[1] == RESET:
+                    done.pop(fields[0], None)
+                elif len(fields) == 4:
+                    file_id, sequence, have, crc = fields
+                    done.setdefault(file_id, {})[int(sequence)] = (int(have), int(crc))
+        return done
+
+    def record(self, file_id: str, sequence: int, have: int, crc: int) -> None:
+        self._append(f"{file_id} {sequence} {have} {crc}")
+
+    def forget(self, file_id: str, sequences: Iterable[int]) -> None:
+        """Marks fragments as not on disk (e.g. found corrupted), so a resume downloads them again."""
+        for sequence in sequences:
+            self.record(file_id, sequence, 0, 0)
+
+    def reset_file(self, file_id: str) -> None:
+        self._append(f"{file_id} {RESET}")
+
+    def finish(self, file_id: str) -> None:
+        """The file got finalized; the journal goes away with the last one."""
+        with self._lock:
+            self._pending.discard(file_id)
+            done = not self._pending
+        if done:
+            self.remove()
+
+    def remove(self) -> None:
+        with self._lock:
+            self._close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def _append(self, body: str) -> None:
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a")
+            self._file.write(f"{body} {self._checksum(body)}\n")
+            self._file.flush()
+
+    def _close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def _checksum(body: str) -> str:
+        return f"{zlib.crc32(body.encode()):08x}"
@@ -1,19 +1,32 @@
 import logging
-import time
 import threading
-from typing import Dict
+import time
+from typing import Dict, Optional
 from queue import Queue
 
+from .FileFinalizer import FileFinalizer
 from .FragmentDownloader import FragmentDownloader
+from .FragmentScheduler import FragmentScheduler
+from .ParkingLot import ParkingLot, FragmentParked
+from .UrlResolver import UrlResolver
 from .state import ThrottleState, FileRecord, FileState, FragmentTask, FileStatus
 from ..exceptions import RateLimitError, ServiceUnavailableError, NetworkError, ServerTimeoutError
+from ..utils.BandwidthLimiter import BandwidthLimiter
+from ..utils.FragmentCache import FragmentCache
+from ..utils.Metrics import MetricsSink
+from ..utils.RetryScheduler import RetryScheduler, RetryPolicy
+from ..utils.TransportPool import TransportPool
 
 logger = logging.getLogger("iDrive")
 
 
 class DownloadWorker:
-    def __init__(self, fragment_queue: Queue[FragmentTask], finalize_queue: Queue[str], file_states: Dict[str, FileState],
-                 file_records: Dict[str, FileRecord], max_retries: int, throttle: ThrottleState, global_pause: threading.Event) -> None:
+    def __init__(self, ready_queue: Queue[FragmentTask], fragment_queue: FragmentScheduler, finalize_queue: Queue[str], file_states: Dict[str, FileState],
+                 file_records: Dict[str, FileRecord], max_retries: int, throttle: ThrottleState, global_pause: threading.Event, parking: ParkingLot, resolver: UrlResolver, transport: TransportPool,
+                 retire: threading.Semaphore, retries: RetryScheduler, retry_policy: RetryPolicy, cache: Optional[FragmentCache] = None,
+                 limiter: Optional[BandwidthLimiter] = None, metrics: Optional[MetricsSink] = None) -> None:
+        self.ready_queue = ready_queue
+        # retried / postponed tasks go back through the resolve stage
         self.fragment_queue = fragment_queue
         self.finalize_queue = finalize_queue
         self.file_states = file_states
@@ -21,25 +34,37 @@ class DownloadWorker:
         self.max_retries = max_retries
         self.throttle = throttle
         self.global_pause = global_pause
-        self.http = FragmentDownloader()
+        self.parking = parking
+        # released by the autoscaler, one worker exits per release
+        self.retire = retire
+        # failed fragments come back through the scheduler, the worker moves on
+        self.retries = retries
+        self.retry_policy = retry_policy
+        self.metrics = metrics or MetricsSink()
+        self.http = FragmentDownloader(resolver, transport, throttle, cache, limiter, self.metrics)
+        self.name = ""
 
     def run(self) -> None:
+        self.name = threading.current_thread().name
         while True:
-            task = self.fragment_queue.get()
+            task = self.ready_queue.get()
 
-            if task is None:
-                self.fragment_queue.task_done()
+            if task is None or self.retire.acquire(blocking=False):
+                if task is not None:
+                    self.fragment_queue.put(task)
+                self.throttle.forget_worker(self.name)
+                self.ready_queue.task_done()
                 break
 
+            self.metrics.observe("download_stage_seconds", time.monotonic() - task.queued_at, stage="ready_wait")
+
             state = self.file_states.get(task.file_id)
             if state is None or state.cancelled:
-                self.fragment_queue.task_done()
+                self.ready_queue.task_done()
                 continue
 
-            if not self.global_pause.is_set() or not state.pause_event.is_set():
-                self.fragment_queue.put(task)
-                self.fragment_queue.task_done()
-                time.sleep(0.05)
+            if self.parking.park_if_paused(task, state):
+                self.ready_queue.task_done()
                 continue
 
             try:
@@ -47,7 +72,13 @@ class DownloadWorker:
                     if state.status not in (FileStatus.COMPLETED, FileStatus.FAILED, FileStatus.CANCELLED):
                         state.status = FileStatus.DOWNLOADING
 
-                bytes_downloaded = self._download_fragment(task)
+                try:
+                    bytes_downloaded = self._download_fragment(task)
+                except FragmentParked:
+                    if not self.parking.park_if_paused(task, state):
+                        # resumed in the meantime
+                        self.fragment_queue.put(task)
+                    continue
 
                 if isinstance(bytes_downloaded, int) and bytes_downloaded > 0:
                     with state.lock:
@@ -61,37 +92,46 @@ class DownloadWorker:
 
             except (RateLimitError, ServiceUnavailableError) as e:
                 self.throttle.signal_error()
+                self.metrics.increment("download_errors_total", error=e.__class__.__name__)
                 if task.retries >= self.max_retries:
-                    with state.lock:
-                        state.error = e
-                        state.status = FileStatus.FAILED
+                    state.finish(FileStatus.FAILED, e)
                 else:
-                    logger.warning(f"[DownloadWorker] Throttled ({e.__class__.__name__}) → retrying in {e.wait}s (retry {task.retries})")
-                    time.sleep(e.wait)
+                    # no sleeping here: the rate limit registry holds back every request to this bucket until it resets
+                    logger.warning(f"[DownloadWorker] Throttled ({e.__class__.__name__}) → requeued (retry {task.retries})")
                     task.retries += 1
                     self.fragment_queue.put(task)
 
             except (NetworkError, ServerTimeoutError) as e:
-                with state.lock:
-                    state.status = FileStatus.RETRYING_NETWORK
-                logger.warning(f"[DownloadWorker] Network issue ({e.__class__.__name__}) → waiting 5s")
-                time.sleep(5)
-                self.fragment_queue.put(task)
+                self.metrics.increment("download_errors_total", error=e.__class__.__name__)
+                if self.retry_policy.gives_up(task.network_retries):
+                    state.finish(FileStatus.FAILED, e)
+                else:
+                    delay = self.retry_policy.delay(task.network_retries)
+                    task.network_retries += 1
+                    with state.lock:
+                        state.status = FileStatus.RETRYING_NETWORK
+                    logger.warning(f"[DownloadWorker] Network issue ({e.__class__.__name__}) → retrying in {delay:.1f}s (attempt {task.network_retries})")
+                    self.retries.schedule(delay, self.fragment_queue.put, task)
 
             except Exception as e:
-                with state.lock:
-                    state.error = e
-                    state.status = FileStatus.FAILED
+                self.metrics.increment("download_errors_total", error=e.__class__.__name__)
+                state.finish(FileStatus.FAILED, e)
                 logger.exception(f"[DownloadWorker] Unexpected failure for file {task.file_id}")
 
             finally:
-                self.fragment_queue.task_done()
+                self.ready_queue.task_done()
 
     def _download_fragment(self, task: FragmentTask) -> int:
         file_record = self.file_records[task.file_id]
         state = self.file_states[task.file_id]
 
-        bytes_count = self.http.download(task, file_record, self.global_pause, state)
-        self.throttle.signal_bytes(bytes_count)
+        if not state.writer_started():
+            return 0
+        try:
+            bytes_count = self.http.download(task, file_record, self.global_pause, state)
+        finally:
+            if state.writer_stopped():
+                FileFinalizer.discard(file_record)
+        self.throttle.signal_bytes(bytes_count, file_id=task.file_id, worker=self.name)
 
         return bytes_count
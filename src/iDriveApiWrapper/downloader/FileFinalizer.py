@@ -1,62 +1,176 @@
+import logging
 import os
-import base64
+import shutil
+import threading
+import time
 import zlib
+from contextlib import contextmanager
+from typing import Dict, Optional, TYPE_CHECKING
 
-from .Decryptor import Decryptor
-from .state import FileRecord, FileInfo
-from ..models.Enums import EncryptionMethod
+from .state import FileRecord, FileState, FragmentInfo
+from ..exceptions import CrcIntegrityError
+from ..utils.crc import crc32_combine_all
+
+if TYPE_CHECKING:
+    from .FinalizePool import FinalizeMonitor
+
+logger = logging.getLogger("iDrive")
 
 
 class FileFinalizer:
-    def finalize(self, record: FileRecord):
+    """
+    Fragments arrive already decrypted, so finalizing only assembles and verifies the output.
+
+    Bytes are moved by the kernel (`copy_file_range`) where available, else through one large buffer per thread
+    that is reused for every file; both, like zlib on large buffers, release the GIL, so finalizer threads run in parallel.
+    """
+
+    def __init__(self, buffer_size: int = 8 * 1024 * 1024, monitor: Optional["FinalizeMonitor"] = None):
+        self.buffer_size = buffer_size
+        self.monitor = monitor
+        self._local = threading.local()
+
+    def finalize(self, record: FileRecord, state: FileState):
+        if record.direct_write:
+            self._finalize_direct(record, state)
+            return
+
         file_info = record.file_info
         file_dir = record.file_dir
-        merged_path = record.merged_path
         output_path = record.output_path
 
         fragments = file_info.fragments
 
-        if not os.path.exists(merged_path):
-            self._merge_fragments(file_dir, merged_path, len(fragments))
+        with self.stage("merge", file_info.size):
+            self._merge_fragments(file_dir, output_path, len(fragments))
+
+        self._verify_crc(record, state)
+
+        with self.stage("cleanup"):
+            self._remove_fragments(file_dir, len(fragments))
+            record.journal.finish(file_info.id)
 
-        self._decrypt(file_info, merged_path, output_path)
+    def _finalize_direct(self, record: FileRecord, state: FileState):
+        partial_path = record.partial_path
 
-        self._verify_crc(output_path, file_info.crc)
+        self._verify_crc(record, state)
 
-        self._remove_fragments(file_dir, len(fragments))
+        with self.stage("commit"):
+            os.replace(partial_path, record.output_path)
+            record.journal.finish(record.file_info.id)
 
-    def _merge_fragments(self, file_dir, merged_path, count):
-        with open(merged_path, "wb") as out:
+    @staticmethod
+    def discard(record: FileRecord) -> None:
+        """Removes what a cancelled file left on disk and resets it in the journal, a later download starts it over."""
+        file_id = record.file_info.id
+        try:
+            if record.direct_write:
+                if os.path.exists(record.partial_path):
+                    os.remove(record.partial_path)
+            else:
+                shutil.rmtree(record.file_dir, ignore_errors=True)
+
+            record.journal.reset_file(file_id)
+            record.journal.finish(file_id)
+        except OSError:
+            logger.warning(f"[FileFinalizer] Could not discard the leftovers of cancelled file {file_id}", exc_info=True)
+
+    @contextmanager
+    def stage(self, name: str, byte_count: int = 0):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            if self.monitor is not None:
+                self.monitor.record(name, time.monotonic() - started, byte_count)
+
+    def _merge_fragments(self, file_dir, output_path, count):
+        with open(output_path, "wb", buffering=0) as out:
             for i in range(1, count + 1):
                 path = os.path.join(file_dir, f"{i}.part")
-                with open(path, "rb") as p:
-                    out.write(p.read())
+                with open(path, "rb", buffering=0) as p:
+                    self._append(p, out)
 
-    def _decrypt(self, info: FileInfo, input, output):
-        if info.encryption_method == EncryptionMethod.Not_Encrypted:
-            os.rename(input, output)
-            return
+    def _append(self, src, out) -> None:
+        remaining = os.fstat(src.fileno()).st_size
+        if hasattr(os, "copy_file_range"):
+            try:
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), out.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                return
+            except OSError:
+                # e.g. across filesystems on older kernels, carry on from where the kernel stopped
+                pass
+
+        buffer = self._buffer()
+        while True:
+            n = src.readinto(buffer)
+            if not n:
+                break
+            view = buffer[:n]
+            while view:
+                view = view[out.write(view):]
+
+    def _buffer(self) -> memoryview:
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = self._local.buffer = memoryview(bytearray(self.buffer_size))
+        return buffer
+
+    def _verify_crc(self, record: FileRecord, state: FileState):
+        fragments = sorted(record.file_info.fragments, key=lambda frag: frag.sequence)
+        expected = record.file_info.crc
+
+        with state.lock:
+            crcs = dict(state.fragment_crcs)
+
+        # only fragments resumed without a recorded CRC have to be read back
+        missing = [frag for frag in fragments if frag.sequence not in crcs]
+        with self.stage("verify", sum(frag.size for frag in missing)):
+            for frag in missing:
+                crcs[frag.sequence] = self._crc_on_disk(record, frag)
 
-        key = base64.b64decode(info.key)
-        iv = base64.b64decode(info.iv)
-        dec = Decryptor(info.encryption_method, key, iv)
+        actual = crc32_combine_all((crcs[frag.sequence], frag.size) for frag in fragments)
+        if actual != expected:
+            corrupted = self._find_corrupted_fragments(record, fragments, crcs)
+            with state.lock:
+                state.fragment_crcs = crcs
+            # otherwise every resume would skip them and fail here again
+            if corrupted:
+                record.journal.forget(record.file_info.id, corrupted)
+            else:
+                # nothing changed on disk, the streamed bytes themselves were off: fetch the whole file again
+                record.journal.reset_file(record.file_info.id)
+            raise CrcIntegrityError(f"CRC mismatch. Expected: {expected}, Actual: {actual}, fragments changed on disk: {corrupted or 'none'}")
 
-        with open(input, "rb") as i, open(output, "wb") as o:
-            for chunk in iter(lambda: i.read(8192), b""):
-                o.write(dec.decrypt(chunk))
-            final = dec.finalize()
-            if final:
-                o.write(final)
+    def _find_corrupted_fragments(self, record: FileRecord, fragments, crcs: Dict[int, int]) -> list:
+        """Sequences whose data on disk differs from what was streamed. An empty result means the source data itself is off."""
+        corrupted = []
+        for frag in fragments:
+            on_disk = self._crc_on_disk(record, frag)
+            if on_disk != crcs[frag.sequence]:
+                logger.warning(f"[FileFinalizer] Fragment {frag.sequence} of {record.file_info.id}: streamed crc={crcs[frag.sequence]}, on disk crc={on_disk}")
+                corrupted.append(frag.sequence)
+        return corrupted
 
-        os.remove(input)
+    def _crc_on_disk(self, record: FileRecord, frag: FragmentInfo) -> int:
+        path = record.partial_path if record.direct_write else record.output_path
 
-    def _verify_crc(self, path, expected):
+        buffer = self._buffer()
         crc = 0
-        with open(path, "rb") as f:
-            for chunk in iter(lambda: f.read(65536), b""):
-                crc = zlib.crc32(chunk, crc)
-        if (crc & 0xFFFFFFFF) != expected:
-            raise CrcIntegrityError(f"CRC mismatch. Expected: {expected}, Actual: {actual}")
+        remaining = frag.size
+        with open(path, "rb", buffering=0) as f:
+            f.seek(frag.offset)
+            while remaining > 0:
+                n = f.readinto(buffer[:min(len(buffer), remaining)])
+                if not n:
+                    break
+                crc = zlib.crc32(buffer[:n], crc)
+                remaining -= n
+        return crc
 
     def _remove_fragments(self, file_dir, count):
         for i in range(1, count + 1):
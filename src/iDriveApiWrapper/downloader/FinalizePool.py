@@ -0,0 +1,138 @@
+import itertools
+import logging
+import threading
+from queue import Queue
+from typing import Dict, List, Optional
+
+from .FinalizeWorker import FinalizeWorker
+from .state import FileRecord, FileState, FinalizeStats, RateMeter
+from ..utils.Metrics import MetricsSink
+
+logger = logging.getLogger("iDrive")
+
+
+class FinalizeMonitor:
+    """Per-stage timings and disk throughput of the finalize stage, fed by its workers."""
+
+    def __init__(self, window: float = 10.0, metrics: Optional[MetricsSink] = None):
+        self.metrics = metrics or MetricsSink()
+        self._lock = threading.Lock()
+        self._bytes = RateMeter(window)
+        self._stage_seconds: Dict[str, float] = {}
+        self._stage_counts: Dict[str, int] = {}
+        self.files_finalized = 0
+
+    def record(self, stage: str, seconds: float, byte_count: int = 0) -> None:
+        with self._lock:
+            self._stage_seconds[stage] = self._stage_seconds.get(stage, 0.0) + seconds
+            self._stage_counts[stage] = self._stage_counts.get(stage, 0) + 1
+        self.metrics.observe("download_stage_seconds", seconds, stage=stage)
+        if byte_count > 0:
+            self._bytes.add(byte_count)
+
+    def file_done(self) -> None:
+        with self._lock:
+            self.files_finalized += 1
+
+    def disk_rate(self) -> float:
+        """Bytes/sec merged or read back, all workers together."""
+        return self._bytes.rate()
+
+    def bytes_total(self) -> int:
+        return self._bytes.lifetime_total
+
+    def stage_seconds(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._stage_seconds)
+
+    def stage_averages(self) -> Dict[str, float]:
+        with self._lock:
+            return {stage: seconds / self._stage_counts[stage] for stage, seconds in self._stage_seconds.items()}
+
+
+class FinalizePool:
+    """
+    The finalize stage: `min_workers` threads, growing up to `max_workers` while files queue up and the last
+    thread added still raised the measured disk throughput, shrinking back once the queue drains.
+    A disk that is already saturated gets no extra threads, it would only seek more.
+    """
+
+    def __init__(self, finalize_queue: Queue, file_states: Dict[str, FileState], file_records: Dict[str, FileRecord],
+                 min_workers: int = 2, max_workers: int = 8, interval: float = 2.0, growth_threshold: float = 1.1, metrics: Optional[MetricsSink] = None):
+        self.queue = finalize_queue
+        self.file_states = file_states
+        self.file_records = file_records
+        self.min_workers = min_workers
+        self.max_workers = max(min_workers, max_workers)
+        self.interval = interval
+        self.growth_threshold = growth_threshold
+        self.monitor = FinalizeMonitor(metrics=metrics)
+
+        self._threads: List[threading.Thread] = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._rate_at_growth: Optional[float] = None
+        self._sizer: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        for _ in range(self.min_workers):
+            self._spawn()
+        self._sizer = threading.Thread(target=self._run, name="iDriveFinalizeSizer", daemon=True)
+        self._sizer.start()
+
+    def workers(self) -> int:
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            return len(self._threads)
+
+    def stats(self) -> FinalizeStats:
+        return FinalizeStats(
+            queue_depth=self.queue.qsize(),
+            workers=self.workers(),
+            files_finalized=self.monitor.files_finalized,
+            bytes_finalized=self.monitor.bytes_total(),
+            disk_throughput=self.monitor.disk_rate(),
+            stage_seconds=self.monitor.stage_seconds(),
+            stage_averages=self.monitor.stage_averages(),
+        )
+
+    def step(self) -> None:
+        depth = self.queue.qsize()
+        workers = self.workers()
+        rate = self.monitor.disk_rate()
+
+        if depth > workers and workers < self.max_workers:
+            if self._rate_at_growth is None or rate > self._rate_at_growth * self.growth_threshold:
+                self._spawn()
+                logger.debug(f"[FinalizePool] {depth} files waiting, {rate / 1e6:.1f} MB/s → {workers + 1} workers")
+                self._rate_at_growth = rate
+        elif depth == 0 and workers > self.min_workers:
+            # picked up by whichever worker is idle
+            self.queue.put(None)
+            self._rate_at_growth = None
+
+    def shutdown(self) -> None:
+        self._stop.set()
+        if self._sizer is not None:
+            self._sizer.join()
+        with self._lock:
+            threads = list(self._threads)
+        for _ in threads:
+            self.queue.put(None)
+        for t in threads:
+            t.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.step()
+            except Exception:
+                logger.exception("[FinalizePool] Sizing failed")
+
+    def _spawn(self) -> None:
+        worker = FinalizeWorker(self.queue, self.file_states, self.file_records, self.monitor)
+        t = threading.Thread(target=worker.run, name=f"iDriveFinalizeWorker-{next(self._ids)}", daemon=True)
+        t.start()
+        with self._lock:
+            self._threads.append(t)
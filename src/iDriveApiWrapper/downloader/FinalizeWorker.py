@@ -1,22 +1,26 @@
 import logging
 import os
 import shutil
-from typing import Dict
+from typing import Dict, Optional, TYPE_CHECKING
 
 from src.iDriveApiWrapper.downloader.FileFinalizer import FileFinalizer
 from .state import FileStatus, FileRecord, FileState
 from ..exceptions import PathDoesntExistError
 
+if TYPE_CHECKING:
+    from .FinalizePool import FinalizeMonitor
+
 logger = logging.getLogger("iDrive")
 
 # Cleaned v.1
 
 class FinalizeWorker:
-    def __init__(self, finalize_q, file_states: Dict[str, FileState], file_records: Dict[str, FileRecord]):
+    def __init__(self, finalize_q, file_states: Dict[str, FileState], file_records: Dict[str, FileRecord], monitor: Optional["FinalizeMonitor"] = None):
         self.fq = finalize_q
         self.file_states = file_states
         self.file_records = file_records
-        self.finalizer = FileFinalizer()
+        self.monitor = monitor
+        self.finalizer = FileFinalizer(monitor=monitor)
 
     def run(self):
         while True:
@@ -25,40 +29,59 @@ class FinalizeWorker:
                 self.fq.task_done()
                 break
 
-            state = self.file_states[fid]
-            record = self.file_records[fid]
-
             try:
-                if state.cancelled:
-                    state.status = FileStatus.CANCELLED
+                self.process(fid)
+            finally:
+                self.fq.task_done()
 
-                elif state.error is None:
-                    self.finalizer.finalize(record)
+    def process(self, fid: str) -> None:
+        state = self.file_states[fid]
+        record = self.file_records[fid]
 
-                    output_dir = record.output_dir
+        # a cancel arriving while the file gets finalized discards it only afterwards, unless it made it through
+        finalizing = finalized = False
+        try:
+            if state.error is None:
+                finalizing = state.writer_started()
 
-                    if not os.path.isdir(output_dir):
-                        raise PathDoesntExistError(f"Target directory does not exist: {output_dir}")
+            if state.cancelled:
+                state.finish(FileStatus.CANCELLED)
 
-                    target_path = os.path.join(output_dir, os.path.basename(record.output_path))
-                    shutil.move(record.output_path, target_path)
-                    shutil.rmtree(record.file_dir)
+            elif state.error is None:
+                self.finalizer.finalize(record, state)
+                finalized = True
 
-                    state.status = FileStatus.COMPLETED
+                if not record.direct_write:
+                    with self.finalizer.stage("move"):
+                        self._move_to_output(record)
 
-                else:
-                    state.status = FileStatus.FAILED
+                if self.monitor is not None:
+                    self.monitor.file_done()
+                state.finish(FileStatus.COMPLETED)
 
-            except Exception as e:
-                state.error = e
-                state.status = FileStatus.FAILED
-                logger.exception(f"[FinalizeWorker] Finalization failed for file {fid}")
+            else:
+                state.finish(FileStatus.FAILED)
 
-            finally:
-                try:
-                    if record.on_complete:
-                        record.on_complete(fid, state)
-                except Exception:
-                    logger.exception(f"[FinalizeWorker] on_complete callback failed for file {fid}")
+        except Exception as e:
+            state.finish(FileStatus.FAILED, e)
+            logger.exception(f"[FinalizeWorker] Finalization failed for file {fid}")
 
-                self.fq.task_done()
+        finally:
+            if finalizing and state.writer_stopped() and not finalized:
+                FileFinalizer.discard(record)
+
+            try:
+                if record.on_complete:
+                    record.on_complete(fid, state)
+            except Exception:
+                logger.exception(f"[FinalizeWorker] on_complete callback failed for file {fid}")
+
+    def _move_to_output(self, record: FileRecord) -> None:
+        output_dir = record.output_dir
+
+        if not os.path.isdir(output_dir):
+            raise PathDoesntExistError(f"Target directory does not exist: {output_dir}")
+
+        target_path = os.path.join(output_dir, os.path.basename(record.output_path))
+        shutil.move(record.output_path, target_path)
+        shutil.rmtree(record.file_dir, ignore_errors=True)
@@ -1,38 +1,84 @@
 import logging
-import os
 import time
 import threading
+from typing import Optional
+
 import httpx
 
-from .state import FragmentTask, FileRecord, FileState
+from .FragmentWriter import FragmentWriter
+from .ParkingLot import FragmentParked
+from .UrlResolver import UrlResolver
+from .state import FragmentTask, FileRecord, FileState, ThrottleState
 from ..exceptions import RateLimitError, ServiceUnavailableError, DiscordAttachmentNotFoundError, ServerTimeoutError, NetworkError
-
-from ..utils.networker import make_request
+from ..utils.BandwidthLimiter import BandwidthLimiter
+from ..utils.FragmentCache import FragmentCache
+from ..utils.Metrics import MetricsSink
+from ..utils.TransportPool import TransportPool
 
 logger = logging.getLogger("iDrive")
 
 class FragmentDownloader:
-    def __init__(self):
-        self._client = httpx.Client(timeout=10.0, follow_redirects=True)
+    def __init__(self, resolver: UrlResolver, transport: TransportPool, throttle: ThrottleState, cache: Optional[FragmentCache] = None,
+                 limiter: Optional[BandwidthLimiter] = None, metrics: Optional[MetricsSink] = None):
+        self._transport = transport
+        self._resolver = resolver
+        self._throttle = throttle
+        self._cache = cache
+        self._limiter = limiter or BandwidthLimiter()
+        self._metrics = metrics or MetricsSink()
 
     def download(self, task: FragmentTask, record: FileRecord, global_pause: threading.Event, state: FileState) -> int:
         if state.cancelled:
             return 0
 
+        attachment_id = task.fragment.attachment_id
+
+        if task.cached is not None:
+            # the resolve stage found it in the cache
+            with task.cached as f:
+                data = f.read()
+            task.cached = None
+            if len(data) == task.fragment.size:
+                return self._from_cache(task, record, state, data)
+
+        try:
+            url = task.url or self._resolver.resolve(attachment_id, task.file_password)
+            try:
+                return self._stream(url, task, record, global_pause, state)
+            except DiscordAttachmentNotFoundError:
+                # a cached url can get revoked before its advertised expiry, ask for a fresh one once
+                self._resolver.invalidate(attachment_id)
+                url = self._resolver.resolve(attachment_id, task.file_password)
+                return self._stream(url, task, record, global_pause, state)
+
+        except (httpx.TimeoutException, httpx.ReadTimeout) as e:
+            raise ServerTimeoutError("Download timed out") from e
+        except httpx.RequestError as e:
+            raise NetworkError("Network error during download") from e
+
+    def _stream(self, url: str, task: FragmentTask, record: FileRecord, global_pause: threading.Event, state: FileState) -> int:
         fragment = task.fragment
-        attachment_id = fragment.attachment_id
-        file_dir = record.file_dir
-        part_path = os.path.join(file_dir, f"{fragment.sequence}.part")
 
+        # continues where an interrupted attempt left off
+        writer = FragmentWriter(record, fragment, task.resume_from, task.resume_crc)
+        if writer.start != task.resume_from:
+            # the `.part` file to continue is gone
+            self._restart(task, record, state)
         try:
-            response_data = make_request("GET", f"items/ultraDownload/attachments/{attachment_id}", headers={"x-resource-password": task.file_password})
-            url = response_data["url"]
+            headers = {"Range": f"bytes={writer.start}-"} if writer.start else None
+
+            started = time.monotonic()
+            with self._transport.client_for(url).stream("GET", url, headers=headers, timeout=10.0, follow_redirects=True) as r:
+                ttfb = time.monotonic() - started
+                self._throttle.signal_ttfb(ttfb)
+                self._metrics.observe("download_stage_seconds", ttfb, stage="ttfb")
 
-            total = 0
+                if r.status_code in (404, 429, 503):
+                    # the errors read the (short) body
+                    r.read()
 
-            with self._client.stream("GET", url) as r:
                 if r.status_code == 404:
-                    raise DiscordAttachmentNotFoundError(f"Attachment {attachment_id} not found")
+                    raise DiscordAttachmentNotFoundError(r, f"Attachment {fragment.attachment_id} not found")
 
                 if r.status_code == 429:
                     raise RateLimitError(r)
@@ -42,33 +88,85 @@ class FragmentDownloader:
 
                 r.raise_for_status()
 
-                with open(part_path, "wb") as f:
-                    for chunk in r.iter_bytes(8192):
+                if writer.start and r.status_code != 206:
+                    # the range was ignored, the whole fragment is coming
+                    writer.close()
+                    self._restart(task, record, state)
+                    writer = FragmentWriter(record, fragment)
+
+                # only whole fragments go into the cache, streamed into it as they arrive
+                entry = self._cache.store(fragment.attachment_id) if self._cache is not None and not writer.start else None
+                body_started = time.monotonic()
+
+                try:
+                    for chunk in r.iter_bytes():
                         if not chunk:
                             continue
 
-                        # pause / cancel
-                        while not global_pause.is_set() or not state.pause_event.is_set():
-                            if state.cancelled:
-                                return total
-                            time.sleep(0.1)
-
                         if state.cancelled:
-                            return total
-
-                        f.write(chunk)
-                        total += len(chunk)
-
-            return total
-
-        except (httpx.TimeoutException, httpx.ReadTimeout) as e:
-            self._cleanup_file(part_path)
-            raise ServerTimeoutError("Download timed out") from e
-        except httpx.RequestError as e:
-            self._cleanup_file(part_path)
-            raise NetworkError("Network error during download") from e
-
-    def _cleanup_file(self, path: str) -> None:
-        logger.info("[FragmentDownloader] Cleaning up file after network error")
-        if os.path.exists(path):
-            os.remove(path)
+                            if entry is not None:
+                                entry.abort()
+                            return writer.written
+
+                        if not global_pause.is_set() or not state.pause_event.is_set():
+                            # give the worker to other files
+                            raise FragmentParked()
+
+                        self._limiter.consume(len(chunk), task.file_id)
+                        writer.write(chunk)
+                        if entry is not None:
+                            entry.write(chunk)
+
+                    writer.commit(state)
+                except BaseException as e:
+                    if entry is not None:
+                        entry.abort()
+                    if isinstance(e, (httpx.HTTPError, NetworkError, FragmentParked)):
+                        self._checkpoint(task, record, state, writer)
+                    raise
+        finally:
+            writer.close()
+
+        # the whole body, decrypting and writing included
+        self._metrics.observe("download_stage_seconds", time.monotonic() - body_started, stage="transfer")
+        writer.report(self._metrics)
+
+        if entry is not None:
+            entry.commit()
+        return writer.written
+
+    def _from_cache(self, task: FragmentTask, record: FileRecord, state: FileState, data: bytes) -> int:
+        writer = FragmentWriter(record, task.fragment)
+        try:
+            writer.write(data)
+            writer.commit(state)
+        finally:
+            writer.close()
+        writer.report(self._metrics, source="cache")
+
+        # progress, but not network throughput the autoscaler should react to
+        with state.lock:
+            state.bytes_downloaded += len(data) - task.resume_from
+        return 0
+
+    def _checkpoint(self, task: FragmentTask, record: FileRecord, state: FileState, writer: FragmentWriter) -> None:
+        """Keeps an interrupted fragment's bytes, so the next attempt asks only for the rest."""
+        if not writer.written or writer.have >= task.fragment.size:
+            # nothing new, or a body that ran long: start the fragment over
+            return
+        have, crc = writer.checkpoint()
+        task.resume_from, task.resume_crc = have, crc
+        record.journal.record(record.file_info.id, task.fragment.sequence, have, crc)
+
+        with state.lock:
+            state.bytes_downloaded += writer.written
+        self._throttle.signal_bytes(writer.written, file_id=task.file_id)
+        task.resume_signaled += writer.written
+
+    def _restart(self, task: FragmentTask, record: FileRecord, state: FileState) -> None:
+        """The fragment comes again from its first byte: its resumed prefix stops counting, in the progress, the meters and the journal."""
+        record.journal.forget(record.file_info.id, [task.fragment.sequence])
+        with state.lock:
+            state.bytes_downloaded -= task.resume_from
+        self._throttle.retract_bytes(task.resume_signaled, file_id=task.file_id)
+        task.resume_from = task.resume_crc = task.resume_signaled = 0
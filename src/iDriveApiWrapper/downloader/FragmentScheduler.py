@@ -0,0 +1,198 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from queue import Empty
+from typing import Dict, List, Optional, Tuple
+
+from .state import FragmentTask, SchedulingPolicy
+
+_Entry = Tuple[int, int, FragmentTask]  # (sort key, arrival counter, task)
+
+# policies that hand out a file's fragments in the order they were queued (retries go last)
+_ARRIVAL_ORDERED = (SchedulingPolicy.FIFO, SchedulingPolicy.PRIORITY)
+
+
+class FragmentScheduler:
+    """
+    Drop-in replacement for the fragment `Queue` that decides which file's fragment is handed out next.
+
+    Every file with queued work keeps its own heap; the policy decides the order within a file
+    (arrival for FIFO / PRIORITY, sequence otherwise) and across files. `None` sentinels are served before any task.
+    Policy and priority changes re-order work that is already queued. A file's arrival and priority are kept
+    until `forget_file`, so its retries keep their place.
+    """
+
+    def __init__(self, policy: SchedulingPolicy = SchedulingPolicy.ROUND_ROBIN):
+        self._policy = policy
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._all_tasks_done = threading.Condition(self._mutex)
+
+        # only files with queued tasks, in queue (or, for round-robin, rotation) order
+        self._files: "OrderedDict[str, List[_Entry]]" = OrderedDict()
+        self._arrival: Dict[str, int] = {}
+        self._priorities: Dict[str, int] = {}
+        # active files sorted for FIFO / PRIORITY / SEQUENTIAL, rebuilt lazily
+        self._ranked: Optional[List[str]] = None
+
+        self._counter = itertools.count()
+        self._sentinels = 0
+        self._size = 0
+        self._unfinished = 0
+
+    # ------------------------------------------------------------------
+    # Scheduling controls
+    # ------------------------------------------------------------------
+
+    @property
+    def policy(self) -> SchedulingPolicy:
+        return self._policy
+
+    def set_policy(self, policy: SchedulingPolicy) -> None:
+        with self._mutex:
+            if policy == self._policy:
+                return
+            rekey = (policy in _ARRIVAL_ORDERED) != (self._policy in _ARRIVAL_ORDERED)
+            self._policy = policy
+            if rekey:
+                for file_id, heap in self._files.items():
+                    rekeyed = [(self._key(task, counter), counter, task) for _, counter, task in heap]
+                    heapq.heapify(rekeyed)
+                    self._files[file_id] = rekeyed
+            self._ranked = None
+
+    def set_priority(self, file_id: str, priority: int) -> None:
+        with self._mutex:
+            self._priorities[file_id] = priority
+            self._ranked = None
+
+    def get_priority(self, file_id: str) -> int:
+        return self._priorities.get(file_id, 0)
+
+    def forget_file(self, file_id: str) -> None:
+        """Drops everything kept for a finished file, including tasks of it still queued."""
+        with self._mutex:
+            self._arrival.pop(file_id, None)
+            self._priorities.pop(file_id, None)
+            heap = self._files.pop(file_id, None)
+            if heap:
+                self._size -= len(heap)
+                self._unfinished -= len(heap)
+                if not self._unfinished:
+                    self._all_tasks_done.notify_all()
+            if heap is not None:
+                self._ranked = None
+
+    # ------------------------------------------------------------------
+    # Queue interface
+    # ------------------------------------------------------------------
+
+    def put(self, task: Optional[FragmentTask], block: bool = True, timeout: Optional[float] = None) -> None:
+        with self._mutex:
+            if task is None:
+                self._sentinels += 1
+            else:
+                self._push(task)
+            self._size += 1
+            self._unfinished += 1
+            self._not_empty.notify()
+
+    def put_nowait(self, task: Optional[FragmentTask]) -> None:
+        self.put(task, block=False)
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Optional[FragmentTask]:
+        with self._not_empty:
+            if not block:
+                if not self._size:
+                    raise Empty
+            elif timeout is None:
+                while not self._size:
+                    self._not_empty.wait()
+            else:
+                deadline = time.monotonic() + timeout
+                while not self._size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise Empty
+                    self._not_empty.wait(remaining)
+
+            self._size -= 1
+            if self._sentinels:
+                self._sentinels -= 1
+                return None
+            return self._pop()
+
+    def get_nowait(self) -> Optional[FragmentTask]:
+        return self.get(block=False)
+
+    def task_done(self) -> None:
+        with self._all_tasks_done:
+            if self._unfinished <= 0:
+                raise ValueError("task_done() called too many times")
+            self._unfinished -= 1
+            if not self._unfinished:
+                self._all_tasks_done.notify_all()
+
+    def join(self) -> None:
+        with self._all_tasks_done:
+            while self._unfinished:
+                self._all_tasks_done.wait()
+
+    def qsize(self) -> int:
+        with self._mutex:
+            return self._size
+
+    def empty(self) -> bool:
+        return not self.qsize()
+
+    def queued_per_file(self) -> Dict[str, int]:
+        with self._mutex:
+            return {file_id: len(heap) for file_id, heap in self._files.items()}
+
+    # ------------------------------------------------------------------
+    # Internals (called with the mutex held)
+    # ------------------------------------------------------------------
+
+    def _key(self, task: FragmentTask, counter: int) -> int:
+        if self._policy in _ARRIVAL_ORDERED:
+            return counter
+        return task.fragment.sequence
+
+    def _push(self, task: FragmentTask) -> None:
+        task.queued_at = time.monotonic()
+        file_id = task.file_id
+        counter = next(self._counter)
+        heap = self._files.get(file_id)
+        if heap is None:
+            heap = self._files[file_id] = []
+            self._arrival.setdefault(file_id, counter)
+            self._ranked = None
+        heapq.heappush(heap, (self._key(task, counter), counter, task))
+
+    def _pop(self) -> FragmentTask:
+        if self._policy == SchedulingPolicy.ROUND_ROBIN:
+            file_id = next(iter(self._files))
+            heap = self._files[file_id]
+            self._files.move_to_end(file_id)
+        else:
+            if self._ranked is None:
+                self._ranked = sorted(self._files, key=self._rank)
+            file_id = self._ranked[0]
+            heap = self._files[file_id]
+
+        _, _, task = heapq.heappop(heap)
+        if not heap:
+            del self._files[file_id]
+            if self._ranked is not None:
+                self._ranked.remove(file_id)
+            if file_id not in self._priorities:
+                # every queued file has a priority until forgotten: a late retry of a finished file
+                self._arrival.pop(file_id, None)
+        return task
+
+    def _rank(self, file_id: str) -> Tuple[int, int]:
+        if self._policy == SchedulingPolicy.FIFO:
+            return 0, self._arrival[file_id]
+        return -self._priorities.get(file_id, 0), self._arrival[file_id]
@@ -0,0 +1,175 @@
+import os
+import threading
+import time
+import zlib
+from typing import Tuple
+
+from .state import FileRecord, FileState, FragmentInfo
+from ..exceptions import NetworkError
+from ..models.Enums import EncryptionMethod
+from ..utils.Metrics import MetricsSink
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+# decryption output, only used within one call so one per thread is enough
+_local = threading.local()
+
+
+class FragmentWriter:
+    """
+    Decrypts a fragment's bytes as they arrive and writes the plaintext to its place on disk:
+    its offset in the preallocated output file, or its own `.part` file.
+
+    Incoming chunks are gathered in one `block_size` buffer, decrypted with `update_into` into a per-thread
+    buffer and written unbuffered, one syscall per block; nothing is allocated per chunk.
+
+    `start` / `start_crc` continue a partially written fragment: the decryptor is seeded at that byte
+    and the CRC carries on from the prefix's. If a `.part` file to continue is gone, the writer starts over
+    (check `start` after construction).
+    """
+
+    def __init__(self, record: FileRecord, fragment: FragmentInfo, start: int = 0, start_crc: int = 0, block_size: int = DEFAULT_BLOCK_SIZE):
+        self.record = record
+        self.fragment = fragment
+        self.start = start
+        self.written = 0
+        self.block_size = block_size
+
+        self._crc = start_crc if start else 0
+        self._file = self._open()
+
+        # fragments are decrypted here, on the worker thread, so nothing is left to decrypt at finalize time
+        self._decryptor = record.file_info.create_decryptor(fragment.offset + self.start)
+        self._encrypted = self._decryptor.method != EncryptionMethod.Not_Encrypted
+        self._block = bytearray(block_size)
+        self._filled = 0
+
+        # per stage, timed once per block
+        self.decrypt_seconds = 0.0
+        self.crc_seconds = 0.0
+        self.write_seconds = 0.0
+
+    @property
+    def part_path(self) -> str:
+        return os.path.join(self.record.file_dir, f"{self.fragment.sequence}.part")
+
+    @property
+    def have(self) -> int:
+        """Bytes of the fragment on disk, including the resumed prefix."""
+        return self.start + self.written
+
+    def _open(self):
+        if self.record.direct_write:
+            # every writer gets its own handle, so writes at different offsets never share a file position
+            f = open(self.record.partial_path, "r+b", buffering=0)
+            f.seek(self.fragment.offset + self.start)
+            return f
+
+        if self.start:
+            try:
+                f = open(self.part_path, "r+b", buffering=0)
+                f.seek(self.start)
+                f.truncate()
+                return f
+            except FileNotFoundError:
+                self.start, self._crc = 0, 0
+
+        try:
+            return open(self.part_path, "wb", buffering=0)
+        except FileNotFoundError:
+            os.makedirs(self.record.file_dir, exist_ok=True)
+            return open(self.part_path, "wb", buffering=0)
+
+    def write(self, chunk) -> None:
+        view = memoryview(chunk)
+        if self.have + len(view) > self.fragment.size:
+            # would spill into the next fragment's bytes
+            raise NetworkError(f"Fragment {self.fragment.sequence} of {self.record.file_info.id}: body longer than {self.fragment.size} bytes")
+        self.written += len(view)
+
+        while view:
+            if not self._filled and len(view) >= self.block_size:
+                # already block sized (e.g. batched by the caller), no need to copy it first
+                self._process(view[:self.block_size])
+                view = view[self.block_size:]
+                continue
+
+            n = min(len(view), self.block_size - self._filled)
+            self._block[self._filled:self._filled + n] = view[:n]
+            self._filled += n
+            view = view[n:]
+            if self._filled == self.block_size:
+                self._flush_block()
+
+    def checkpoint(self) -> Tuple[int, int]:
+        """Makes what was written so far durable. Returns (bytes on disk, CRC32 of them)."""
+        self._flush_block()
+        os.fsync(self._file.fileno())
+        return self.have, self._crc
+
+    def commit(self, state: FileState) -> int:
+        """
+        Flushes the fragment and records it as complete. Returns its CRC32.
+        Raises NetworkError if the body was cut short, so the rest is fetched again instead of being journaled as done.
+        """
+        if self.have != self.fragment.size:
+            raise NetworkError(f"Fragment {self.fragment.sequence} of {self.record.file_info.id}: body ended at {self.have} of {self.fragment.size} bytes")
+        self._flush_block()
+        tail = self._decryptor.finalize()
+        if tail:
+            self._crc = zlib.crc32(tail, self._crc)
+            self._write_all(memoryview(tail))
+        # data must be durable before the journal says so
+        started = time.perf_counter()
+        os.fsync(self._file.fileno())
+        self.write_seconds += time.perf_counter() - started
+        self.close()
+
+        with state.lock:
+            state.fragment_crcs[self.fragment.sequence] = self._crc
+
+        self.record.journal.record(self.record.file_info.id, self.fragment.sequence, self.fragment.size, self._crc)
+
+        return self._crc
+
+    def report(self, metrics: MetricsSink, source: str = "network") -> None:
+        """Records a committed fragment's per-stage timings and size."""
+        metrics.observe("download_stage_seconds", self.decrypt_seconds, stage="decrypt")
+        metrics.observe("download_stage_seconds", self.crc_seconds, stage="crc")
+        metrics.observe("download_stage_seconds", self.write_seconds, stage="write")
+        metrics.increment("download_bytes_total", self.written, source=source)
+        metrics.increment("download_fragments_total", source=source)
+
+    def _flush_block(self) -> None:
+        if self._filled:
+            self._process(memoryview(self._block)[:self._filled])
+            self._filled = 0
+
+    def _process(self, data: memoryview) -> None:
+        started = time.perf_counter()
+        if self._encrypted:
+            out = self._out_buffer(len(data))
+            data = out[:self._decryptor.decrypt_into(data, out)]
+        decrypted = time.perf_counter()
+        self._crc = zlib.crc32(data, self._crc)
+        checksummed = time.perf_counter()
+        self._write_all(data)
+        self.decrypt_seconds += decrypted - started
+        self.crc_seconds += checksummed - decrypted
+        self.write_seconds += time.perf_counter() - checksummed
+
+    def _write_all(self, data: memoryview) -> None:
+        while data:
+            data = data[self._file.write(data):]
+
+    @staticmethod
+    def _out_buffer(size: int) -> memoryview:
+        # update_into wants room for a block on top of the data
+        buffer = getattr(_local, "buffer", None)
+        if buffer is None or len(buffer) < size + 63:
+            buffer = _local.buffer = memoryview(bytearray(size + 63))
+        return buffer
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._file.close()
@@ -1,13 +1,22 @@
 import logging
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
 from .state import FileInfo
+from ..models.Folder import Folder
 from ..models.Item import Item
+from ..utils.TransportPool import TransportPool
 from ..utils.networker import make_request
 
 logger = logging.getLogger("iDrive")
 
 # Cleaned v.1
 class MetadataFetcher:
+    def __init__(self, max_concurrency: int = 8, transport: Optional[TransportPool] = None):
+        self.max_concurrency = max_concurrency
+        self.transport = transport
+
     def _inject_passwords(self, raw_files: dict, password: str):
         for f in raw_files:
             f["password"] = password
@@ -18,6 +27,43 @@ class MetadataFetcher:
             "POST",
             f"items/ultraDownload/items/{item.id}",
             headers=item._get_password_header(),
+            transport=self.transport,
         )
         self._inject_passwords(res_data, item.get_password())
-        return FileInfo.convert(res_data)
+        files = FileInfo.convert(res_data)
+
+        if isinstance(item, Folder):
+            # the listing above is flat, the tree comes from the folders themselves
+            file_dirs = self.fetch_tree(item)
+            for file in files:
+                file.path = file_dirs.get(file.id, "")
+        return files
+
+    def fetch_tree(self, folder: Folder) -> Dict[str, str]:
+        """
+        file_id → directory of the file relative to `folder` ("" for its direct children, "/" separated).
+        The tree is walked one level at a time, the folders of a level listed in parallel.
+        """
+        headers = folder._get_password_header()
+        file_dirs: Dict[str, str] = {}
+        level: List[Tuple[str, str]] = [(folder.id, "")]
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="iDriveMetadataFetcher") as pool:
+            while level:
+                listings = pool.map(lambda entry: make_request("GET", f"folders/{entry[0]}", headers=headers, transport=self.transport)["folder"]["children"], level)
+                next_level: List[Tuple[str, str]] = []
+                for (_, path), children in zip(level, listings):
+                    for child in children:
+                        if child["isDir"]:
+                            next_level.append((child["id"], posixpath.join(path, self._safe_name(child["name"]))))
+                        else:
+                            file_dirs[child["id"]] = path
+                level = next_level
+
+        return file_dirs
+
+    @staticmethod
+    def _safe_name(name: str) -> str:
+        # a folder name must never climb out of (or split inside) the target directory
+        name = name.replace("/", "_").replace("\\", "_")
+        return "_" if name in ("", ".", "..") else name
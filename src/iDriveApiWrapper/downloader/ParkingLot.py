@@ -0,0 +1,66 @@
+import threading
+from typing import Dict, List
+
+from .state import FileState, FragmentTask
+
+
+class FragmentParked(Exception):
+    """The file got paused mid-stream, the fragment starts over once it's resumed."""
+
+
+class ParkingLot:
+    """
+    Holds fragment tasks of paused files until they're resumed, so workers don't keep cycling them through the queues.
+
+    Pause flags are flipped under the same lock tasks get parked under, hence a task can't be parked
+    after its file was already released.
+    """
+
+    def __init__(self, global_pause: threading.Event):
+        self._global_pause = global_pause
+        self._lock = threading.Lock()
+        self._parked: Dict[str, List[FragmentTask]] = {}
+
+    def park_if_paused(self, task: FragmentTask, state: FileState) -> bool:
+        with self._lock:
+            if self._global_pause.is_set() and state.pause_event.is_set():
+                return False
+            self._parked.setdefault(task.file_id, []).append(task)
+            return True
+
+    def parked_count(self) -> int:
+        with self._lock:
+            return sum(len(tasks) for tasks in self._parked.values())
+
+    # ------------------------------------------------------------------
+    # Pause / resume, return the tasks to put back in the queue
+    # ------------------------------------------------------------------
+
+    def pause_all(self) -> None:
+        with self._lock:
+            self._global_pause.clear()
+
+    def resume_all(self, states: Dict[str, FileState]) -> List[FragmentTask]:
+        with self._lock:
+            self._global_pause.set()
+            released = []
+            for file_id in list(self._parked):
+                state = states.get(file_id)
+                if state is None or state.pause_event.is_set():
+                    released.extend(self._parked.pop(file_id))
+            return released
+
+    def pause_file(self, state: FileState) -> None:
+        with self._lock:
+            state.pause_event.clear()
+
+    def resume_file(self, file_id: str, state: FileState) -> List[FragmentTask]:
+        with self._lock:
+            state.pause_event.set()
+            if not self._global_pause.is_set():
+                return []
+            return self._parked.pop(file_id, [])
+
+    def discard(self, file_id: str) -> None:
+        with self._lock:
+            self._parked.pop(file_id, None)
@@ -0,0 +1,98 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from .state import FileState
+
+logger = logging.getLogger("iDrive")
+
+
+class _Watch:
+    __slots__ = ("file_id", "state", "callback", "interval", "reported", "finished")
+
+    def __init__(self, file_id: str, state: FileState, callback: Callable[[str, int, int], None], interval: float):
+        self.file_id = file_id
+        self.state = state
+        self.callback = callback
+        self.interval = interval
+        self.reported = -1
+        self.finished = False
+
+
+class ProgressDispatcher:
+    """
+    Delivers the byte-progress callbacks of every watched file from one thread, at most once per `interval`
+    per file and only when the byte count moved. Watches sit in a heap ordered by their next due time, so
+    thousands of them cost no thread each and nothing in between their ticks; a finishing file gets one last
+    call with its final count right away. Callbacks never run on download workers, a slow one only delays
+    other callbacks.
+    """
+
+    IDLE_TIMEOUT = 30.0
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap: List[Tuple[float, int, _Watch]] = []
+        self._seq = itertools.count()
+        self._thread: Optional[threading.Thread] = None
+
+    def watch(self, file_id: str, state: FileState, callback: Callable[[str, int, int], None], interval: float = 0.5) -> None:
+        watch = _Watch(file_id, state, callback, interval)
+        with self._cond:
+            self._push(watch, time.monotonic())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="iDriveProgressDispatcher", daemon=True)
+                self._thread.start()
+        # runs right away if the file already finished, hence outside the lock
+        state.future.add_done_callback(lambda _: self._due_now(watch))
+
+    def _due_now(self, watch: _Watch) -> None:
+        with self._cond:
+            self._push(watch, time.monotonic())
+
+    def _push(self, watch: _Watch, at: float) -> None:
+        heapq.heappush(self._heap, (at, next(self._seq), watch))
+        self._cond.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap:
+                        self._cond.wait(ProgressDispatcher.IDLE_TIMEOUT)
+                        if not self._heap:
+                            # nothing to report for a while, a new watch starts a new thread
+                            self._thread = None
+                            return
+                        continue
+                    delay = self._heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        watch = heapq.heappop(self._heap)[2]
+                        break
+                    self._cond.wait(delay)
+
+            self._report(watch)
+
+    def _report(self, watch: _Watch) -> None:
+        if watch.finished:
+            # a tick already queued when the file finished
+            return
+
+        state = watch.state
+        finished = state.future.done()
+        current = state.bytes_downloaded
+        if current != watch.reported:
+            watch.reported = current
+            try:
+                watch.callback(watch.file_id, current, state.size_total)
+            except Exception:
+                logger.exception(f"[ProgressDispatcher] Progress callback failed for file {watch.file_id}")
+
+        if finished:
+            watch.finished = True
+        else:
+            with self._cond:
+                self._push(watch, time.monotonic() + watch.interval)
@@ -0,0 +1,227 @@
+import bisect
+import io
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from typing import Optional
+
+import httpx
+
+from .UrlResolver import UrlResolver
+from .state import FileInfo, FragmentInfo
+from ..exceptions import RateLimitError, ServiceUnavailableError, DiscordAttachmentNotFoundError, ServerTimeoutError, NetworkError
+from ..utils.FragmentCache import FragmentCache
+from ..utils.RetryScheduler import RetryPolicy
+from ..utils.TransportPool import TransportPool
+
+logger = logging.getLogger("iDrive")
+
+
+class RemoteFile(io.RawIOBase):
+    """
+    Read-only, seekable view of a remote file, fetched fragment by fragment straight from the CDN.
+
+    A read maps its position to a fragment through the fragment offsets; the fragment is fetched whole and
+    decrypted with a decryptor seeked to the fragment's offset. Fragments are kept in a small LRU cache and the
+    next `read_ahead` ones are fetched in parallel, so sequential readers (players, parsers, archive readers)
+    rarely wait on the network. Wrap it in `io.BufferedReader` for small reads.
+    """
+
+    def __init__(self, file_info: FileInfo, resolver: UrlResolver, transport: TransportPool, read_ahead: int = 4,
+                 cache_fragments: int = 16, max_retries: int = 5, retry_policy: Optional[RetryPolicy] = None, fragment_cache: Optional[FragmentCache] = None):
+        super().__init__()
+        self.file_info = file_info
+        self.name = file_info.name
+        self.size = file_info.size
+        self.read_ahead = read_ahead
+        # always room for the fragment being read plus the read-ahead window
+        self.cache_fragments = max(cache_fragments, read_ahead + 1)
+        self.max_retries = max_retries
+        self.retry_policy = retry_policy or RetryPolicy()
+
+        self._resolver = resolver
+        self._transport = transport
+        # the on-disk cache shared with the downloaders, unlike the in-memory one below
+        self._fragment_cache = fragment_cache
+        self._fragments = sorted(file_info.fragments, key=lambda f: f.offset)
+        self._offsets = [f.offset for f in self._fragments]
+        self._position = 0
+
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[int, Future]" = OrderedDict()  # index in self._fragments → Future[bytes]
+        self._executor = ThreadPoolExecutor(max_workers=max(1, read_ahead), thread_name_prefix="iDriveRemoteFile")
+
+    def __repr__(self):
+        return f"RemoteFile({self.name!r}, size={self.size})"
+
+    # ------------------------------------------------------------------
+    # io.RawIOBase
+    # ------------------------------------------------------------------
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self._check_closed()
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return position
+
+    def readinto(self, buffer) -> int:
+        self._check_closed()
+        filled = self._read_at(self._position, memoryview(buffer).cast("B"))
+        self._position += filled
+        return filled
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        """Positional read that leaves the file position alone, safe to call from several threads at once."""
+        self._check_closed()
+        buffer = bytearray(max(0, min(size, self.size - offset)))
+        filled = self._read_at(offset, memoryview(buffer))
+        return bytes(buffer[:filled])
+
+    def close(self) -> None:
+        if not self.closed:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            with self._lock:
+                self._cache.clear()
+        super().close()
+
+    # ------------------------------------------------------------------
+    # Cache / read-ahead
+    # ------------------------------------------------------------------
+
+    def _read_at(self, position: int, view: memoryview) -> int:
+        filled = 0
+        # fills the whole buffer unless EOF, many parsers treat a short read as the end of the file
+        while filled < len(view) and position < self.size:
+            index = bisect.bisect_right(self._offsets, position) - 1
+            fragment = self._fragments[index]
+            data = self._get(index)
+
+            start = position - fragment.offset
+            count = min(len(view) - filled, len(data) - start)
+            if count <= 0:
+                # fragments shorter than advertised, nothing sensible to return past them
+                break
+            view[filled:filled + count] = data[start:start + count]
+            filled += count
+            position += count
+        return filled
+
+    def _get(self, index: int) -> bytes:
+        while True:
+            with self._lock:
+                future = self._submit(index)
+                for ahead in range(index + 1, min(index + 1 + self.read_ahead, len(self._fragments))):
+                    self._submit(ahead)
+                self._evict(keep=index)
+
+            try:
+                return future.result()
+            except CancelledError:
+                # evicted by a concurrent reader before it got fetched
+                continue
+            except Exception:
+                # a failed fetch must not stay cached, the next read tries again
+                with self._lock:
+                    if self._cache.get(index) is future:
+                        del self._cache[index]
+                raise
+
+    def _submit(self, index: int) -> Future:
+        future = self._cache.get(index)
+        if future is None:
+            future = self._executor.submit(self._fetch, self._fragments[index])
+            self._cache[index] = future
+        self._cache.move_to_end(index)
+        return future
+
+    def _evict(self, keep: int) -> None:
+        while len(self._cache) > self.cache_fragments:
+            oldest = next(iter(self._cache))
+            if oldest == keep:
+                break
+            self._cache.pop(oldest).cancel()
+
+    # ------------------------------------------------------------------
+    # Fetching
+    # ------------------------------------------------------------------
+
+    def _fetch(self, fragment: FragmentInfo) -> bytes:
+        for attempt in itertools.count():
+            try:
+                return self._fetch_once(fragment)
+            except (RateLimitError, ServiceUnavailableError):
+                if attempt >= self.max_retries:
+                    raise
+                # the transport's rate limit registry holds the next request back as long as needed
+            except NetworkError:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.retry_policy.delay(attempt)
+                logger.warning(f"[RemoteFile] Network issue on fragment {fragment.sequence} of {self.name} → retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def _fetch_once(self, fragment: FragmentInfo) -> bytes:
+        raw = self._fragment_cache.get(fragment.attachment_id) if self._fragment_cache else None
+        if raw is None:
+            raw = self._download(fragment)
+            if self._fragment_cache:
+                self._fragment_cache.put(fragment.attachment_id, raw)
+
+        decryptor = self.file_info.create_decryptor(fragment.offset)
+        return decryptor.decrypt(raw) + decryptor.finalize()
+
+    def _download(self, fragment: FragmentInfo) -> bytes:
+        password = self.file_info.password
+        try:
+            url = self._resolver.resolve(fragment.attachment_id, password)
+            try:
+                raw = self._request(url, fragment)
+            except DiscordAttachmentNotFoundError:
+                # a cached url can get revoked before its advertised expiry, ask for a fresh one once
+                self._resolver.invalidate(fragment.attachment_id)
+                raw = self._request(self._resolver.resolve(fragment.attachment_id, password), fragment)
+        except httpx.TimeoutException as e:
+            raise ServerTimeoutError("Download timed out") from e
+        except httpx.RequestError as e:
+            raise NetworkError("Network error during download") from e
+        return raw
+
+    def _request(self, url: str, fragment: FragmentInfo) -> bytes:
+        r = self._transport.client_for(url).get(url, timeout=10.0, follow_redirects=True)
+
+        if r.status_code == 404:
+            raise DiscordAttachmentNotFoundError(r, f"Attachment {fragment.attachment_id} not found")
+
+        if r.status_code == 429:
+            raise RateLimitError(r)
+
+        if r.status_code == 503:
+            raise ServiceUnavailableError(r)
+
+        r.raise_for_status()
+        return r.content
+
+    def _check_closed(self) -> None:
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
@@ -0,0 +1,70 @@
+import logging
+import time
+from queue import Queue
+from typing import Dict, Optional
+
+from .ParkingLot import ParkingLot
+from .FragmentScheduler import FragmentScheduler
+from .UrlResolver import UrlResolver
+from .state import FileState, FragmentTask
+from ..utils.FragmentCache import FragmentCache
+from ..utils.Metrics import MetricsSink
+
+logger = logging.getLogger("iDrive")
+
+
+class ResolveWorker:
+    """
+    First pipeline stage: attaches a signed url to each fragment task and hands it to the
+    bounded ready queue, so transfer workers never wait on an API round trip.
+    """
+
+    def __init__(self, fragment_queue: FragmentScheduler, ready_queue: Queue[FragmentTask], file_states: Dict[str, FileState], resolver: UrlResolver, parking: ParkingLot,
+                 cache: Optional[FragmentCache] = None, metrics: Optional[MetricsSink] = None) -> None:
+        self.fragment_queue = fragment_queue
+        self.ready_queue = ready_queue
+        self.file_states = file_states
+        self.resolver = resolver
+        self.parking = parking
+        self.cache = cache
+        self.metrics = metrics or MetricsSink()
+
+    def run(self) -> None:
+        while True:
+            task = self.fragment_queue.get()
+
+            if task is None:
+                self.fragment_queue.task_done()
+                break
+
+            self.metrics.observe("download_stage_seconds", time.monotonic() - task.queued_at, stage="queue_wait")
+            try:
+                state = self.file_states.get(task.file_id)
+                if state is None or state.cancelled:
+                    continue
+
+                # paused files don't take up look-ahead slots
+                if self.parking.park_if_paused(task, state):
+                    continue
+
+                if self.cache is not None:
+                    task.cached = self.cache.open(task.fragment.attachment_id)
+                if task.cached is not None:
+                    # served from disk, no url needed (the open entry stays readable if it gets evicted meanwhile)
+                    task.queued_at = time.monotonic()
+                    self.ready_queue.put(task)
+                    continue
+
+                try:
+                    task.url = self.resolver.resolve(task.fragment.attachment_id, task.file_password)
+                except Exception as e:
+                    # the transfer worker resolves again and owns retry / failure handling
+                    logger.debug(f"[ResolveWorker] Could not resolve {task.fragment.attachment_id} ({e.__class__.__name__}), deferring to transfer worker")
+                    task.url = None
+
+                # blocks once `lookahead` tasks are waiting
+                task.queued_at = time.monotonic()
+                self.ready_queue.put(task)
+
+            finally:
+                self.fragment_queue.task_done()
@@ -0,0 +1,250 @@
+import logging
+import mimetypes
+import re
+import secrets
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Set, Tuple
+from urllib.parse import quote, unquote
+
+from .MetadataFetcher import MetadataFetcher
+from .RemoteFile import RemoteFile
+from .UrlResolver import UrlResolver
+from .state import FileInfo
+from ..models.Item import Item
+from ..utils.FragmentCache import FragmentCache
+from ..utils.TransportPool import TransportPool
+
+logger = logging.getLogger("iDrive")
+
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class StreamServer:
+    """
+    Localhost HTTP server exposing remote files, decrypted, with `Range` support, so players and tools
+    (ffmpeg, VLC, browsers) can stream and seek them through the fragment fast path.
+
+    Every file is served by one RemoteFile shared by all requests for it, so a player's overlapping range
+    requests share one fragment cache and read-ahead window; past `max_files` the least recently served idle
+    file is closed, one still serving a request is closed by its last one. Urls carry a random token, other local users
+    can't guess their way to the files.
+    """
+
+    _default: Optional["StreamServer"] = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, resolver: Optional[UrlResolver] = None, transport: Optional[TransportPool] = None, metadata_fetcher: Optional[MetadataFetcher] = None,
+                 host: str = "127.0.0.1", port: int = 0, read_ahead: int = 4, cache_fragments: int = 32, max_files: int = 8, chunk_size: int = 256 * 1024,
+                 fragment_cache: Optional[FragmentCache] = None):
+        self.transport = transport or TransportPool.default()
+        self.resolver = resolver or UrlResolver(transport=self.transport)
+        self.metadata_fetcher = metadata_fetcher or MetadataFetcher(transport=self.transport)
+        self.host = host
+        self.port = port
+        self.read_ahead = read_ahead
+        self.cache_fragments = cache_fragments
+        self.max_files = max_files
+        self.chunk_size = chunk_size
+        self.fragment_cache = fragment_cache
+
+        self._token = secrets.token_urlsafe(16)
+        self._lock = threading.Lock()
+        self._files: "OrderedDict[str, RemoteFile]" = OrderedDict()  # file_id → RemoteFile, least recently served first
+        self._active: Dict[RemoteFile, int] = {}  # RemoteFile → requests being served from it
+        self._evicted: Set[RemoteFile] = set()  # evicted while serving, closed once `_active` lets go of them
+        self._httpd: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def default(cls) -> "StreamServer":
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    # ------------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------------
+
+    def url_for(self, file: Item) -> str:
+        files = self.metadata_fetcher.fetch_files(file)
+        if len(files) != 1:
+            raise ValueError(f"{file} is not a single file")
+        return self.register(files[0])
+
+    def register(self, file_info: FileInfo) -> str:
+        """Serves a file from its metadata (e.g. from `MetadataFetcher.fetch_files`) and returns its url."""
+        self.start()
+        with self._lock:
+            if file_info.id not in self._files:
+                self._files[file_info.id] = RemoteFile(file_info, self.resolver, self.transport, read_ahead=self.read_ahead, cache_fragments=self.cache_fragments,
+                                                      fragment_cache=self.fragment_cache)
+            self._files.move_to_end(file_info.id)
+            self._evict()
+        return f"http://{self.host}:{self.port}/{self._token}/{file_info.id}/{quote(file_info.name)}"
+
+    def start(self) -> None:
+        with self._lock:
+            if self._httpd is not None:
+                return
+            self._httpd = ThreadingHTTPServer((self.host, self.port), _StreamHandler)
+            self._httpd.daemon_threads = True
+            self._httpd.stream_server = self
+            self.port = self._httpd.server_address[1]
+            self._thread = threading.Thread(target=self._httpd.serve_forever, name="iDriveStreamServer", daemon=True)
+            self._thread.start()
+        logger.info(f"[StreamServer] Serving on http://{self.host}:{self.port}")
+
+    def stop(self) -> None:
+        with self._lock:
+            httpd, self._httpd = self._httpd, None
+            files = list(self._files.values()) + list(self._evicted)
+            self._files.clear()
+            self._evicted.clear()
+        if httpd is not None:
+            httpd.shutdown()
+            httpd.server_close()
+            self._thread.join()
+        for remote in files:
+            remote.close()
+
+    # ------------------------------------------------------------------
+    # Internals
+    # ------------------------------------------------------------------
+
+    def _lookup(self, path: str) -> Optional[RemoteFile]:
+        """The file a request is for, held open until it's handed back to `_release`."""
+        parts = path.split("?", 1)[0].strip("/").split("/")
+        if len(parts) < 2 or not secrets.compare_digest(parts[0], self._token):
+            return None
+        with self._lock:
+            remote = self._files.get(unquote(parts[1]))
+            if remote is not None:
+                self._files.move_to_end(remote.file_info.id)
+                self._active[remote] = self._active.get(remote, 0) + 1
+            return remote
+
+    def _release(self, remote: RemoteFile) -> None:
+        with self._lock:
+            left = self._active.pop(remote) - 1
+            if left:
+                self._active[remote] = left
+                return
+            if remote not in self._evicted:
+                return
+            self._evicted.discard(remote)
+        remote.close()
+
+    def _evict(self) -> None:
+        while len(self._files) > max(self.max_files, 1):
+            # the least recently served idle file goes first; the newest one never, its url was just handed out
+            candidates = list(self._files.items())[:-1]
+            file_id, remote = next(((fid, r) for fid, r in candidates if r not in self._active), candidates[0])
+            del self._files[file_id]
+            if remote in self._active:
+                self._evicted.add(remote)
+            else:
+                remote.close()
+
+    @staticmethod
+    def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+        """(first, last) byte of a single `Range`, None to serve the whole file."""
+        match = _RANGE.fullmatch(header.strip()) if header else None
+        if match is None or not (match.group(1) or match.group(2)):
+            # absent, malformed or multi-range: a full response is always allowed
+            return None
+
+        if match.group(1):
+            first = int(match.group(1))
+            last = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+        else:
+            suffix = int(match.group(2))
+            if suffix == 0:
+                raise RangeNotSatisfiable()
+            first, last = max(0, size - suffix), size - 1
+
+        if first >= size or first > last:
+            raise RangeNotSatisfiable()
+        return first, last
+
+
+class _StreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def log_message(self, format, *args):
+        logger.debug(f"[StreamServer] {self.address_string()} {format % args}")
+
+    def _serve(self, body: bool) -> None:
+        server: StreamServer = self.server.stream_server
+        remote = server._lookup(self.path)
+        if remote is None:
+            self.send_error(404)
+            return
+
+        try:
+            self._serve_file(server, remote, body)
+        finally:
+            server._release(remote)
+
+    def _serve_file(self, server: StreamServer, remote: RemoteFile, body: bool) -> None:
+        size = remote.size
+        try:
+            requested = StreamServer.parse_range(self.headers.get("Range"), size)
+        except RangeNotSatisfiable:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        first, last = requested or (0, size - 1)
+        length = last - first + 1 if size else 0
+
+        # fetch the first chunk before committing to a status, so a failing fetch can still become a 502
+        try:
+            chunk = remote.read_at(first, min(server.chunk_size, length)) if body and length else b""
+        except Exception as e:
+            logger.warning(f"[StreamServer] Failed to serve {remote.name}: {e}")
+            self.send_error(502)
+            return
+
+        self.send_response(206 if requested else 200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", mimetypes.guess_type(remote.name)[0] or "application/octet-stream")
+        self.send_header("Content-Length", str(length))
+        if requested:
+            self.send_header("Content-Range", f"bytes {first}-{last}/{size}")
+        self.end_headers()
+        if not body:
+            return
+
+        position = first
+        try:
+            while True:
+                self.wfile.write(chunk)
+                position += len(chunk)
+                if position > last:
+                    return
+                chunk = remote.read_at(position, min(server.chunk_size, last + 1 - position))
+                if not chunk:
+                    break
+        except (ConnectionError, TimeoutError):
+            # players drop connections all the time when seeking
+            return
+        except Exception as e:
+            logger.warning(f"[StreamServer] Failed to serve {remote.name}: {e}")
+
+        # the promised length can't be met anymore
+        self.close_connection = True
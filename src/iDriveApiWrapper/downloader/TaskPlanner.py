@@ -1,8 +1,11 @@
+import hashlib
+import itertools
 import logging
 import os
 from queue import Queue
 from typing import Tuple, Dict, List, Callable, Optional
 
+from .DownloadJournal import DownloadJournal
 from .state import (
     FileState,
     FragmentTask,
@@ -16,8 +19,9 @@ logger = logging.getLogger("iDrive")
 
 
 class TaskPlanner:
-    def __init__(self, temp_folder: str):
+    def __init__(self, temp_folder: str, direct_write: bool = True):
         self._temp_folder = temp_folder
+        self._direct_write = direct_write
 
     def prepare(self, files: List[FileInfo], target_dir: str, on_complete: Optional[Callable] = None) -> Tuple[Queue[FragmentTask], Queue[str], Dict[str, FileState], Dict[str, FileRecord], int]:
         fragment_queue: Queue[FragmentTask] = Queue()
@@ -26,18 +30,38 @@ class TaskPlanner:
         file_records: Dict[str, FileRecord] = {}
         remaining_size_est = 0
 
+        # files of different subfolders take turns, so no folder waits for all the others
+        files = self._interleave(files)
+        output_paths = self._output_paths(files, target_dir)
+
+        # the whole tree is created up front, one makedirs per directory instead of a check per file
+        for output_dir in sorted({os.path.dirname(path) for path in output_paths.values()} | {target_dir}):
+            os.makedirs(output_dir, exist_ok=True)
+
+        # one journal (and one read) for the whole batch
+        journal = DownloadJournal(self._journal_path(files, target_dir), (file.id for file in files))
+        journaled = journal.load()
+
         for file in files:
             file_id = file.id
             name = file.name
             fragments = file.fragments
 
+            # `.part` files' directory is only created once a fragment is written there
             temp_file_dir = os.path.join(self._temp_folder, file_id)
-            os.makedirs(temp_file_dir, exist_ok=True)
-
             merged_path = os.path.join(temp_file_dir, f"{name}.encrypted")
-            output_path = os.path.join(target_dir, name)
+            output_path = output_paths[file_id]
+            partial_path = f"{output_path}.idownload" if self._direct_write else None
+            done = journaled.get(file_id, {})
 
-            missing_fragments, downloaded_fragments, downloaded_bytes, remaining_bytes = self._missing(temp_file_dir, fragments)
+            if done and not self._still_on_disk(file, temp_file_dir, partial_path):
+                journal.reset_file(file_id)
+                done = {}
+            if self._direct_write and not done:
+                self._preallocate(partial_path, file.size)
+
+            fragment_crcs: Dict[int, int] = {}
+            missing_fragments, downloaded_fragments, downloaded_bytes, remaining_bytes = self._missing(fragments, done, fragment_crcs)
 
             remaining_size_est += remaining_bytes
 
@@ -49,6 +73,7 @@ class TaskPlanner:
             )
 
             state.bytes_downloaded = downloaded_bytes
+            state.fragment_crcs = fragment_crcs
 
             if downloaded_fragments == len(fragments):
                 state.status = FileStatus.COMPLETED
@@ -64,8 +89,11 @@ class TaskPlanner:
                 file_dir=temp_file_dir,
                 merged_path=merged_path,
                 output_path=output_path,
-                output_dir=target_dir,
+                output_dir=os.path.dirname(output_path),
                 on_complete=on_complete,
+                direct_write=self._direct_write,
+                partial_path=partial_path,
+                journal=journal,
             )
 
             # --- Queue work ---
@@ -73,13 +101,15 @@ class TaskPlanner:
                 # Already on disk → finalize immediately
                 finalize_queue.put(file_id)
             else:
-                for fragment in missing_fragments:
+                for fragment, have, crc in missing_fragments:
                     fragment_queue.put(
                         FragmentTask(
                             file_id=file_id,
                             file_name=name,
                             fragment=fragment,
                             file_password=file.password,
+                            resume_from=have,
+                            resume_crc=crc,
                         )
                     )
 
@@ -87,31 +117,72 @@ class TaskPlanner:
 
     # ---------------------------------------------------------
 
-    def _missing(self, file_dir: str, fragments: List[FragmentInfo]) -> Tuple[List[FragmentInfo], int, int, int]:
-        missing: List[FragmentInfo] = []
+    def _interleave(self, files: List[FileInfo]) -> List[FileInfo]:
+        """Round-robin over directories, keeping the listing's order within each."""
+        by_dir: Dict[str, List[FileInfo]] = {}
+        for file in files:
+            by_dir.setdefault(file.path, []).append(file)
+        rounds = itertools.zip_longest(*by_dir.values())
+        return [file for batch in rounds for file in batch if file is not None]
+
+    def _output_paths(self, files: List[FileInfo], target_dir: str) -> Dict[str, str]:
+        """file_id → output path, mirroring the remote tree. Same-named files of one folder get a ` (n)` suffix."""
+        paths: Dict[str, str] = {}
+        taken = set()
+        for file in files:
+            output_dir = os.path.join(target_dir, *file.path.split("/")) if file.path else target_dir
+            stem, ext = os.path.splitext(file.name)
+            path = os.path.join(output_dir, file.name)
+            n = 1
+            while os.path.normcase(path) in taken:
+                n += 1
+                path = os.path.join(output_dir, f"{stem} ({n}){ext}")
+            taken.add(os.path.normcase(path))
+            paths[file.id] = path
+        return paths
+
+    def _missing(self, fragments: List[FragmentInfo], done: Dict[int, Tuple[int, int]], fragment_crcs: Dict[int, int]) -> Tuple[List[Tuple[FragmentInfo, int, int]], int, int, int]:
+        """Missing fragments as (fragment, bytes already on disk, their CRC32)"""
+        missing: List[Tuple[FragmentInfo, int, int]] = []
         downloaded_fragments = 0
         downloaded_bytes = 0
         remaining_bytes = 0
 
         for frag in fragments:
-            part_path = os.path.join(file_dir, f"{frag.sequence}.part")
-
-            if os.path.exists(part_path):
-                try:
-                    actual_size = os.path.getsize(part_path)
-                except OSError:
-                    actual_size = -1
-
-                if actual_size == frag.size:
-                    downloaded_fragments += 1
-                    downloaded_bytes += frag.size
-                else:
-                    logger.info(f"[TaskPlanner] .part frag size doesnt match: {actual_size}!={frag.size} removing .part file....")
-                    os.remove(part_path)
-                    missing.append(frag)
-                    remaining_bytes += frag.size
+            have, crc = done.get(frag.sequence, (0, 0))
+            if have == frag.size:
+                fragment_crcs[frag.sequence] = crc
+                downloaded_fragments += 1
+                downloaded_bytes += frag.size
             else:
-                missing.append(frag)
-                remaining_bytes += frag.size
+                if not 0 < have < frag.size:
+                    have, crc = 0, 0
+                missing.append((frag, have, crc))
+                downloaded_bytes += have
+                remaining_bytes += frag.size - have
 
         return missing, downloaded_fragments, downloaded_bytes, remaining_bytes
+
+    def _still_on_disk(self, file: FileInfo, temp_file_dir: str, partial_path: Optional[str]) -> bool:
+        """One cheap check per file (never per fragment) that what the journal points at wasn't deleted meanwhile."""
+        if partial_path is None:
+            return os.path.isdir(temp_file_dir)
+        try:
+            return os.path.getsize(partial_path) == file.size
+        except OSError:
+            return False
+
+    def _journal_path(self, files: List[FileInfo], target_dir: str) -> str:
+        # the same download (same files into the same place) finds its journal again
+        key = hashlib.sha1("\n".join([os.path.abspath(target_dir)] + sorted(file.id for file in files)).encode()).hexdigest()[:20]
+        return os.path.join(self._temp_folder, f"{key}.journal")
+
+    def _preallocate(self, path: str, size: int) -> None:
+        with open(path, "wb") as f:
+            if size <= 0:
+                return
+            try:
+                # reserves real blocks, so out-of-space shows up now and not mid-download
+                os.posix_fallocate(f.fileno(), 0, size)
+            except (AttributeError, OSError):
+                f.truncate(size)
@@ -1,41 +1,87 @@
+import itertools
 import os
 import tempfile
 import threading
-from queue import Queue, Empty
+from queue import Queue, Empty, Full
 from typing import Dict, List, Optional
 
 from .AutoScaler import AutoScaler
+from .DownloadHandle import DownloadHandle, FileHandle
 from .DownloadWorker import DownloadWorker
-from .FinalizeWorker import FinalizeWorker
+from .FileFinalizer import FileFinalizer
+from .FinalizePool import FinalizePool
+from .FragmentScheduler import FragmentScheduler
 from .MetadataFetcher import MetadataFetcher
+from .ParkingLot import ParkingLot
+from .ProgressDispatcher import ProgressDispatcher
+from .RemoteFile import RemoteFile
+from .ResolveWorker import ResolveWorker
+from .StreamServer import StreamServer
 from .TaskPlanner import TaskPlanner
+from .UrlResolver import UrlResolver
 from .state import (
     ThrottleState,
     FragmentTask,
     FileState,
     FileRecord,
-    FileStatus, onCompleteCallback,
+    FileStatus, onCompleteCallback, onProgressCallback,
+    PipelineStats,
+    FinalizeStats,
+    SchedulingPolicy,
+    ScalingDecision,
 )
 from ..Config import APIConfig
 from ..models.Item import Item
+from ..utils.BandwidthLimiter import BandwidthLimiter
+from ..utils.ConcurrencyStore import ConcurrencyStore
+from ..utils.FragmentCache import FragmentCache
+from ..utils.Metrics import MetricsRegistry, MetricsSink
+from ..utils.RetryScheduler import RetryScheduler, RetryPolicy
+from ..utils.TransportPool import TransportPool
 
 
 class UltraDownloader:
-    def __init__(self, max_workers: int):
+    def __init__(self, max_workers: int, direct_write: bool = True, resolver_workers: int = 4, lookahead: int = 32, transport: Optional[TransportPool] = None,
+                 scheduling_policy: SchedulingPolicy = SchedulingPolicy.ROUND_ROBIN, concurrency_store: Optional[ConcurrencyStore] = None,
+                 concurrency_key: Optional[str] = None, retry_policy: Optional[RetryPolicy] = None, fragment_cache: Optional[FragmentCache] = None,
+                 max_finalize_workers: int = 8, bandwidth_limiter: Optional[BandwidthLimiter] = None, metrics: Optional[MetricsSink] = None):
         self._temp_download_folder = os.path.join(tempfile.gettempdir(), "idrive_download")
         os.makedirs(self._temp_download_folder, exist_ok=True)
 
-        self.metadata_fetcher = MetadataFetcher()
-        self.planner = TaskPlanner(self._temp_download_folder)
+        self.transport = transport or TransportPool.default()
+        # per-stage latencies and counters, MetricsSink() turns them off
+        self.metrics = metrics or MetricsRegistry()
+        self.metadata_fetcher = MetadataFetcher(transport=self.transport)
+        self.planner = TaskPlanner(self._temp_download_folder, direct_write=direct_write)
+        # shared by all workers and kept across downloads, so a re-download or resume reuses unexpired urls
+        self.resolver = UrlResolver(max_concurrency=resolver_workers, metrics=self.metrics, transport=self.transport)
+        self.resolver_workers = resolver_workers
+        self.lookahead = lookahead
+        # optional, fragments found there skip both url resolution and transfer
+        self.fragment_cache = fragment_cache
+        # caps all workers at once, unlimited unless given a rate
+        self.bandwidth_limiter = bandwidth_limiter or BandwidthLimiter()
 
         self.throttle = ThrottleState()
-        self.scaler = AutoScaler(max_workers=max_workers, throttle_state=self.throttle)
+        # warm start from the worker count that worked best last time
+        self.concurrency_store = concurrency_store
+        self.concurrency_key = concurrency_key
+        initial_workers = 1
+        on_learned = None
+        if concurrency_store and concurrency_key:
+            initial_workers = concurrency_store.get_workers(concurrency_key) or 1
+            on_learned = self._save_learned_concurrency
+        self.scaler = AutoScaler(max_workers=max_workers, throttle_state=self.throttle, initial_workers=initial_workers, on_learned=on_learned)
 
         self.max_retries = 5
         self.post_workers = 2
+        self.retry_policy = retry_policy or RetryPolicy()
+        self._retries = RetryScheduler()
 
         # Persistent queues
-        self._fragment_queue: Queue[FragmentTask] = Queue()
+        # fragment queue (scheduler) → resolve workers → ready queue (bounded look-ahead, urls attached) → download workers
+        self._fragment_queue = FragmentScheduler(scheduling_policy)
+        self._ready_queue: Queue[FragmentTask] = Queue(maxsize=lookahead)
         self._finalize_queue: Queue[str] = Queue()
 
         # Shared state
@@ -44,12 +90,22 @@ class UltraDownloader:
 
         self._global_pause = threading.Event()
         self._global_pause.set()
+        # tasks of paused files wait here, not in the queues
+        self._parking = ParkingLot(self._global_pause)
 
         self._lock = threading.RLock()
         self._last_error: Optional[Exception] = None
+        self._stream_server: Optional[StreamServer] = None
+        # one thread for the progress callbacks of all files
+        self._progress = ProgressDispatcher()
 
+        self._worker_ids = itertools.count(1)
+        self._retire = threading.Semaphore(0)
+        self._resolve_threads: List[threading.Thread] = []
         self._download_threads: List[threading.Thread] = []
-        self._finalize_threads: List[threading.Thread] = []
+        # grows past `post_workers` while finished files queue up and the disk keeps up
+        self.finalizer = FinalizePool(self._finalize_queue, self._states, self._records, min_workers=self.post_workers, max_workers=max_finalize_workers,
+                                      metrics=self.metrics)
 
         self._start_workers()
 
@@ -65,28 +121,38 @@ class UltraDownloader:
     def _start_workers(self) -> None:
         def spawn_one():
             t = self._start_download_thread()
+            # retired workers leave the list here, so it only ever holds about as many threads as are running
+            self._download_threads = [thread for thread in self._download_threads if thread.is_alive()]
             self._download_threads.append(t)
 
         def kill_one():
-            self._fragment_queue.put(None)
+            # never blocks the autoscaler, unlike a sentinel in the bounded ready queue
+            self._retire.release()
+
+        for _ in range(self.resolver_workers):
+            t = self._start_resolve_thread()
+            self._resolve_threads.append(t)
 
-        # Spawn minimum workers
-        for _ in range(self.scaler.min):
+        # Spawn the starting workers
+        for _ in range(self.scaler.current):
             spawn_one()
 
         # Start autoscaler
         self.scaler.start(spawn_one, kill_one)
 
         # Start finalize workers
-        for _ in range(self.post_workers):
-            t = self._start_finalize_thread()
-            self._finalize_threads.append(t)
+        self.finalizer.start()
 
     # ------------------------------------------------------------------
     # Public API
     # ------------------------------------------------------------------
 
-    def download(self, data: Item, target_dir: str = APIConfig.download_folder, on_complete: onCompleteCallback = None) -> None:
+    def download(self, data: Item, target_dir: str = APIConfig.download_folder, on_complete: onCompleteCallback = None, priority: int = 0,
+                 on_progress: onProgressCallback = None, progress_interval: float = 0.5) -> DownloadHandle:
+        """
+        Queues every file of `data` and returns right away. The handle's futures settle as files finish;
+        `on_progress(file_id, bytes_downloaded, size_total)` is called at most every `progress_interval` seconds per file.
+        """
         files = self.metadata_fetcher.fetch_files(data)
 
         plan_queue, finalize_queue, states, records, size_est = self.planner.prepare(files, target_dir, on_complete)
@@ -96,10 +162,16 @@ class UltraDownloader:
 
             for fid, st in states.items():
                 self._states[fid] = st
+                self._track(fid, st)
 
             for fid, rec in records.items():
                 self._records[fid] = rec
 
+        for fid in states:
+            self._fragment_queue.set_priority(fid, priority)
+
+        handle = self._handle(states, on_progress, progress_interval)
+
         # enqueue finalize tasks (already completed files)
         while True:
             try:
@@ -116,6 +188,26 @@ class UltraDownloader:
                 break
             self._fragment_queue.put(task)
 
+        return handle
+
+    def open(self, file: Item, read_ahead: int = 4, cache_fragments: int = 16) -> RemoteFile:
+        """
+        Seekable, read-only file object over a remote file, served from the CDN without downloading it to disk.
+        The next `read_ahead` fragments are fetched in parallel with the one being read.
+        """
+        files = self.metadata_fetcher.fetch_files(file)
+        if len(files) != 1:
+            raise ValueError(f"{file} is not a single file")
+        return RemoteFile(files[0], self.resolver, self.transport, read_ahead=read_ahead, cache_fragments=cache_fragments,
+                          max_retries=self.max_retries, retry_policy=self.retry_policy, fragment_cache=self.fragment_cache)
+
+    def stream_url(self, file: Item) -> str:
+        """Localhost url serving the decrypted file with `Range` support, for players and tools like ffmpeg or VLC."""
+        with self._lock:
+            if self._stream_server is None:
+                self._stream_server = StreamServer(self.resolver, self.transport, self.metadata_fetcher, fragment_cache=self.fragment_cache)
+        return self._stream_server.url_for(file)
+
     # ------------------------------------------------------------------
     # State querying
     # ------------------------------------------------------------------
@@ -123,6 +215,10 @@ class UltraDownloader:
     def get_file_state(self, file_id: str) -> FileState:
         return self._states[file_id]
 
+    def get_file_handle(self, file_id: str) -> FileHandle:
+        """Future / progress handle of a file queued by an earlier `download()`."""
+        return FileHandle(file_id, self._records[file_id].file_info.name, self._states[file_id], self.cancel_file, self._progress)
+
     def get_all_states(self) -> Dict[str, FileState]:
         return dict(self._states)
 
@@ -132,26 +228,81 @@ class UltraDownloader:
     def get_download_rate(self) -> float:
         return self.throttle.download_rate()
 
+    def get_file_rate(self, file_id: str) -> float:
+        return self.throttle.file_rate(file_id)
+
+    def get_scaling_history(self) -> List[ScalingDecision]:
+        """The autoscaler's decisions over time, oldest first."""
+        return self.scaler.get_history()
+
+    def get_worker_rates(self) -> Dict[str, float]:
+        """Bytes/sec per download thread, by thread name."""
+        return self.throttle.worker_rates()
+
+    def get_cache_stats(self) -> Dict[str, int]:
+        """Hits, misses, bytes saved and stored of the fragment cache (shared, so counting other users of it in this process too)."""
+        return self.fragment_cache.stats() if self.fragment_cache else {}
+
+    def get_metrics(self) -> Dict[str, Dict[str, dict]]:
+        """
+        Snapshot of the per-stage latency histograms (resolve, queue_wait, ready_wait, ttfb, transfer, decrypt, crc, write,
+        merge, verify, commit, move, cleanup) and counters (bytes, fragments, errors). Empty with a custom MetricsSink.
+        """
+        return self.metrics.snapshot(prefix="download_") if isinstance(self.metrics, MetricsRegistry) else {}
+
+    def get_finalize_stats(self) -> FinalizeStats:
+        """Finalize queue depth, worker count, disk throughput and time spent per stage."""
+        return self.finalizer.stats()
+
     def get_last_error(self) -> Optional[Exception]:
         return self._last_error
 
+    def get_pipeline_stats(self) -> PipelineStats:
+        latency_avg, latency_p95 = self.resolver.latency_stats()
+        return PipelineStats(
+            resolve_queue=self._fragment_queue.qsize(),
+            ready_queue=self._ready_queue.qsize(),
+            lookahead=self.lookahead,
+            resolver_workers=self.resolver_workers,
+            resolve_latency_avg=latency_avg,
+            resolve_latency_p95=latency_p95,
+            cached_urls=self.resolver.cached_count(),
+        )
+
+    # ------------------------------------------------------------------
+    # Scheduling
+    # ------------------------------------------------------------------
+
+    def set_scheduling_policy(self, policy: SchedulingPolicy) -> None:
+        """Takes effect immediately, including for fragments already queued."""
+        self._fragment_queue.set_policy(policy)
+
+    def set_file_priority(self, file_id: str, priority: int) -> None:
+        """Higher goes first, used by the PRIORITY and SEQUENTIAL policies."""
+        state = self._states.get(file_id)
+        if state is not None and state.future.done():
+            # nothing left to schedule, and the scheduler already forgot it
+            return
+        self._fragment_queue.set_priority(file_id, priority)
+
     # ------------------------------------------------------------------
     # Global pause / resume
     # ------------------------------------------------------------------
 
     def pause_all(self) -> None:
-        self._global_pause.clear()
+        self._parking.pause_all()
         for st in self._states.values():
             with st.lock:
                 if st.status == FileStatus.DOWNLOADING:
                     st.status = FileStatus.PAUSED
 
     def resume_all(self) -> None:
-        self._global_pause.set()
+        released = self._parking.resume_all(self._states)
         for st in self._states.values():
             with st.lock:
-                if st.status == FileStatus.PAUSED and not st.cancelled:
+                if st.status == FileStatus.PAUSED and not st.cancelled and st.pause_event.is_set():
                     st.status = FileStatus.DOWNLOADING
+        self._requeue(released)
 
     # ------------------------------------------------------------------
     # Per-file control
@@ -159,15 +310,15 @@ class UltraDownloader:
 
     def pause_file(self, file_id: str) -> None:
         st = self._states[file_id]
+        self._parking.pause_file(st)
         with st.lock:
-            st.pause_event.clear()
             if st.status == FileStatus.DOWNLOADING:
                 st.status = FileStatus.PAUSED
 
     def resume_file(self, file_id: str) -> None:
         st = self._states[file_id]
+        released = self._parking.resume_file(file_id, st)
         with st.lock:
-            st.pause_event.set()
             if (
                 st.status == FileStatus.PAUSED
                 and not st.cancelled
@@ -175,19 +326,52 @@ class UltraDownloader:
                 and st.fragments_downloaded < st.fragments_total
             ):
                 st.status = FileStatus.DOWNLOADING
+        self._requeue(released)
 
     def cancel_file(self, file_id: str) -> None:
         st = self._states[file_id]
-        with st.lock:
-            st.cancelled = True
-            st.status = FileStatus.CANCELLED
+        st.finish(FileStatus.CANCELLED)
+        self._parking.discard(file_id)
+        # otherwise the last fragment still being written does this
+        if st.discard_due():
+            FileFinalizer.discard(self._records[file_id])
+
+    def _handle(self, states: Dict[str, FileState], on_progress: onProgressCallback, progress_interval: float) -> DownloadHandle:
+        handle = DownloadHandle({fid: self.get_file_handle(fid) for fid in states})
+        if on_progress is not None:
+            handle.on_progress(on_progress, progress_interval)
+        return handle
+
+    def _track(self, file_id: str, state: FileState) -> None:
+        # per-file bookkeeping lives as long as the file isn't finished, whichever way it ends
+        self.throttle.track_file(file_id)
+        state.future.add_done_callback(lambda _: self._forget(file_id))
+
+    def _forget(self, file_id: str) -> None:
+        self.throttle.forget_file(file_id)
+        self._fragment_queue.forget_file(file_id)
+
+    def _requeue(self, tasks: List[FragmentTask]) -> None:
+        # back through the resolve stage, the url may have expired while paused
+        for task in tasks:
+            self._fragment_queue.put(task)
 
     # ------------------------------------------------------------------
     # Worker helpers
     # ------------------------------------------------------------------
 
+    def _save_learned_concurrency(self, workers: int, throughput: float, throttled: bool) -> None:
+        self.concurrency_store.record(self.concurrency_key, workers, throughput, throttled)
+
+    def _start_resolve_thread(self) -> threading.Thread:
+        worker = ResolveWorker(self._fragment_queue, self._ready_queue, self._states, self.resolver, self._parking, self.fragment_cache, self.metrics)
+        t = threading.Thread(target=worker.run, daemon=True)
+        t.start()
+        return t
+
     def _start_download_thread(self) -> threading.Thread:
         worker = DownloadWorker(
+            self._ready_queue,
             self._fragment_queue,
             self._finalize_queue,
             self._states,
@@ -195,14 +379,17 @@ class UltraDownloader:
             self.max_retries,
             self.throttle,
             self._global_pause,
+            self._parking,
+            self.resolver,
+            self.transport,
+            self._retire,
+            self._retries,
+            self.retry_policy,
+            self.fragment_cache,
+            self.bandwidth_limiter,
+            self.metrics,
         )
-        t = threading.Thread(target=worker.run, daemon=True)
-        t.start()
-        return t
-
-    def _start_finalize_thread(self) -> threading.Thread:
-        worker = FinalizeWorker(self._finalize_queue, self._states, self._records)
-        t = threading.Thread(target=worker.run, daemon=True)
+        t = threading.Thread(target=worker.run, name=f"iDriveDownloadWorker-{next(self._worker_ids)}", daemon=True)
         t.start()
         return t
 
@@ -211,14 +398,39 @@ class UltraDownloader:
     # ------------------------------------------------------------------
 
     def shutdown(self) -> None:
-        for _ in self._download_threads:
+        self._retries.shutdown()
+        if self._stream_server is not None:
+            self._stream_server.stop()
+
+        # no more spawning or retiring while the workers are stopped
+        self.scaler.stop()
+
+        for _ in self._resolve_threads:
             self._fragment_queue.put(None)
-        for t in self._download_threads:
+        for t in self._resolve_threads:
             t.join()
 
-        for _ in self._finalize_threads:
-            self._finalize_queue.put(None)
-        for t in self._finalize_threads:
-            t.join()
+        self._stop_download_threads()
 
-        self.scaler.stop()
+        self.finalizer.shutdown()
+
+        self.scaler.report_learned()
+        self.resolver.shutdown()
+
+    def _stop_download_threads(self) -> None:
+        # cancel retirements not picked up yet, every live worker now exits on its sentinel
+        while self._retire.acquire(blocking=False):
+            pass
+
+        threads = [t for t in self._download_threads if t.is_alive()]
+        for _ in threads:
+            # the ready queue is bounded: don't block on a sentinel no worker is left to take
+            while any(t.is_alive() for t in threads):
+                try:
+                    self._ready_queue.put(None, timeout=0.1)
+                    break
+                except Full:
+                    continue
+        for t in threads:
+            t.join()
+        self._download_threads = []
@@ -0,0 +1,130 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+from ..utils.Metrics import MetricsSink
+from ..utils.TransportPool import TransportPool
+from ..utils.networker import make_request
+
+logger = logging.getLogger("iDrive")
+
+
+class UrlResolver:
+    """
+    Resolves attachment ids into signed CDN urls and caches them until they expire.
+
+    The API only resolves one attachment per call, so lookups run on a small thread pool, kept busy by the
+    resolve stage's workers (or the async downloader's streams). Concurrent lookups of the same id share one request.
+    """
+
+    def __init__(self, max_concurrency: int = 8, max_entries: int = 200_000, default_ttl: float = 600.0, expiry_margin: float = 60.0,
+                 metrics: Optional[MetricsSink] = None, transport: Optional[TransportPool] = None):
+        self.max_entries = max_entries
+        self.transport = transport
+        self.metrics = metrics or MetricsSink()
+        self.default_ttl = default_ttl
+        self.expiry_margin = expiry_margin
+
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()  # attachment_id → (url, expires_at)
+        self._in_flight: Dict[str, Future] = {}
+        self._latencies: "deque[float]" = deque(maxlen=512)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="iDriveUrlResolver")
+
+    # ------------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------------
+
+    def resolve(self, attachment_id: str, password: Optional[str] = None) -> str:
+        url = self.get_cached(attachment_id)
+        if url is not None:
+            return url
+        return self._submit(attachment_id, password).result()
+
+    def resolve_future(self, attachment_id: str, password: Optional[str] = None) -> Future:
+        """Non-blocking `resolve`, for callers that can't park a thread (e.g. asyncio via `asyncio.wrap_future`)."""
+        url = self.get_cached(attachment_id)
+        if url is not None:
+            future = Future()
+            future.set_result(url)
+            return future
+        return self._submit(attachment_id, password)
+
+    def get_cached(self, attachment_id: str) -> Optional[str]:
+        with self._lock:
+            entry = self._cache.get(attachment_id)
+            if entry is None:
+                return None
+            url, expires_at = entry
+            if time.time() >= expires_at - self.expiry_margin:
+                del self._cache[attachment_id]
+                return None
+            self._cache.move_to_end(attachment_id)
+            return url
+
+    def invalidate(self, attachment_id: str) -> None:
+        with self._lock:
+            self._cache.pop(attachment_id, None)
+
+    def latency_stats(self) -> Tuple[float, float]:
+        """(average, p95) seconds of the most recent API lookups"""
+        with self._lock:
+            samples = sorted(self._latencies)
+        if not samples:
+            return 0.0, 0.0
+        return sum(samples) / len(samples), samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+    def cached_count(self) -> int:
+        return len(self._cache)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    # ------------------------------------------------------------------
+    # Internals
+    # ------------------------------------------------------------------
+
+    def _submit(self, attachment_id: str, password: Optional[str]) -> Future:
+        with self._lock:
+            future = self._in_flight.get(attachment_id)
+            if future is None:
+                future = self._executor.submit(self._fetch, attachment_id, password)
+                self._in_flight[attachment_id] = future
+            return future
+
+    def _fetch(self, attachment_id: str, password: Optional[str]) -> str:
+        try:
+            started = time.monotonic()
+            response_data = make_request("GET", f"items/ultraDownload/attachments/{attachment_id}", headers={"x-resource-password": password}, transport=self.transport)
+            url = response_data["url"]
+            latency = time.monotonic() - started
+            with self._lock:
+                self._latencies.append(latency)
+            self.metrics.observe("download_stage_seconds", latency, stage="resolve")
+            self._store(attachment_id, url)
+            return url
+        finally:
+            with self._lock:
+                self._in_flight.pop(attachment_id, None)
+
+    def _store(self, attachment_id: str, url: str) -> None:
+        expires_at = self._expiry_of(url)
+        with self._lock:
+            self._cache[attachment_id] = (url, expires_at)
+            self._cache.move_to_end(attachment_id)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def _expiry_of(self, url: str) -> float:
+        # Discord signed urls carry their expiry as a hex unix timestamp in `ex`
+        ex = parse_qs(urlparse(url).query).get("ex")
+        if ex:
+            try:
+                return float(int(ex[0], 16))
+            except ValueError:
+                pass
+        return time.time() + self.default_ttl
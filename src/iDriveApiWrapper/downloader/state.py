@@ -1,11 +1,19 @@
+import base64
 import threading
 import time
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
 from dataclasses import dataclass, field
 from enum import Enum
-from typing import Optional, List, Union, Callable
+from typing import BinaryIO, Optional, List, Union, Callable, Dict, TYPE_CHECKING
 
+from src.iDriveApiWrapper.downloader.Decryptor import Decryptor
+from src.iDriveApiWrapper.exceptions import DownloadFailedError
 from src.iDriveApiWrapper.models.Enums import EncryptionMethod
 
+if TYPE_CHECKING:
+    from .DownloadJournal import DownloadJournal
+
 
 @dataclass
 class FragmentInfo:
@@ -27,6 +35,8 @@ class FileInfo:
     key: Optional[str] = None
     iv: Optional[str] = None
     fragments: List[FragmentInfo] = field(default_factory=list)
+    # directory relative to the downloaded folder, "/" separated ("" at its top level)
+    path: str = ""
 
     def __str__(self):
         return (
@@ -38,6 +48,11 @@ class FileInfo:
 
     __repr__ = __str__
 
+    def create_decryptor(self, start_byte: int = 0) -> Decryptor:
+        if self.encryption_method == EncryptionMethod.Not_Encrypted:
+            return Decryptor(self.encryption_method, None)
+        return Decryptor(self.encryption_method, base64.b64decode(self.key), base64.b64decode(self.iv), start_byte=start_byte)
+
     @staticmethod
     def convert(data: Union[list, dict]) -> List["FileInfo"]:
         result = []
@@ -65,6 +80,18 @@ class FragmentTask:
     fragment: FragmentInfo
     file_password: Optional[str]
     retries: int = 0
+    network_retries: int = 0
+    # bytes of the fragment already on disk (and their CRC32) from an interrupted attempt
+    resume_from: int = 0
+    resume_crc: int = 0
+    # how much of `resume_from` this session already fed to the throughput meters
+    resume_signaled: int = 0
+    # signed CDN url, filled in by the resolve stage
+    url: Optional[str] = None
+    # or the fragment's fragment cache entry, opened by the resolve stage
+    cached: Optional[BinaryIO] = None
+    # monotonic time it entered its current queue, for the queue wait metrics
+    queued_at: float = 0.0
 
 
 class FileStatus(Enum):
@@ -79,6 +106,13 @@ class FileStatus(Enum):
     QUEUED = "queued"
 
 
+class SchedulingPolicy(Enum):
+    FIFO = "fifo"                # files in the order they were queued
+    ROUND_ROBIN = "round_robin"  # one fragment per file in turn
+    PRIORITY = "priority"        # highest priority file first, then queue order
+    SEQUENTIAL = "sequential"    # like PRIORITY, but fragments strictly in sequence (retries too) so a file's prefix lands first
+
+
 @dataclass
 class FileState:
     fragments_total: int
@@ -90,13 +124,111 @@ class FileState:
     status: FileStatus = FileStatus.QUEUED
     pause_event: threading.Event = field(default_factory=threading.Event)
     cancelled: bool = False
+    # sequence → CRC32 of the fragment's plaintext, computed while streaming
+    fragment_crcs: Dict[int, int] = field(default_factory=dict)
+    # settles once the file reaches a terminal status: this state, the error, or cancelled
+    future: Future = field(default_factory=Future, repr=False, compare=False)
+    # fragments being written (or the file being finalized) right now; a cancelled file is discarded after the last one
+    writers: int = 0
+    discarded: bool = False
 
     def __post_init__(self):
         # By default files are not paused
         self.pause_event.set()
 
+    def finish(self, status: FileStatus, error: Optional[Exception] = None) -> None:
+        """
+        Moves the file to a terminal status and settles `future`. Takes `lock` itself, don't hold it.
+        A file that already finished stays as it is, so `status` and `future` never disagree.
+        """
+        with self.lock:
+            # the future is checked too: a file found complete on disk is COMPLETED before it got finalized
+            if self.status in (FileStatus.COMPLETED, FileStatus.FAILED, FileStatus.CANCELLED) and self.future.done():
+                return
+            if error is not None:
+                self.error = error
+            if status == FileStatus.CANCELLED:
+                self.cancelled = True
+            self.status = status
+            error = self.error
+
+        # outside the lock: done callbacks run right here and may well read this state
+        try:
+            if status == FileStatus.COMPLETED:
+                self.future.set_result(self)
+            elif status == FileStatus.CANCELLED:
+                self.future.cancel()
+            else:
+                self.future.set_exception(error or DownloadFailedError(f"Download ended as {status.value}"))
+        except InvalidStateError:
+            # already settled, e.g. cancelled through the future
+            pass
+
+    def writer_started(self) -> bool:
+        """Registers a writer; False if the file got cancelled, then nothing may be written."""
+        with self.lock:
+            if self.cancelled:
+                return False
+            self.writers += 1
+            return True
+
+    def writer_stopped(self) -> bool:
+        """True if the file got cancelled and this was its last writer: its leftovers are the caller's to discard."""
+        with self.lock:
+            self.writers -= 1
+            return self._claim_discard()
+
+    def discard_due(self) -> bool:
+        """True once for a cancelled file no writer touches anymore: its leftovers are the caller's to discard."""
+        with self.lock:
+            return self._claim_discard()
+
+    def _claim_discard(self) -> bool:
+        if self.cancelled and not self.writers and not self.discarded:
+            self.discarded = True
+            return True
+        return False
+
+
+@dataclass
+class PipelineStats:
+    resolve_queue: int
+    ready_queue: int
+    lookahead: int
+    resolver_workers: int
+    resolve_latency_avg: float
+    resolve_latency_p95: float
+    cached_urls: int
+
+
+@dataclass
+class FinalizeStats:
+    queue_depth: int
+    workers: int
+    files_finalized: int
+    bytes_finalized: int
+    disk_throughput: float            # bytes/sec merged or read back over the last seconds
+    stage_seconds: Dict[str, float]   # stage → total seconds ("merge", "verify", "commit", "move", "cleanup")
+    stage_averages: Dict[str, float]  # stage → seconds per file
+
+
+@dataclass
+class ScalingDecision:
+    timestamp: float
+    phase: str             # "slow_start" / "avoidance"
+    action: str            # "increase" / "decrease" / "hold"
+    reason: str
+    workers: int
+    target: float
+    throughput: float      # bytes/sec since the previous decision
+    per_connection: float  # throughput / workers
+    ttfb: Optional[float]
+    errors: int            # hard throttling events since the previous decision
+
 
 onCompleteCallback = Optional[Callable[[str, FileState], None]]
+# file_id, bytes downloaded, total bytes
+onProgressCallback = Optional[Callable[[str, int, int], None]]
 
 
 @dataclass
@@ -107,6 +239,52 @@ class FileRecord:
     output_dir: str
     output_path: str
     on_complete: onCompleteCallback
+    # direct-write mode: fragments go straight into a preallocated `partial_path`
+    direct_write: bool = False
+    partial_path: Optional[str] = None
+    # completed fragments of the whole download batch, shared by its files
+    journal: Optional["DownloadJournal"] = None
+
+
+class RateMeter:
+    """
+    Sliding-window counter over a ring of fixed time buckets: `add` is O(1), `rate` / `total` are
+    O(buckets). Each meter has its own lock, so meters never contend with each other.
+    """
+
+    def __init__(self, window: float = 10.0, bucket: float = 0.5):
+        self.window = window
+        self.bucket = bucket
+        self._size = max(1, int(round(window / bucket)))
+        self._slots = [0] * self._size
+        self._epochs = [-1] * self._size  # which bucket index each slot currently holds
+        self._started = time.monotonic()
+        self.lifetime_total = 0
+        self._lock = threading.Lock()
+
+    def add(self, amount: int = 1) -> None:
+        idx = int(time.monotonic() / self.bucket)
+        slot = idx % self._size
+        with self._lock:
+            if self._epochs[slot] != idx:
+                self._epochs[slot] = idx
+                self._slots[slot] = 0
+            self._slots[slot] += amount
+            self.lifetime_total += amount
+
+    def total(self) -> int:
+        """Sum over the window."""
+        idx = int(time.monotonic() / self.bucket)
+        oldest = idx - self._size
+        return sum(value for value, epoch in zip(self._slots, self._epochs) if epoch > oldest)
+
+    def rate(self) -> float:
+        """Per second, averaged over the window (or over the meter's lifetime while it's younger than that)."""
+        now = time.monotonic()
+        current_start = int(now / self.bucket) * self.bucket
+        covered = (self._size - 1) * self.bucket + (now - current_start)
+        duration = max(min(covered, now - self._started), 0.001)
+        return self.total() / duration
 
 
 class ThrottleState:
@@ -115,70 +293,117 @@ class ThrottleState:
         self.window = window  # lookback window (seconds)
 
         # hard throttling (429, 503, etc.)
-        self._hard_events = []  # [timestamp]
+        self._errors = RateMeter(window)
 
-        # download throughput
-        self._byte_events = []  # [(timestamp, bytes)]
+        # download throughput, overall and broken down per file / per worker
+        self._bytes = RateMeter(window)
+        self._file_meters: Dict[str, RateMeter] = {}
+        self._worker_meters: Dict[str, RateMeter] = {}
+
+        # time to first byte of recent fragment requests
+        self._ttfb: "deque[float]" = deque(maxlen=64)
 
     # ---------------------------
     # hard errors (429 / 503)
     # ---------------------------
 
     def signal_error(self) -> None:
-        now = time.time()
-        with self.lock:
-            self._hard_events.append(now)
-            self._prune_times(self._hard_events, now)
+        self._errors.add()
 
     def error_rate(self) -> int:
         """How many hard throttling events in last window."""
-        now = time.time()
-        with self.lock:
-            self._prune_times(self._hard_events, now)
-            return len(self._hard_events)
+        return self._errors.total()
+
+    def errors_total(self) -> int:
+        """Hard throttling events since creation."""
+        return self._errors.lifetime_total
 
     # ---------------------------
     # throughput
     # ---------------------------
 
-    def signal_bytes(self, byte_count: int) -> None:
+    def signal_bytes(self, byte_count: int, file_id: Optional[str] = None, worker: Optional[str] = None) -> None:
         """Record bytes downloaded by *any* worker."""
         if byte_count <= 0:
             return
-        now = time.time()
-        with self.lock:
-            self._byte_events.append((now, byte_count))
-            self._prune_bytes(now)
+        self._bytes.add(byte_count)
+        if file_id is not None:
+            # only files between track_file and forget_file, late bytes of a finished one don't bring its meter back
+            meter = self._file_meters.get(file_id)
+            if meter is not None:
+                meter.add(byte_count)
+        if worker is not None:
+            self._meter(self._worker_meters, worker).add(byte_count)
+
+    def retract_bytes(self, byte_count: int, file_id: Optional[str] = None) -> None:
+        """Takes back bytes signalled earlier that are about to be downloaded (and signalled) again."""
+        if byte_count <= 0:
+            return
+        self._bytes.add(-byte_count)
+        if file_id is not None:
+            meter = self._file_meters.get(file_id)
+            if meter is not None:
+                meter.add(-byte_count)
 
     def download_rate(self) -> float:
         """
         Bytes/sec averaged over the window.
         """
-        now = time.time()
-        with self.lock:
-            self._prune_bytes(now)
-            if not self._byte_events:
-                return 0.0
+        return self._bytes.rate()
+
+    def bytes_total(self) -> int:
+        """Bytes since creation."""
+        return self._bytes.lifetime_total
+
+    # ---------------------------
+    # latency
+    # ---------------------------
+
+    def signal_ttfb(self, seconds: float) -> None:
+        self._ttfb.append(seconds)
+
+    def ttfb(self) -> Optional[float]:
+        """Median time to first byte of the most recent fragment requests."""
+        samples = sorted(self._ttfb)
+        if not samples:
+            return None
+        return samples[len(samples) // 2]
+
+    # ---------------------------
+    # per file / per worker
+    # ---------------------------
+
+    def file_rate(self, file_id: str) -> float:
+        meter = self._file_meters.get(file_id)
+        return meter.rate() if meter else 0.0
+
+    def worker_rate(self, worker: str) -> float:
+        meter = self._worker_meters.get(worker)
+        return meter.rate() if meter else 0.0
+
+    def file_rates(self) -> Dict[str, float]:
+        return {file_id: meter.rate() for file_id, meter in list(self._file_meters.items())}
+
+    def worker_rates(self) -> Dict[str, float]:
+        return {worker: meter.rate() for worker, meter in list(self._worker_meters.items())}
+
+    def track_file(self, file_id: str) -> None:
+        """Starts a per-file meter; `forget_file` drops it once the file finished, so they don't pile up."""
+        self._meter(self._file_meters, file_id)
+
+    def forget_file(self, file_id: str) -> None:
+        self._file_meters.pop(file_id, None)
 
-            total_bytes = sum(b for _, b in self._byte_events)
-            first_ts = self._byte_events[0][0]
-            duration = max(now - first_ts, 0.001)
-            return total_bytes / duration
+    def forget_worker(self, worker: str) -> None:
+        self._worker_meters.pop(worker, None)
 
     # ---------------------------
     # helpers
     # ---------------------------
 
-    def _prune_times(self, arr, now: float) -> None:
-        cutoff = now - self.window
-        i = 0
-        for t in arr:
-            if t >= cutoff:
-                break
-            i += 1
-        if i:
-            del arr[:i]
-
-    def _prune_bytes(self, now: float) -> None:
-        cutoff = now - self.window
-        self._byte_events = [(t, b) for (t, b) in self._byte_events if t >= cutoff]
+    def _meter(self, meters: Dict[str, RateMeter], key: str) -> RateMeter:
+        meter = meters.get(key)
+        if meter is None:
+            with self.lock:
+                meter = meters.setdefault(key, RateMeter(self.window))
+        return meter
@@ -1,4 +1,5 @@
-import time
+import threading
+from concurrent.futures import wait
 
 from tqdm import tqdm
 
@@ -7,37 +8,29 @@ from src.iDriveApiWrapper.downloader.state import FileStatus
 
 
 def watch_file_download(downloader: UltraDownloader, file_id: str, poll_interval: float = 0.2) -> None:
-    state = downloader.get_file_state(file_id)
-
-    total = state.size_total
-    initial = state.bytes_downloaded
+    handle = downloader.get_file_handle(file_id)
+    state = handle.state
 
     with tqdm(
-        total=total,
-        initial=initial,
+        total=state.size_total,
+        initial=state.bytes_downloaded,
         unit="B",
         unit_scale=True,
         unit_divisor=1024,
         desc=f"Downloading {file_id}",
     ) as bar:
 
-        last_bytes = initial
-
-        while True:
-            downloaded = state.bytes_downloaded
-            delta = downloaded - last_bytes
-            if delta > 0:
-                bar.update(delta)
-                last_bytes = downloaded
+        lock = threading.Lock()
 
-            if state.status in (
-                FileStatus.COMPLETED,
-                FileStatus.FAILED,
-                FileStatus.CANCELLED,
-            ):
-                break
+        def advance(downloaded: int) -> None:
+            with lock:
+                if downloaded > bar.n:
+                    bar.update(downloaded - bar.n)
 
-            time.sleep(poll_interval)
+        # pushed by the downloader's progress thread, at most every `poll_interval`
+        handle.on_progress(lambda _, downloaded, __: advance(downloaded), poll_interval)
+        wait([handle.future])
+        advance(state.bytes_downloaded)
 
     if state.status == FileStatus.FAILED:
         raise RuntimeError(f"Download failed for file {file_id}: {state.error}")
@@ -73,9 +73,9 @@ class RateLimitError(HttpError):
     def __init__(self, response):
         header_wait = response.headers.get("Retry-After")
 
-        if header_wait and header_wait.isdigit():
-            self.wait = int(header_wait)
-        else:
+        try:
+            self.wait = float(header_wait)
+        except (TypeError, ValueError):
             self.wait = 2.0
 
         msg = (
@@ -111,3 +111,6 @@ class PathDoesntExistError(IDriveException):
 
 class CrcIntegrityError(IDriveException):
     """Raised when CRC mismatch"""
+
+class DownloadFailedError(IDriveException):
+    """Raised when a download fails without a more specific error"""
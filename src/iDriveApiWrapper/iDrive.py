@@ -1,7 +1,8 @@
 import logging
-from typing import Union, List
+from typing import Union, List, Optional
 
 from .Config import APIConfig
+from .downloader.AsyncUltraDownloader import AsyncUltraDownloader
 from .downloader.UltraDownloader import UltraDownloader
 from .exceptions import UnauthorizedError, ResourceNotFoundError
 from .models.DiscordSettings import DiscordSettings
@@ -14,6 +15,11 @@ from .models.UserProfile import UserProfile
 from .uploader.UltraUploader import UltraUploader
 from .utils import common
 from .utils.AuthClient import AuthClient
+from .utils.BandwidthLimiter import BandwidthLimiter
+from .utils.ConcurrencyStore import ConcurrencyStore
+from .utils.FragmentCache import FragmentCache
+from .utils.Metrics import MetricsRegistry, MetricsSink
+from .utils.TransportPool import TransportPool
 from .utils.WebsocketManager import WebsocketManager
 from .utils.networker import make_request
 
@@ -34,10 +40,23 @@ logger.addHandler(console_handler)
 
 
 class Client:
-    def __init__(self, token: str, device_id: str):
+    def __init__(self, token: str, device_id: str, transport: Optional[TransportPool] = None, fragment_cache: Optional[FragmentCache] = None,
+                 bandwidth_limiter: Optional[BandwidthLimiter] = None, metrics: Optional[MetricsSink] = None,
+                 concurrency_store: Optional[ConcurrencyStore] = ConcurrencyStore()):
         APIConfig.token = token
         APIConfig.device_id = device_id
+        # one connection pool for the client's API calls, the downloaders and the uploader, handed to each of them
+        self.transport = transport or TransportPool.default()
+        # learned worker counts, reused by the next session; None disables it
+        self.concurrency_store = concurrency_store
+        # optional on-disk cache of downloaded fragments, e.g. FragmentCache(max_bytes=50 * 1024 ** 3)
+        self.fragment_cache = fragment_cache
+        # one cap for the downloaders and the uploader, set e.g. with client.bandwidth_limiter.set_rate(20 * 1024 ** 2)
+        self.bandwidth_limiter = bandwidth_limiter or BandwidthLimiter()
+        # per-stage latencies of all transfers, client.metrics.to_prometheus() for a scrape endpoint
+        self.metrics = metrics or MetricsRegistry()
         self._ultraDownloader = None
+        self._async_downloader = None
         self._ultra_uploader = None
         self.websocket = WebsocketManager()
 
@@ -61,11 +80,11 @@ class Client:
         return Folder(self.get_user_profile().user.root)
 
     def search(self, query: str, files: bool = True, folders: bool = True, type: str = "", extension: str = "", max_results: int = 50) -> ItemsList:
-        data = make_request("GET", "search", params={"query": query, "files": files, "folder": folders, "type": type, "extension": extension, "resultsLimit": max_results})
+        data = make_request("GET", "search", params={"query": query, "files": files, "folder": folders, "type": type, "extension": extension, "resultsLimit": max_results}, transport=self.transport)
         return Folder._parse_children(None, data)
 
     def get_trash(self) -> Union[List[Union[Folder, File]], None]:
-        data = make_request("GET", "trash")
+        data = make_request("GET", "trash", transport=self.transport)
         data = data['trash']
         return Folder._parse_children(None, data)
 
@@ -110,7 +129,7 @@ class Client:
         return Share(token)
 
     def get_shares(self) -> List[Share]:
-        data = make_request("GET", "shares")
+        data = make_request("GET", "shares", transport=self.transport)
         shares = []
         for share_dict in data:
             share = Share(share_dict['token'])
@@ -119,7 +138,7 @@ class Client:
         return shares
 
     def create_share(self) -> Share:
-        data = make_request("GET", "shares")
+        data = make_request("GET", "shares", transport=self.transport)
 
     def get_user_profile(self) -> UserProfile:
         return UserProfile.fetch()
@@ -130,17 +149,37 @@ class Client:
     def get_downloader(self) -> UltraDownloader:
         if not self._ultraDownloader:
             discord_settings = self.get_discord_settings()
-            self._ultraDownloader = UltraDownloader(max_workers=len(discord_settings.bots)*2)
+            bots = len(discord_settings.bots)
+            account = ConcurrencyStore.account_id(APIConfig.token)
+            self._ultraDownloader = UltraDownloader(
+                max_workers=bots*2,
+                transport=self.transport,
+                concurrency_store=self.concurrency_store,
+                concurrency_key=ConcurrencyStore.make_key("download", account, bots),
+                fragment_cache=self.fragment_cache,
+                bandwidth_limiter=self.bandwidth_limiter,
+                metrics=self.metrics,
+            )
 
         return self._ultraDownloader
 
+    def get_async_downloader(self, max_concurrency: int = 200) -> AsyncUltraDownloader:
+        if not self._async_downloader:
+            self._async_downloader = AsyncUltraDownloader(max_concurrency=max_concurrency, transport=self.transport, fragment_cache=self.fragment_cache,
+                                                          bandwidth_limiter=self.bandwidth_limiter, metrics=self.metrics)
+
+        return self._async_downloader
+
     def get_uploader(self) -> UltraUploader:
         if not self._ultra_uploader:
             user_settings = self.get_user_profile()
             self._ultra_uploader = UltraUploader(
                 max_message_size=user_settings.user.maxDiscordMessageSize,
                 max_attachments=user_settings.user.maxAttachmentsPerMessage,
-                encryption_method=user_settings.settings.encryptionMethod
+                encryption_method=user_settings.settings.encryptionMethod,
+                transport=self.transport,
+                bandwidth_limiter=self.bandwidth_limiter,
+                metrics=self.metrics,
             )
 
         return self._ultra_uploader
@@ -153,7 +192,7 @@ class Client:
 
     def check_attachment(self, attachment_id: str) -> bool:
         try:
-            make_request("GET", f"cleanup/{attachment_id}")
+            make_request("GET", f"cleanup/{attachment_id}", transport=self.transport)
             return True
         except ResourceNotFoundError:
             return False
@@ -1,5 +1,5 @@
 import logging
-import os
+import subprocess
 from typing import Optional
 
 from overrides import overrides
@@ -217,7 +217,9 @@ class File(Item):
     def play(self):
         if self.type != "video":
             raise ValueError("File is not a video")
-        os.system(f"ffplay -i {self.download_url}")
+        # imported here, the downloader package imports the models
+        from ..downloader.StreamServer import StreamServer
+        subprocess.run(["ffplay", "-i", StreamServer.default().url_for(self)])
 
     def _fetch_secrets(self):
         data = make_request("GET", f"file/secrets/{self.id}", headers=self._get_password_header())
@@ -1,8 +1,10 @@
+import time
 import uuid
 from queue import Queue
-from typing import Iterator, Callable
+from typing import Iterator, Callable, Optional
 
 from src.iDriveApiWrapper.uploader.Encryptor import Encryptor
+from src.iDriveApiWrapper.utils.Metrics import MetricsSink
 from src.iDriveApiWrapper.uploader.VideoExtractor import extract_thumbnail_if_needed, extract_subtitles_if_needed
 from src.iDriveApiWrapper.uploader.state import (UploadInput, DiscordAttachment, DiscordRequest, UploadConfig, UploadFileState, UploadFileStatus,
                                                  Crypto, ThumbnailAttachment, ChunkAttachment, SubtitleAttachment)
@@ -41,8 +43,10 @@ class _RequestBuilder:
 
 
 class PrepareRequestWorker:
-    def __init__(self, input_queue: Queue[UploadInput], upload_queue: Queue[DiscordRequest], get_config: Callable[[], UploadConfig], file_states: dict[uuid.UUID, UploadFileState]):
+    def __init__(self, input_queue: Queue[UploadInput], upload_queue: Queue[DiscordRequest], get_config: Callable[[], UploadConfig], file_states: dict[uuid.UUID, UploadFileState],
+                 metrics: Optional[MetricsSink] = None):
         self._input_queue = input_queue
+        self._metrics = metrics or MetricsSink()
         self._upload_queue = upload_queue
         self._builder = _RequestBuilder(get_config)
         self._file_states = file_states
@@ -126,11 +130,15 @@ class PrepareRequestWorker:
                     continue
 
                 take = min(remaining_request, remaining_file)
+                started = time.perf_counter()
                 raw_chunk = f.read(take)
                 if not raw_chunk:
                     break
 
+                read = time.perf_counter()
                 encrypted = file_encryptor.encrypt(raw_chunk)
+                self._metrics.observe("upload_stage_seconds", read - started, stage="read")
+                self._metrics.observe("upload_stage_seconds", time.perf_counter() - read, stage="encrypt")
                 att = ChunkAttachment(frontend_id=file_id, data=encrypted, sequence=sequence, offset=offset, crypto=file_crypto)
                 state.expected_chunks += 1
                 req = self._builder.flush_if_needed(att)
@@ -11,16 +11,29 @@ from src.iDriveApiWrapper.models.Webhook import Webhook
 from src.iDriveApiWrapper.uploader.PrepareRequestWorker import PrepareRequestWorker
 from src.iDriveApiWrapper.uploader.UploadWorker import UploadWorker
 from src.iDriveApiWrapper.uploader.state import UploadInput, UploadConfig, DiscordRequest, UploadFileState
+from src.iDriveApiWrapper.utils.BandwidthLimiter import BandwidthLimiter
+from src.iDriveApiWrapper.utils.Metrics import MetricsRegistry, MetricsSink
+from src.iDriveApiWrapper.utils.RetryScheduler import RetryScheduler, RetryPolicy
+from src.iDriveApiWrapper.utils.TransportPool import TransportPool
 from src.iDriveApiWrapper.utils.networker import make_request
 
 
 class UltraUploader:
-    def __init__(self, max_message_size: int, max_attachments: int, encryption_method: EncryptionMethod):
+    def __init__(self, max_message_size: int, max_attachments: int, encryption_method: EncryptionMethod, transport: Optional[TransportPool] = None,
+                 retry_policy: Optional[RetryPolicy] = None, bandwidth_limiter: Optional[BandwidthLimiter] = None,
+                 metrics: Optional[MetricsSink] = None):
         self._config: Optional[UploadConfig] = None
         self._config_lock = threading.Lock()
         self.max_message_size = max_message_size
         self.max_attachments = max_attachments
         self.encryption_method = encryption_method
+        self.transport = transport or TransportPool.default()
+        self.retry_policy = retry_policy or RetryPolicy()
+        # caps all upload workers at once, unlimited unless given a rate
+        self.bandwidth_limiter = bandwidth_limiter or BandwidthLimiter()
+        # per-stage latencies and counters, MetricsSink() turns them off
+        self.metrics = metrics or MetricsRegistry()
+        self._retries = RetryScheduler(name="iDriveUploadRetryScheduler")
 
         # Persistent queues
         self._input_queue: Queue[UploadInput] = Queue()
@@ -52,13 +65,14 @@ class UltraUploader:
                 return
 
             for _ in range(self._prepare_workers):
-                worker = PrepareRequestWorker(self._input_queue, self._upload_queue, self._get_config, self._file_states)
+                worker = PrepareRequestWorker(self._input_queue, self._upload_queue, self._get_config, self._file_states, self.metrics)
                 t = threading.Thread(target=worker.run, daemon=True)
                 t.start()
                 self._prepare_threads.append(t)
 
             for _ in range(self._upload_workers):
-                worker = UploadWorker(self._upload_queue, self._file_states, self._get_config, max_retries=5, global_pause=self._global_pause)
+                worker = UploadWorker(self._upload_queue, self._file_states, self._get_config, max_retries=5, global_pause=self._global_pause, transport=self.transport,
+                                      retries=self._retries, retry_policy=self.retry_policy, limiter=self.bandwidth_limiter, metrics=self.metrics)
                 t = threading.Thread(target=worker.run, daemon=True)
                 t.start()
                 self._upload_threads.append(t)
@@ -78,7 +92,12 @@ class UltraUploader:
 
     def join(self) -> None:
         self._input_queue.join()
-        self._upload_queue.join()
+        # requests waiting for a retry are in neither queue
+        while True:
+            self._upload_queue.join()
+            self._retries.join()
+            if not self._upload_queue.unfinished_tasks:
+                break
 
     def check_path(self, path) -> Path:
         path = Path(path).resolve()
@@ -87,7 +106,7 @@ class UltraUploader:
         return path
 
     def check_can_upload(self, parent: Folder) -> Optional[str]:
-        data = make_request("GET", f"user/canUpload/{parent.id}", headers=parent._get_password_header())
+        data = make_request("GET", f"user/canUpload/{parent.id}", headers=parent._get_password_header(), transport=self.transport)
 
         new_config = UploadConfig(
             webhooks=[Webhook(**hook) for hook in data["webhooks"]],
@@ -106,6 +125,13 @@ class UltraUploader:
 
         return data["lockFrom"]
 
+    def get_metrics(self) -> Dict[str, Dict[str, dict]]:
+        """
+        Snapshot of the per-stage latency histograms (read, encrypt, queue_wait, request) and counters
+        (bytes, requests by status, errors). Empty with a custom MetricsSink.
+        """
+        return self.metrics.snapshot(prefix="upload_") if isinstance(self.metrics, MetricsRegistry) else {}
+
     def _get_config(self) -> UploadConfig:
         cfg = self._config
         if cfg is None:
@@ -117,6 +143,8 @@ class UltraUploader:
     # ------------------------------------------------------------------
 
     def shutdown(self) -> None:
+        self._retries.shutdown()
+
         for _ in self._prepare_threads:
             self._input_queue.put(None)
         for t in self._prepare_threads:
@@ -2,24 +2,35 @@ import logging
 import time
 import threading
 import uuid
-from typing import Dict, Set
+from dataclasses import replace
+from typing import Dict, Optional, Set
 from queue import Queue
 
 from .DiscordUploader import DiscordUploader
 from .state import DiscordRequest, UploadFileState, UploadFileStatus, ChunkAttachment, SubtitleAttachment, ThumbnailAttachment
 from ..exceptions import RateLimitError, ServiceUnavailableError, NetworkError, ServerTimeoutError
+from ..utils.BandwidthLimiter import BandwidthLimiter
+from ..utils.Metrics import MetricsSink
+from ..utils.RetryScheduler import RetryScheduler, RetryPolicy
+from ..utils.TransportPool import TransportPool
 
 logger = logging.getLogger("iDrive")
 
 #todo unchecked
 class UploadWorker:
-    def __init__(self, upload_queue: Queue[DiscordRequest], upload_states: Dict[uuid.UUID, UploadFileState], get_config, max_retries: int, global_pause: threading.Event):
+    def __init__(self, upload_queue: Queue[DiscordRequest], upload_states: Dict[uuid.UUID, UploadFileState], get_config, max_retries: int, global_pause: threading.Event, transport: TransportPool,
+                 retries: RetryScheduler, retry_policy: RetryPolicy, limiter: Optional[BandwidthLimiter] = None,
+                 metrics: Optional[MetricsSink] = None):
         self.upload_queue = upload_queue
         self.upload_states = upload_states
         self._get_config = get_config
         self.max_retries = max_retries
         self.global_pause = global_pause
-        self.http = DiscordUploader(self._get_config,  global_pause, upload_states)
+        # failed requests come back through the scheduler, the worker moves on
+        self.retries = retries
+        self.retry_policy = retry_policy
+        self.metrics = metrics or MetricsSink()
+        self.http = DiscordUploader(self._get_config, global_pause, upload_states, transport, limiter, self.metrics)
 
     def run(self) -> None:
         while True:
@@ -49,6 +60,7 @@ class UploadWorker:
                 time.sleep(0.05)
                 continue
 
+            self.metrics.observe("upload_stage_seconds", time.monotonic() - task.queued_at, stage="queue_wait")
             try:
                 self._mark_uploading(states)
 
@@ -59,21 +71,27 @@ class UploadWorker:
                 self._mark_completed_if_done(states)
 
             except (RateLimitError, ServiceUnavailableError) as e:
+                self.metrics.increment("upload_errors_total", error=e.__class__.__name__)
                 if task.retries >= self.max_retries:
                     self._fail_states(states, e)
                 else:
-                    logger.warning(f"[UploadWorker] Throttled ({e.__class__.__name__}) → retrying in {e.wait}s (retry {task.retries}) request={task.request_id}")
-                    time.sleep(e.wait)
-                    task.retries += 1
-                    self.upload_queue.put(task)
+                    # the transport's rate limit registry holds the retry until the webhook's bucket resets
+                    logger.warning(f"[UploadWorker] Throttled ({e.__class__.__name__}) → requeued (retry {task.retries}) request={task.request_id}")
+                    self.upload_queue.put(replace(task, retries=task.retries + 1, queued_at=time.monotonic()))
 
             except (NetworkError, ServerTimeoutError) as e:
-                self._mark_retrying_network(states)
-                logger.warning(f"[UploadWorker] Network issue ({e.__class__.__name__}) → waiting 5s request={task.request_id}")
-                time.sleep(5)
-                self.upload_queue.put(task)
+                self.metrics.increment("upload_errors_total", error=e.__class__.__name__)
+                if self.retry_policy.gives_up(task.network_retries):
+                    self._fail_states(states, e)
+                else:
+                    delay = self.retry_policy.delay(task.network_retries)
+                    self._mark_retrying_network(states)
+                    logger.warning(f"[UploadWorker] Network issue ({e.__class__.__name__}) → retrying in {delay:.1f}s request={task.request_id}")
+                    self.retries.schedule(delay, self.upload_queue.put, replace(task, network_retries=task.network_retries + 1,
+                                                                                          queued_at=time.monotonic() + delay))
 
             except Exception as e:
+                self.metrics.increment("upload_errors_total", error=e.__class__.__name__)
                 self._fail_states(states, e)
                 logger.exception(f"[UploadWorker] Unexpected failure request={task.request_id}")
 
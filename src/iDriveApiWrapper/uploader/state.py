@@ -1,5 +1,6 @@
 import os
 import threading
+import time
 import uuid
 from dataclasses import dataclass, field
 from enum import Enum
@@ -111,6 +112,9 @@ class DiscordRequest:
     attachments: list[ChunkAttachment | ThumbnailAttachment | SubtitleAttachment | DiscordAttachment]
     request_id: uuid.UUID = uuid.uuid4()
     retries: int = 0
+    network_retries: int = 0
+    # monotonic time it entered the upload queue, for the queue wait metric
+    queued_at: float = field(default_factory=time.monotonic)
 
     @property
     def total_size(self):
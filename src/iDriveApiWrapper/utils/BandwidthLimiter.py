@@ -0,0 +1,157 @@
+import threading
+import time
+from typing import Dict, Hashable, Optional
+
+
+class _TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate: float, burst: Optional[float]):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    @property
+    def capacity(self) -> float:
+        # a quarter of a second worth of bytes by default: smooth, yet never less than a socket read
+        return self.burst if self.burst is not None else max(self.rate / 4, 64 * 1024)
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take(self, amount: int, now: float) -> float:
+        """Takes `amount` tokens, going into debt if needed, and returns the seconds until that debt is paid off."""
+        self.refill(now)
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class BandwidthLimiter:
+    """
+    Token bucket bandwidth cap, in bytes/sec, shared by every worker (and both directions) it is handed to.
+
+    There is one global bucket plus optional per-file ones; a transfer consumes from the global bucket and
+    from its file's, and waits for whichever is slower. Callers take tokens before pushing bytes any further
+    and may go into debt, so a chunk bigger than the burst is delayed instead of refused. Rates can be changed
+    or lifted at any time; lifting one releases the threads waiting on it. With no rate set, `consume` returns
+    straight away without taking any lock.
+    """
+
+    def __init__(self, rate: Optional[float] = None, burst: Optional[float] = None):
+        self._cond = threading.Condition()
+        self._global: Optional[_TokenBucket] = None
+        self._files: Dict[Hashable, _TokenBucket] = {}
+        self._burst = burst
+        # read without the lock on the hot path
+        self._active = False
+
+        self.bytes_consumed = 0
+        self.delayed_seconds = 0.0
+
+        self.set_rate(rate)
+
+    # ------------------------------------------------------------------
+    # Configuration
+    # ------------------------------------------------------------------
+
+    @property
+    def rate(self) -> Optional[float]:
+        bucket = self._global
+        return bucket.rate if bucket else None
+
+    def set_rate(self, rate: Optional[float]) -> None:
+        """Caps the combined throughput of everything using this limiter, None or 0 lifts the cap."""
+        with self._cond:
+            self._global = self._update(self._global, rate)
+            self._changed()
+
+    def get_file_rate(self, file_id: Hashable) -> Optional[float]:
+        bucket = self._files.get(file_id)
+        return bucket.rate if bucket else None
+
+    def set_file_rate(self, file_id: Hashable, rate: Optional[float]) -> None:
+        """Caps the throughput of one file on top of the global cap, None or 0 lifts it."""
+        with self._cond:
+            bucket = self._update(self._files.get(file_id), rate)
+            if bucket is None:
+                self._files.pop(file_id, None)
+            else:
+                self._files[file_id] = bucket
+            self._changed()
+
+    def limits(self, file_id: Optional[Hashable] = None) -> bool:
+        """Whether transfers of `file_id` are currently capped at all."""
+        return self._global is not None or (file_id is not None and file_id in self._files)
+
+    # ------------------------------------------------------------------
+    # Consuming
+    # ------------------------------------------------------------------
+
+    def consume(self, amount: int, file_id: Optional[Hashable] = None) -> None:
+        """Blocks until `amount` bytes of `file_id` may go through."""
+        if not self._active:
+            return
+
+        with self._cond:
+            delay = self._reserve(amount, file_id)
+            if delay <= 0:
+                return
+            started = time.monotonic()
+            deadline = started + delay
+            limits = (self._global, self._files.get(file_id))
+            # woken early when the limits this wait is for get changed or lifted
+            while limits == (self._global, self._files.get(file_id)):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            self.delayed_seconds += time.monotonic() - started
+
+    def reserve(self, amount: int, file_id: Optional[Hashable] = None) -> float:
+        """Non-blocking `consume`: takes the tokens and returns the seconds to wait before sending (e.g. with `asyncio.sleep`)."""
+        if not self._active:
+            return 0.0
+        with self._cond:
+            delay = self._reserve(amount, file_id)
+            self.delayed_seconds += delay
+            return delay
+
+    def stats(self) -> Dict[str, float]:
+        with self._cond:
+            return {
+                "rate": self.rate or 0,
+                "limited_files": len(self._files),
+                "bytes_consumed": self.bytes_consumed,
+                "delayed_seconds": self.delayed_seconds,
+            }
+
+    # ------------------------------------------------------------------
+    # Helpers
+    # ------------------------------------------------------------------
+
+    def _reserve(self, amount: int, file_id: Optional[Hashable]) -> float:
+        now = time.monotonic()
+        self.bytes_consumed += amount
+        delay = 0.0
+        if self._global is not None:
+            delay = self._global.take(amount, now)
+        bucket = self._files.get(file_id) if file_id is not None else None
+        if bucket is not None:
+            delay = max(delay, bucket.take(amount, now))
+        return delay
+
+    def _update(self, bucket: Optional[_TokenBucket], rate: Optional[float]) -> Optional[_TokenBucket]:
+        if not rate or rate <= 0:
+            return None
+        # a new bucket, so waiters notice the change; debt carries over so a lower rate can't be dodged
+        new = _TokenBucket(float(rate), self._burst)
+        if bucket is not None:
+            bucket.refill(time.monotonic())
+            new.tokens = min(bucket.tokens, new.capacity)
+        return new
+
+    def _changed(self) -> None:
+        self._active = self._global is not None or bool(self._files)
+        self._cond.notify_all()
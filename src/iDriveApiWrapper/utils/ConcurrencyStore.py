@@ -0,0 +1,102 @@
+import hashlib
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger("iDrive")
+
+
+class ConcurrencyStore:
+    """
+    Remembers, across sessions, the worker count that gave the best throughput, so the next
+    downloader can start there instead of ramping up from a single worker.
+
+    Entries are keyed by what the optimum depends on: job kind, account, bot count and network.
+    Kept in the per-user cache directory unless given a `path` (see `default_path`).
+    """
+
+    STATE_FILE = "concurrency_state.json"
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or ConcurrencyStore.default_path()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def default_path() -> str:
+        """%LOCALAPPDATA%\\iDrive on Windows, ~/Library/Caches/iDrive on macOS, $XDG_CACHE_HOME/iDrive (~/.cache/iDrive) elsewhere."""
+        if sys.platform == "win32":
+            base = os.environ.get("LOCALAPPDATA") or os.path.expanduser(os.path.join("~", "AppData", "Local"))
+        elif sys.platform == "darwin":
+            base = os.path.expanduser(os.path.join("~", "Library", "Caches"))
+        else:
+            base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(os.path.join("~", ".cache"))
+        return os.path.join(base, "iDrive", ConcurrencyStore.STATE_FILE)
+
+    @staticmethod
+    def make_key(kind: str, account: str, bots: int) -> str:
+        return f"{kind}:{account}:{bots}:{ConcurrencyStore.network_id()}"
+
+    @staticmethod
+    def account_id(token: str) -> str:
+        """The account part of a key, from the auth token the client already holds; hashed, the state file never holds the token."""
+        return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+    @staticmethod
+    def network_id() -> str:
+        """The local address used for outbound traffic: tells e.g. home wifi from office ethernet, without sending anything."""
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                s.connect(("10.254.254.254", 1))
+                return s.getsockname()[0]
+        except OSError:
+            return "unknown"
+
+    def get_workers(self, key: str) -> Optional[int]:
+        entry = self._load().get(key)
+        return entry["workers"] if entry else None
+
+    def record(self, key: str, workers: int, throughput: float, throttled: bool = False) -> None:
+        """
+        Stores a session's best worker count. A session that saw noticeably less throughput than the stored one
+        probably just had less work, so it only replaces the entry if it was throttled below the stored count.
+        """
+        with self._lock:
+            state = self._load()
+            entry = state.get(key)
+
+            if entry is None or throughput >= entry["throughput"] * 0.9:
+                entry = {"workers": workers, "throughput": throughput}
+            elif throttled and workers < entry["workers"]:
+                entry = {"workers": workers, "throughput": entry["throughput"]}
+            else:
+                return
+
+            entry["updated"] = time.time()
+            state[key] = entry
+            self._save(state)
+
+    def _load(self) -> Dict[str, dict]:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    def _save(self, state: Dict[str, dict]) -> None:
+        tmp_path = f"{self.path}.tmp"
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"[ConcurrencyStore] Could not save {self.path}: {e}")
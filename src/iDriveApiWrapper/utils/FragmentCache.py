@@ -0,0 +1,238 @@
+import logging
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import BinaryIO, Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger("iDrive")
+
+
+class FragmentCache:
+    """
+    On-disk cache of fragments' ciphertext, keyed by attachment id, shared by every downloader and process
+    pointing at the same directory. Ciphertext is what an attachment id stands for, so entries never go stale
+    and no plaintext ends up at rest.
+
+    Entries are written to a temp file (as their bytes arrive, see `store`) and renamed into place, so readers
+    never see a torn fragment without taking any lock. A hit bumps the entry's mtime; once the directory outgrows `max_bytes`, the least recently
+    used entries are deleted under an exclusive lock file, so concurrent processes never evict twice.
+    """
+
+    LOCK_FILE = ".lock"
+
+    def __init__(self, path: Optional[str] = None, max_bytes: int = 10 * 1024 ** 3):
+        self.path = path or os.path.join(tempfile.gettempdir(), "idrive_fragment_cache")
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # estimate of the directory size, corrected by every eviction pass
+        self._size = self._scan_size()
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.bytes_stored = 0
+        self.evictions = 0
+
+    # ------------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------------
+
+    def get(self, attachment_id: str) -> Optional[bytes]:
+        """The entry's ciphertext, None on a miss."""
+        f = self.open(attachment_id)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def open(self, attachment_id: str) -> Optional[BinaryIO]:
+        """
+        The entry opened for reading, None on a miss. Counts as the hit (or miss) itself, so one lookup
+        can decide on a fragment and its bytes be read later; an entry evicted meanwhile stays readable.
+        """
+        path = self._entry_path(attachment_id)
+        try:
+            f = open(path, "rb")
+        except OSError:
+            # missing, or evicted by another process in the meantime
+            with self._lock:
+                self.misses += 1
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += os.fstat(f.fileno()).st_size
+        return f
+
+    def put(self, attachment_id: str, data: bytes) -> None:
+        entry = self.store(attachment_id)
+        if entry is not None:
+            entry.write(data)
+            entry.commit()
+
+    def store(self, attachment_id: str) -> Optional["PendingEntry"]:
+        """Starts an entry to be written chunk by chunk as it downloads; None if it can't be stored."""
+        path = self._entry_path(attachment_id)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            f = open(tmp_path, "wb")
+        except OSError as e:
+            logger.warning(f"[FragmentCache] Could not store {attachment_id}: {e}")
+            return None
+        return PendingEntry(self, attachment_id, path, tmp_path, f)
+
+    def _stored(self, size: int) -> None:
+        with self._lock:
+            self.bytes_stored += size
+            self._size += size
+            over_budget = self._size > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def evict(self, target_bytes: Optional[int] = None) -> None:
+        """Deletes least recently used entries until the cache holds at most `target_bytes` (90% of the budget by default)."""
+        target_bytes = int(self.max_bytes * 0.9) if target_bytes is None else target_bytes
+        with self._process_lock():
+            entries = sorted(self._entries(), key=lambda entry: entry[1])
+            size = sum(entry[2] for entry in entries)
+            evicted = 0
+            for path, _, entry_size in entries:
+                if size <= target_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                size -= entry_size
+                evicted += 1
+
+        with self._lock:
+            self._size = size
+            self.evictions += evicted
+        if evicted:
+            logger.debug(f"[FragmentCache] Evicted {evicted} fragments, {size} bytes left")
+
+    def clear(self) -> None:
+        self.evict(target_bytes=0)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "bytes_saved": self.bytes_saved,
+                "bytes_stored": self.bytes_stored,
+                "evictions": self.evictions,
+                "size": self._size,
+            }
+
+    # ------------------------------------------------------------------
+    # Helpers
+    # ------------------------------------------------------------------
+
+    def _entry_path(self, attachment_id: str) -> str:
+        # attachment ids are snowflakes; a short prefix directory keeps any one directory small
+        name = "".join(c if c.isalnum() or c in "-_" else "_" for c in attachment_id)
+        return os.path.join(self.path, name[-2:], name)
+
+    def _entries(self):
+        """(path, mtime, size) of every entry."""
+        for directory in os.scandir(self.path):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                yield entry.path, stat.st_mtime, stat.st_size
+
+    def _scan_size(self) -> int:
+        return sum(entry[2] for entry in self._entries())
+
+    @contextmanager
+    def _process_lock(self):
+        with open(os.path.join(self.path, FragmentCache.LOCK_FILE), "a+b") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class PendingEntry:
+    """A cache entry being written: chunks go to its temp file, `commit` renames it into place, `abort` drops it."""
+
+    def __init__(self, cache: FragmentCache, attachment_id: str, path: str, tmp_path: str, file: BinaryIO):
+        self.attachment_id = attachment_id
+        self.size = 0
+        self._cache = cache
+        self._path = path
+        self._tmp_path = tmp_path
+        self._file: Optional[BinaryIO] = file
+
+    def write(self, data) -> None:
+        if self._file is None:
+            return
+        try:
+            self._file.write(data)
+        except OSError as e:
+            logger.warning(f"[FragmentCache] Could not store {self.attachment_id}: {e}")
+            self.abort()
+            return
+        self.size += len(data)
+        if self.size > self._cache.max_bytes:
+            self.abort()
+
+    def commit(self) -> None:
+        if self._file is None:
+            return
+        file, self._file = self._file, None
+        try:
+            file.close()
+            os.replace(self._tmp_path, self._path)
+        except OSError as e:
+            logger.warning(f"[FragmentCache] Could not store {self.attachment_id}: {e}")
+            self._remove_tmp()
+            return
+        self._cache._stored(self.size)
+
+    def abort(self) -> None:
+        if self._file is None:
+            return
+        file, self._file = self._file, None
+        try:
+            file.close()
+        except OSError:
+            pass
+        self._remove_tmp()
+
+    def _remove_tmp(self) -> None:
+        try:
+            os.remove(self._tmp_path)
+        except OSError:
+            pass
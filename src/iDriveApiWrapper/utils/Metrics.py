@@ -0,0 +1,170 @@
+import bisect
+import math
+import threading
+from typing import Dict, Optional, Sequence, Tuple
+
+# seconds, from a cached url lookup to a slow fragment over a bad link
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_Labels = Tuple[Tuple[str, str], ...]
+
+
+class MetricsSink:
+    """
+    Receives the transfer pipelines' measurements: `observe` for durations (seconds), `increment` for counts.
+    Does nothing by itself; subclass it to forward them elsewhere (statsd, OpenTelemetry, ...), or use
+    MetricsRegistry to keep them in memory. Called from worker threads, implementations must be thread-safe
+    and cheap.
+    """
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        pass
+
+    def increment(self, name: str, amount: float = 1, **labels: str) -> None:
+        pass
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count", "min", "max")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """Estimated from the buckets, linearly within the one holding the quantile, and kept within the observed range."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else lower
+                estimate = lower + (upper - lower) * (rank - seen) / count
+                return min(max(estimate, self.min), self.max)
+            seen += count
+        return self.max
+
+
+class MetricsRegistry(MetricsSink):
+    """
+    In-memory histograms and counters, keyed by name and labels, readable as a `snapshot` or in the
+    Prometheus text format (`to_prometheus`) under `namespace`. An observation is a dict lookup and a bisect
+    under one lock, a few per fragment, so keeping metrics costs nothing measurable next to the transfer.
+    """
+
+    def __init__(self, namespace: str = "idrive", buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.namespace = namespace
+        self.buckets = tuple(sorted(buckets))
+
+        self._lock = threading.Lock()
+        self._histograms: Dict[Tuple[str, _Labels], _Histogram] = {}
+        self._counters: Dict[Tuple[str, _Labels], float] = {}
+
+    # ------------------------------------------------------------------
+    # MetricsSink
+    # ------------------------------------------------------------------
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(self.buckets)
+            histogram.observe(value)
+
+    def increment(self, name: str, amount: float = 1, **labels: str) -> None:
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    # ------------------------------------------------------------------
+    # Reading
+    # ------------------------------------------------------------------
+
+    def snapshot(self, prefix: Optional[str] = None) -> Dict[str, Dict[str, dict]]:
+        """
+        {"counters": {series: value}, "histograms": {series: {"count", "sum", "avg", "p50", "p95", "p99"}}},
+        series being `name{label="value"}`, optionally only the names starting with `prefix`.
+        """
+        with self._lock:
+            counters = {key: value for key, value in self._counters.items() if not prefix or key[0].startswith(prefix)}
+            histograms = {key: (h.count, h.sum, h.quantile(0.5), h.quantile(0.95), h.quantile(0.99))
+                          for key, h in self._histograms.items() if not prefix or key[0].startswith(prefix)}
+
+        return {
+            "counters": {_series(name, labels): value for (name, labels), value in sorted(counters.items())},
+            "histograms": {
+                _series(name, labels): {"count": count, "sum": total, "avg": total / count if count else 0.0, "p50": p50, "p95": p95, "p99": p99}
+                for (name, labels), (count, total, p50, p95, p99) in sorted(histograms.items())
+            },
+        }
+
+    def to_prometheus(self) -> str:
+        """Everything recorded so far in the Prometheus text exposition format, e.g. for a `/metrics` endpoint."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(h.counts), h.sum, h.count) for key, h in self._histograms.items())
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            full = f"{self.namespace}_{name}"
+            if full not in typed:
+                typed.add(full)
+                lines.append(f"# TYPE {full} counter")
+            lines.append(f"{_series(full, labels)} {_number(value)}")
+
+        for (name, labels), counts, total, count in histograms:
+            full = f"{self.namespace}_{name}"
+            if full not in typed:
+                typed.add(full)
+                lines.append(f"# TYPE {full} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == math.inf else _number(bound)
+                lines.append(f"{_series(full + '_bucket', labels + (('le', le),))} {cumulative}")
+            lines.append(f"{_series(full + '_sum', labels)} {_number(total)}")
+            lines.append(f"{_series(full + '_count', labels)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+def _label_key(labels: Dict[str, str]) -> _Labels:
+    # the pipelines pass one label at most, sorting only matters past that
+    return tuple(labels.items()) if len(labels) < 2 else tuple(sorted(labels.items()))
+
+
+def _series(name: str, labels: _Labels) -> str:
+    if not labels:
+        return name
+    rendered = ",".join(f'{key}="{_escape(str(value))}"' for key, value in labels)
+    return f"{name}{{{rendered}}}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
@@ -0,0 +1,174 @@
+import logging
+import re
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+logger = logging.getLogger("iDrive")
+
+_ID_SEGMENT = re.compile(r"^(?=.*\d)[\w-]{8,}$")
+_MAJOR_PARAMS = ("channels", "guilds", "webhooks")
+# the CDN limits per client, not per route
+_HOST_WIDE = ("cdn.discordapp.com", "media.discordapp.net")
+
+
+class _Bucket:
+    __slots__ = ("remaining", "reset_at", "blocked_until")
+
+    def __init__(self):
+        self.remaining: Optional[int] = None
+        self.reset_at = 0.0
+        self.blocked_until = 0.0
+
+
+class RateLimitRegistry:
+    """
+    Rate limit state shared by every request of the process, learned from `Retry-After` and
+    Discord's `X-RateLimit-*` headers.
+
+    Requests are mapped to a route (method + host + path with ids collapsed, Discord "major" ids kept), routes
+    to the bucket the server reports for them. Senders call `acquire` (or the non-blocking `reserve`) before a
+    request and `update` with its response: a 429 blocks the whole bucket (or host, for global limits) until it
+    resets, and a bucket that reported no remaining requests blocks until its reset, so only the first request
+    ever gets throttled.
+    """
+
+    def __init__(self, default_retry_after: float = 2.0):
+        self.default_retry_after = default_retry_after
+
+        self._cond = threading.Condition()
+        self._route_buckets: Dict[str, str] = {}
+        self._buckets: Dict[str, _Bucket] = {}
+        self._host_blocked_until: Dict[str, float] = {}
+
+        self.throttled_responses = 0
+        self.delayed_requests = 0
+        self.delayed_seconds = 0.0
+
+    # ------------------------------------------------------------------
+    # Before sending
+    # ------------------------------------------------------------------
+
+    def acquire(self, method: str, url: str) -> None:
+        """Blocks until a request to `url` may be sent."""
+        waited = 0.0
+        with self._cond:
+            while True:
+                delay = self._reserve(method, url)
+                if delay <= 0:
+                    break
+                waited += delay
+                self._cond.wait(delay)
+            if waited:
+                self.delayed_requests += 1
+                self.delayed_seconds += waited
+
+    def reserve(self, method: str, url: str) -> float:
+        """0 if the request may go now (and counts it against its bucket), else the seconds to wait before asking again."""
+        with self._cond:
+            return self._reserve(method, url)
+
+    # ------------------------------------------------------------------
+    # After receiving headers
+    # ------------------------------------------------------------------
+
+    def update(self, method: str, url: str, status_code: int, headers) -> None:
+        now = time.monotonic()
+        route = self.route_key(method, url)
+        host = urlsplit(url).hostname or ""
+
+        with self._cond:
+            bucket_id = headers.get("X-RateLimit-Bucket")
+            if bucket_id:
+                self._route_buckets[route] = bucket_id
+            bucket = self._bucket(route)
+
+            remaining = headers.get("X-RateLimit-Remaining")
+            reset_after = _to_float(headers.get("X-RateLimit-Reset-After"))
+            if remaining is not None and remaining.isdigit():
+                bucket.remaining = int(remaining)
+                if reset_after is not None:
+                    bucket.reset_at = now + reset_after
+
+            if status_code in (429, 503):
+                self.throttled_responses += 1
+                retry_after = _to_float(headers.get("Retry-After"))
+                if retry_after is None:
+                    retry_after = reset_after if reset_after is not None else self.default_retry_after
+
+                is_global = headers.get("X-RateLimit-Global", "").lower() == "true" or headers.get("X-RateLimit-Scope") == "global"
+                if is_global or status_code == 503:
+                    self._host_blocked_until[host] = max(self._host_blocked_until.get(host, 0.0), now + retry_after)
+                else:
+                    bucket.blocked_until = max(bucket.blocked_until, now + retry_after)
+                logger.warning(f"[RateLimitRegistry] {status_code} on {route} ({'host-wide' if is_global or status_code == 503 else 'bucket'}) → holding for {retry_after:.2f}s")
+
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, float]:
+        with self._cond:
+            return {
+                "throttled_responses": self.throttled_responses,
+                "delayed_requests": self.delayed_requests,
+                "delayed_seconds": self.delayed_seconds,
+            }
+
+    # ------------------------------------------------------------------
+    # Helpers
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def route_key(method: str, url: str) -> str:
+        parts = urlsplit(url)
+        host = parts.hostname or ""
+        if host in _HOST_WIDE:
+            return host
+
+        segments = [s for s in parts.path.split("/") if s]
+        route = []
+        for i, segment in enumerate(segments):
+            previous = segments[i - 1] if i else ""
+            if previous in _MAJOR_PARAMS:
+                route.append(segment)
+            elif i >= 2 and segments[i - 2] == "webhooks":
+                route.append(":token")
+            elif _ID_SEGMENT.match(segment):
+                route.append(":id")
+            else:
+                route.append(segment)
+        return f"{method.upper()} {host}/{'/'.join(route)}"
+
+    def _bucket(self, route: str) -> _Bucket:
+        bucket_id = self._route_buckets.get(route, route)
+        bucket = self._buckets.get(bucket_id)
+        if bucket is None:
+            bucket = self._buckets[bucket_id] = _Bucket()
+        return bucket
+
+    def _reserve(self, method: str, url: str) -> float:
+        now = time.monotonic()
+        host = urlsplit(url).hostname or ""
+        bucket = self._bucket(self.route_key(method, url))
+
+        wait = max(self._host_blocked_until.get(host, 0.0), bucket.blocked_until) - now
+        if wait > 0:
+            return wait
+
+        if bucket.remaining is not None:
+            if bucket.reset_at <= now:
+                bucket.remaining = None
+            elif bucket.remaining <= 0:
+                return bucket.reset_at - now
+            else:
+                bucket.remaining -= 1
+        return 0.0
+
+
+def _to_float(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
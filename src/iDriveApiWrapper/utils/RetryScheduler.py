@@ -0,0 +1,95 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger("iDrive")
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """Exponential backoff with jitter: attempt n waits around `base_delay * multiplier**n`, capped at `max_delay`."""
+    base_delay: float = 1.0
+    multiplier: float = 2.0
+    max_delay: float = 60.0
+    # fraction of the delay that is randomized, so workers that failed together don't retry together
+    jitter: float = 0.5
+    # None retries forever
+    max_attempts: Optional[int] = None
+
+    def delay(self, attempt: int) -> float:
+        delay = min(self.max_delay, self.base_delay * self.multiplier ** attempt)
+        return delay * (1 - self.jitter) + random.uniform(0, delay * self.jitter)
+
+    def gives_up(self, attempt: int) -> bool:
+        return self.max_attempts is not None and attempt >= self.max_attempts
+
+
+class RetryScheduler:
+    """
+    One timer thread re-injecting delayed work, so worker threads never sleep on a failure.
+    Entries live in a heap ordered by due time.
+    """
+
+    def __init__(self, name: str = "iDriveRetryScheduler"):
+        self._cond = threading.Condition()
+        self._heap: List[Tuple[float, int, Callable, tuple]] = []
+        self._counter = itertools.count()
+        self._running = 0  # callbacks being executed right now
+        self._stopped = False
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def schedule(self, delay: float, fn: Callable, *args) -> None:
+        with self._cond:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), fn, args))
+            self._cond.notify_all()
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._heap) + self._running
+
+    def join(self) -> None:
+        """Blocks until every scheduled callback ran."""
+        with self._cond:
+            while self._heap or self._running:
+                self._cond.wait()
+
+    def shutdown(self) -> None:
+        """Stops the timer, dropping whatever is still scheduled."""
+        with self._cond:
+            self._stopped = True
+            self._heap.clear()
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    wait = self._heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+
+                if self._stopped:
+                    return
+                _, _, fn, args = heapq.heappop(self._heap)
+                self._running += 1
+
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception("[RetryScheduler] Scheduled callback failed")
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self._cond.notify_all()
@@ -52,6 +52,14 @@ class StreamCipherBase:
         if bytes_to_discard > 0:
             self._ctx.update(b"\x00" * bytes_to_discard)
 
+    def _update_into(self, data, out) -> int:
+        """Transforms `data` into the preallocated `out` (at least len(data) + 63 bytes), returns the byte count."""
+        if self.method == EncryptionMethod.Not_Encrypted:
+            n = len(data)
+            out[:n] = data
+            return n
+        return self._ctx.update_into(data, out)
+
     def finalize(self):
         if self.method == EncryptionMethod.Not_Encrypted:
             return b""
@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+from .RateLimitRegistry import RateLimitRegistry
+
+logger = logging.getLogger("iDrive")
+
+
+class _ReleasingStream(httpx.SyncByteStream):
+    def __init__(self, inner: httpx.SyncByteStream, release):
+        self._inner = inner
+        self._release = release
+
+    def __iter__(self):
+        yield from self._inner
+
+    def close(self) -> None:
+        try:
+            self._inner.close()
+        finally:
+            release, self._release = self._release, None
+            if release:
+                release()
+
+
+class _CappedTransport(httpx.BaseTransport):
+    """
+    Waits for the request's rate limit bucket, then holds one process-wide slot from sending
+    the request until its response is closed; waiting for a slot counts against the request's pool timeout.
+    Responses feed the rate limit registry.
+    """
+
+    def __init__(self, inner: httpx.BaseTransport, slots: Optional[threading.BoundedSemaphore], rate_limits: RateLimitRegistry):
+        self._inner = inner
+        self._slots = slots
+        self._rate_limits = rate_limits
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        url = str(request.url)
+        self._rate_limits.acquire(request.method, url)
+
+        if self._slots is None:
+            response = self._inner.handle_request(request)
+        else:
+            timeout = request.extensions.get("timeout", {}).get("pool")
+            if not self._slots.acquire(timeout=timeout):
+                raise httpx.PoolTimeout(f"No free connection slot within {timeout}s (max_total_connections reached)", request=request)
+            try:
+                response = self._inner.handle_request(request)
+            except BaseException:
+                self._slots.release()
+                raise
+            if response.is_closed:
+                # came back fully read (e.g. from a mock transport), nothing left to hold the slot for
+                self._slots.release()
+            else:
+                response.stream = _ReleasingStream(response.stream, self._slots.release)
+
+        self._rate_limits.update(request.method, url, response.status_code, response.headers)
+        return response
+
+    def close(self) -> None:
+        self._inner.close()
+
+
+class _RateLimitedAsyncTransport(httpx.AsyncBaseTransport):
+    def __init__(self, inner: httpx.AsyncBaseTransport, rate_limits: RateLimitRegistry):
+        self._inner = inner
+        self._rate_limits = rate_limits
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        url = str(request.url)
+        delay = self._rate_limits.reserve(request.method, url)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self._rate_limits.reserve(request.method, url)
+
+        response = await self._inner.handle_async_request(request)
+        self._rate_limits.update(request.method, url, response.status_code, response.headers)
+        return response
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
+
+
+class TransportPool:
+    """
+    Registry of pooled HTTP clients, one per host, shared by the API networker, the downloaders and the uploader,
+    so connections (and TLS handshakes) are reused across all of them.
+
+    `max_connections_per_host` / `max_keepalive_per_host` / `keepalive_expiry` configure each host's pool,
+    `max_total_connections` caps requests in flight across every host of the process.
+    Every request waits for its rate limit bucket in the shared `rate_limits` registry before it's sent.
+    """
+
+    _default: Optional["TransportPool"] = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, max_connections_per_host: int = 64, max_keepalive_per_host: int = 32, max_total_connections: Optional[int] = 256,
+                 keepalive_expiry: float = 30.0, http2: bool = False, timeout: float = 20.0,
+                 rate_limits: Optional[RateLimitRegistry] = None):
+        self.max_connections_per_host = max_connections_per_host
+        self.max_keepalive_per_host = max_keepalive_per_host
+        self.max_total_connections = max_total_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2 and self._http2_available()
+        self.timeout = timeout
+        self.rate_limits = rate_limits or RateLimitRegistry()
+
+        self._slots = threading.BoundedSemaphore(max_total_connections) if max_total_connections else None
+        self._clients: Dict[Tuple[str, str, Optional[int]], httpx.Client] = {}
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------
+    # Process-wide default
+    # ------------------------------------------------------------------
+
+    @classmethod
+    def default(cls) -> "TransportPool":
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    @classmethod
+    def set_default(cls, pool: "TransportPool") -> None:
+        with cls._default_lock:
+            cls._default = pool
+
+    # ------------------------------------------------------------------
+    # Clients
+    # ------------------------------------------------------------------
+
+    def client_for(self, url: str) -> httpx.Client:
+        key = self._host_key(url)
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                transport = httpx.HTTPTransport(limits=self._limits(), http2=self.http2)
+                client = httpx.Client(transport=_CappedTransport(transport, self._slots, self.rate_limits), timeout=self.timeout)
+                self._clients[key] = client
+            return client
+
+    def create_async_client(self, max_connections: Optional[int] = None) -> httpx.AsyncClient:
+        """A new AsyncClient with this pool's settings. Event-loop bound, so it's owned (and closed) by the caller."""
+        limits = httpx.Limits(
+            max_connections=max_connections or self.max_connections_per_host,
+            max_keepalive_connections=max_connections or self.max_keepalive_per_host,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+        transport = httpx.AsyncHTTPTransport(limits=limits, http2=self.http2)
+        return httpx.AsyncClient(transport=_RateLimitedAsyncTransport(transport, self.rate_limits), timeout=self.timeout)
+
+    def close(self) -> None:
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            client.close()
+
+    # ------------------------------------------------------------------
+    # Helpers
+    # ------------------------------------------------------------------
+
+    def _limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections_per_host,
+            max_keepalive_connections=self.max_keepalive_per_host,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    def _host_key(self, url: str) -> Tuple[str, str, Optional[int]]:
+        parts = urlsplit(url)
+        return parts.scheme, parts.hostname or "", parts.port
+
+    def _http2_available(self) -> bool:
+        try:
+            import h2  # noqa: F401
+            return True
+        except ImportError:
+            logger.warning("[TransportPool] http2 requested but the 'h2' package is not installed (pip install httpx[http2]), using HTTP/1.1")
+            return False
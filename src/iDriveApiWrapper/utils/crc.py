@@ -0,0 +1,66 @@
+from functools import lru_cache
+from typing import Iterable, Tuple
+
+# CRC-32 combine (same maths as zlib's crc32_combine): the CRC of A+B is derived from crc(A), crc(B) and len(B)
+# without touching the data. Shifting crc(A) over len(B) zero bytes is a linear operator over GF(2), which is
+# precomputed once per fragment length into four 256-entry lookup tables.
+
+_CRC32_POLY = 0xEDB88320
+
+
+def _gf2_times(mat, vec: int) -> int:
+    result = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            result ^= mat[i]
+        vec >>= 1
+        i += 1
+    return result
+
+
+def _gf2_compose(a, b) -> list:
+    return [_gf2_times(a, b[n]) for n in range(32)]
+
+
+@lru_cache(maxsize=64)
+def _zeros_tables(length: int) -> Tuple[Tuple[int, ...], ...]:
+    # operator for a single zero bit
+    op = [_CRC32_POLY] + [1 << (n - 1) for n in range(1, 32)]
+    # ... squared three times → a single zero byte
+    for _ in range(3):
+        op = _gf2_compose(op, op)
+
+    result = [1 << n for n in range(32)]  # identity
+    while length:
+        if length & 1:
+            result = _gf2_compose(op, result)
+        length >>= 1
+        if length:
+            op = _gf2_compose(op, op)
+
+    tables = []
+    for byte in range(4):
+        table = [0] * 256
+        for v in range(1, 256):
+            low = v & -v
+            table[v] = table[v ^ low] ^ result[byte * 8 + low.bit_length() - 1]
+        tables.append(tuple(table))
+    return tuple(tables)
+
+
+def crc32_combine(crc1: int, crc2: int, len2: int) -> int:
+    """CRC-32 of the concatenation of two blocks, given their CRCs and the length of the second one."""
+    if len2 <= 0:
+        return crc1
+    t0, t1, t2, t3 = _zeros_tables(len2)
+    shifted = t0[crc1 & 0xFF] ^ t1[(crc1 >> 8) & 0xFF] ^ t2[(crc1 >> 16) & 0xFF] ^ t3[crc1 >> 24]
+    return (shifted ^ crc2) & 0xFFFFFFFF
+
+
+def crc32_combine_all(parts: Iterable[Tuple[int, int]]) -> int:
+    """Combines `(crc, length)` pairs, in order, into the CRC-32 of the whole."""
+    crc = 0
+    for part_crc, length in parts:
+        crc = crc32_combine(crc, part_crc, length)
+    return crc
@@ -9,10 +9,12 @@ from ..Config import APIConfig
 from ..Constants import BASE_URL
 from ..exceptions import BadRequestError, ResourcePermissionError, ResourceNotFoundError, MissingOrIncorrectResourcePasswordError, IDriveException, RateLimitError, UnauthorizedError, \
     ServiceUnavailableError, InternalServerError, BadMethodError, ServerTimeoutError, NetworkError
+from typing import Optional
+
+from .TransportPool import TransportPool
 
 logger = logging.getLogger("iDrive")
 
-httpxClient = httpx.Client(timeout=20.0)
 DEFAULT_RETRY_AFTER = 5
 
 
@@ -26,7 +28,8 @@ def _get_headers() -> dict:
     return headers
 
 
-def make_request(method: str, endpoint: str, data: dict = None, headers: dict = None, params: dict = None, files: dict = None, retry=True) -> dict:
+def make_request(method: str, endpoint: str, data: dict = None, headers: dict = None, params: dict = None, files: dict = None, retry=True,
+                 transport: Optional[TransportPool] = None) -> dict:
     headers = {k: v for k, v in (headers or {}).items() if v is not None}
     headers.update(_get_headers())
 
@@ -39,27 +42,25 @@ def make_request(method: str, endpoint: str, data: dict = None, headers: dict =
     logger.debug(f"Calling... Endpoint={endpoint}, Method={method}, Headers={safe_headers}")
 
     try:
-        response = httpxClient.request(method, url, headers=headers, json=data, params=params, files=files, timeout=5)
+        response = (transport or TransportPool.default()).client_for(url).request(method, url, headers=headers, json=data, params=params, files=files, timeout=5)
     except httpx.TimeoutException as e:
         logger.warning(f"Request timeout: {method} {endpoint}")
         if retry:
             time.sleep(DEFAULT_RETRY_AFTER)
-            return make_request(method, endpoint, data, headers, params, files, retry=False)
+            return make_request(method, endpoint, data, headers, params, files, retry=False, transport=transport)
         raise ServerTimeoutError("Request timed out") from e
 
     except httpx.RequestError as e:
         logger.error(f"Server not responding: {method} {endpoint} ({e})")
         if retry:
             time.sleep(DEFAULT_RETRY_AFTER)
-            return make_request(method, endpoint, data, headers, params, files, retry=False)
+            return make_request(method, endpoint, data, headers, params, files, retry=False, transport=transport)
         raise NetworkError("Server not responding") from e
 
     if response.status_code == 429 and retry:
-        retry_after = response.headers.get("Retry-After")
-        wait_time = int(retry_after) if retry_after and retry_after.isdigit() else DEFAULT_RETRY_AFTER
-        logger.warning(f"Rate limited (429). Retrying after {wait_time} seconds...")
-        time.sleep(wait_time)
-        return make_request(method, url, headers, data, params, files, retry=False)
+        # the transport's rate limit registry holds the retry (and everyone else on this route) until the bucket resets
+        logger.warning(f"Rate limited (429) on {method} {endpoint}, retrying once the bucket resets")
+        return make_request(method, endpoint, data, headers, params, files, retry=False, transport=transport)
 
     if not response.is_success:
         _raise_for_status(response)
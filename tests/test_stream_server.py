@@ -0,0 +1,151 @@
+import os
+
+import httpx
+import pytest
+
+from src.iDriveApiWrapper.downloader.StreamServer import StreamServer
+from src.iDriveApiWrapper.downloader.state import FileInfo, FragmentInfo
+from src.iDriveApiWrapper.models.Enums import EncryptionMethod
+
+FRAGMENT_SIZE = 1000
+
+
+class _Resolver:
+    def resolve(self, attachment_id, password=None):
+        return f"https://cdn.test/{attachment_id}"
+
+    def invalidate(self, attachment_id):
+        pass
+
+
+class _Transport:
+    """Serves the fragments from memory through an httpx MockTransport."""
+
+    def __init__(self, blobs):
+        self.blobs = blobs
+        self.client = httpx.Client(transport=httpx.MockTransport(self._handle))
+
+    def _handle(self, request):
+        return httpx.Response(200, content=self.blobs[request.url.path.strip("/")])
+
+    def client_for(self, url):
+        return self.client
+
+
+def _file(file_id, data):
+    fragments, blobs = [], {}
+    for sequence, offset in enumerate(range(0, len(data), FRAGMENT_SIZE), start=1):
+        attachment_id = f"{file_id}-{sequence}"
+        blobs[attachment_id] = data[offset:offset + FRAGMENT_SIZE]
+        fragments.append(FragmentInfo(message_id="m", attachment_id=attachment_id, offset=offset, sequence=sequence, size=len(blobs[attachment_id])))
+    info = FileInfo(id=file_id, name=f"{file_id}.mp4", encryption_method=EncryptionMethod.Not_Encrypted, size=len(data), crc=0, password=None, fragments=fragments)
+    return info, blobs
+
+
+@pytest.fixture
+def data():
+    return os.urandom(3500)
+
+
+@pytest.fixture
+def served(data):
+    info, blobs = _file("f1", data)
+    server = StreamServer(resolver=_Resolver(), transport=_Transport(blobs), metadata_fetcher=object(), chunk_size=700)
+    url = server.register(info)
+    yield server, url
+    server.stop()
+
+
+def test_full_get(served, data):
+    _, url = served
+    r = httpx.get(url)
+    assert r.status_code == 200
+    assert r.headers["Accept-Ranges"] == "bytes"
+    assert r.headers["Content-Type"] == "video/mp4"
+    assert r.content == data
+
+
+def test_range(served, data):
+    _, url = served
+    r = httpx.get(url, headers={"Range": "bytes=900-2100"})
+    assert r.status_code == 206
+    assert r.headers["Content-Range"] == f"bytes 900-2100/{len(data)}"
+    assert r.content == data[900:2101]
+
+
+def test_open_ended_range(served, data):
+    _, url = served
+    r = httpx.get(url, headers={"Range": "bytes=3000-"})
+    assert r.status_code == 206
+    assert r.content == data[3000:]
+
+
+def test_suffix_range(served, data):
+    _, url = served
+    r = httpx.get(url, headers={"Range": "bytes=-100"})
+    assert r.status_code == 206
+    assert r.headers["Content-Range"] == f"bytes {len(data) - 100}-{len(data) - 1}/{len(data)}"
+    assert r.content == data[-100:]
+
+
+def test_head(served, data):
+    _, url = served
+    r = httpx.head(url, headers={"Range": "bytes=10-19"})
+    assert r.status_code == 206
+    assert r.headers["Content-Length"] == "10"
+    assert r.content == b""
+
+
+@pytest.mark.parametrize("header", [f"bytes={3500}-", "bytes=-0", "bytes=20-10"])
+def test_unsatisfiable_range(served, data, header):
+    _, url = served
+    r = httpx.get(url, headers={"Range": header})
+    assert r.status_code == 416
+    assert r.headers["Content-Range"] == f"bytes */{len(data)}"
+
+
+def test_unknown_token(served):
+    _, url = served
+    assert httpx.get(url.replace(url.split("/")[3], "nope")).status_code == 404
+
+
+def test_eviction_waits_for_requests_in_flight(data):
+    first, blobs = _file("f1", data)
+    second, more = _file("f2", data)
+    blobs.update(more)
+    server = StreamServer(resolver=_Resolver(), transport=_Transport(blobs), metadata_fetcher=object(), max_files=1)
+    try:
+        url = server.register(first)
+        remote = server._lookup(httpx.URL(url).path)
+        server.register(second)
+
+        # evicted, but still serving the request that looked it up
+        assert "f1" not in server._files
+        assert not remote.closed
+        assert remote.read_at(0, 10) == data[:10]
+
+        server._release(remote)
+        assert remote.closed
+    finally:
+        server.stop()
+
+
+def test_eviction_prefers_idle_files(data):
+    infos, blobs = [], {}
+    for file_id in ("f1", "f2", "f3"):
+        info, more = _file(file_id, data)
+        infos.append(info)
+        blobs.update(more)
+    server = StreamServer(resolver=_Resolver(), transport=_Transport(blobs), metadata_fetcher=object(), max_files=2)
+    try:
+        busy = server._lookup(httpx.URL(server.register(infos[0])).path)
+        server._release(server._lookup(httpx.URL(server.register(infos[1])).path))
+        server.register(infos[2])
+
+        # f1 is the least recently served, but f2 is the idle one
+        assert list(server._files) == ["f1", "f3"]
+        assert not busy.closed
+        server._release(busy)
+        assert not busy.closed
+    finally:
+        server.stop()